@@ -11,9 +11,12 @@ import functools
 import json
 import logging
 import webapp2
+import zlib
 
 from google.appengine.api import users
 
+from components import profiling
+
 from . import api
 from . import config
 from . import host_token
@@ -94,6 +97,21 @@ class AuthenticatingHandler(webapp2.RequestHandler):
   frame_options = 'DENY'
 
   def dispatch(self):
+    """Profiles the request, see components.profiling.
+
+    Only a ratio of profiling.PROFILE_SAMPLE_RATE of the requests is profiled.
+    An admin can pass '_trace=1' to get the full RPC trace in the logs.
+    """
+    route = getattr(self.request.route, 'template', None)
+    # The caller is known to be an admin only once authenticated.
+    trace = self.request.get('_trace') == '1'
+    profile = profiling.start(route or self.__class__.__name__, force=trace)
+    try:
+      self.authenticate_and_dispatch()
+    finally:
+      profiling.stop(profile, trace=trace and api.is_admin())
+
+  def authenticate_and_dispatch(self):
     """Extracts and verifies Identity, sets up request auth context."""
     # Ensure auth component is configured before executing any code.
     # Configuration may modify _auth_methods used below.
@@ -281,6 +299,8 @@ class ApiHandler(AuthenticatingHandler):
   """Parses JSON request body to a dict, serializes response to JSON."""
   CONTENT_TYPE_BASE = 'application/json'
   CONTENT_TYPE_FULL = 'application/json; charset=utf-8'
+  # Maximum size of a gzip compressed body once decompressed.
+  MAX_DECOMPRESSED_BODY_SIZE = 32 * 1024 * 1024
   _json_body = None
   # Clickjacking not applicable to APIs.
   frame_options = None
@@ -312,6 +332,9 @@ class ApiHandler(AuthenticatingHandler):
   def parse_body(self):
     """Parses JSON body and verifies it's a dict.
 
+    The body may be gzip compressed, as specified by the Content-Encoding
+    header. The decompressed body is limited to MAX_DECOMPRESSED_BODY_SIZE.
+
     webob.Request doesn't cache the decoded json body, this function does.
     """
     if self._json_body is None:
@@ -321,8 +344,24 @@ class ApiHandler(AuthenticatingHandler):
             'Expecting JSON body with content type \'%s\'' %
             self.CONTENT_TYPE_BASE)
         self.abort_with_error(400, text=msg)
+      body = None
+      if self.request.headers.get('Content-Encoding') == 'gzip':
+        try:
+          # 16 is to expect the gzip header.
+          decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+          body = decompressor.decompress(
+              self.request.body, self.MAX_DECOMPRESSED_BODY_SIZE)
+        except zlib.error:
+          self.abort_with_error(400, text='Not a valid gzip body')
+        if decompressor.unconsumed_tail:
+          self.abort_with_error(
+              413, text='Decompressed body is larger than %d bytes' %
+              self.MAX_DECOMPRESSED_BODY_SIZE)
       try:
-        self._json_body = self.request.json
+        if body is not None:
+          self._json_body = json.loads(body)
+        else:
+          self._json_body = self.request.json
         if not isinstance(self._json_body, dict):
           raise ValueError()
       except (LookupError, ValueError):
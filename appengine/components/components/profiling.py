@@ -0,0 +1,313 @@
+# Copyright 2014 The Swarming Authors. All rights reserved.
+# Use of this source code is governed by the Apache v2.0 license that can be
+# found in the LICENSE file.
+
+"""Per route profiling of the RPCs, the wall time and the CPU time.
+
+auth.AuthenticatingHandler.dispatch() profiles each request with start() and
+stop(). The RPCs are intercepted with apiproxy hooks and counted per service
+and method. Each request logs one entry, with its own prefix so the
+application's stats parsers never see them, that STATS_HANDLER aggregates per
+route. The application must add get_backend_routes() to its backend and a
+cron job to /internal/cron/profiling/update for the snapshots to be generated,
+so a failure there doesn't affect the application's own statistics.
+
+Only a ratio of PROFILE_SAMPLE_RATE of the requests is profiled; the
+application can change it, e.g. set it to 0 to disable the per request entry.
+The counts in the snapshots are then the counts of the sampled requests.
+
+A full trace of the RPCs is logged when an admin passes the request parameter
+'_trace=1' or when the request is randomly sampled with TRACE_SAMPLE_RATE.
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+
+import webapp2
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import quota
+from google.appengine.ext import ndb
+
+from components import decorators
+from components import stats_framework
+from components import utils
+
+
+# Logs prefix, distinct from stats_framework.PREFIX.
+PREFIX = 'Profile: '
+
+
+# Ratio of the requests which are profiled.
+PROFILE_SAMPLE_RATE = 0.01
+
+
+# Ratio of the profiled requests which full RPC trace is logged.
+TRACE_SAMPLE_RATE = 0.
+
+
+# Percentiles exposed for the latency histograms.
+_PERCENTILES = (50, 90, 99)
+
+
+# Key used to register the apiproxy hooks.
+_HOOK_NAME = 'components_profiling'
+
+
+# Profile of the request handled by the current thread, if any.
+_LOCAL = threading.local()
+
+
+# apiproxy instance the hooks are registered in. It is replaced by testbed.
+_hooked_apiproxy = None
+_hooks_lock = threading.Lock()
+
+
+### Private stuff.
+
+
+class _Profile(object):
+  """Measurements of a single request."""
+  def __init__(self, route):
+    self.route = route
+    self.start = time.time()
+    self.cpu_start = quota.get_request_cpu_usage()
+    # 'service.method': [calls, total ms].
+    self.rpcs = {}
+    # id(response): start time, of the RPCs in flight.
+    self.pending = {}
+    # (start offset ms, duration ms, 'service.method', error).
+    self.trace = []
+
+  def to_entry(self):
+    """Returns the entry to log for this profile."""
+    cpu = quota.get_request_cpu_usage() - self.cpu_start
+    return utils.encode_to_json({
+      'c': int(round(quota.megacycles_to_cpu_seconds(cpu) * 1000.)),
+      'r': self.route,
+      'rpc': self.rpcs,
+      'w': int(round((time.time() - self.start) * 1000.)),
+    })
+
+
+def _pre_call_hook(service, call, request, response, rpc=None):
+  """apiproxy hook called when a RPC starts."""
+  # pylint: disable=W0613
+  profile = getattr(_LOCAL, 'profile', None)
+  if profile:
+    profile.pending[id(response)] = time.time()
+
+
+def _post_call_hook(service, call, request, response, rpc=None, error=None):
+  """apiproxy hook called when a RPC completed."""
+  # pylint: disable=W0613
+  profile = getattr(_LOCAL, 'profile', None)
+  if not profile:
+    return
+  now = time.time()
+  start = profile.pending.pop(id(response), now)
+  duration_ms = (now - start) * 1000.
+  name = '%s.%s' % (service, call)
+  item = profile.rpcs.setdefault(name, [0, 0])
+  item[0] += 1
+  item[1] += int(round(duration_ms))
+  profile.trace.append(
+      (
+        int(round((start - profile.start) * 1000.)),
+        int(round(duration_ms)),
+        name,
+        error.__class__.__name__ if error else None,
+      ))
+
+
+def _install_hooks():
+  """Registers the apiproxy hooks once per process."""
+  global _hooked_apiproxy
+  with _hooks_lock:
+    apiproxy = apiproxy_stub_map.apiproxy
+    if apiproxy is _hooked_apiproxy:
+      return
+    apiproxy.GetPreCallHooks().Append(_HOOK_NAME, _pre_call_hook)
+    apiproxy.GetPostCallHooks().Append(_HOOK_NAME, _post_call_hook)
+    _hooked_apiproxy = apiproxy
+
+
+class _SnapshotForRpc(ndb.Model):
+  """Statistics for a RPC method, e.g. 'datastore_v3.Get'."""
+  name = ndb.StringProperty()
+  calls = ndb.IntegerProperty(default=0)
+  total_ms = ndb.IntegerProperty(default=0)
+
+  def accumulate(self, rhs):
+    assert self.name == rhs.name
+    stats_framework.accumulate(self, rhs, ['name'])
+
+
+class _SnapshotForRoute(ndb.Model):
+  """Statistics for a route."""
+  route = ndb.StringProperty()
+  requests = ndb.IntegerProperty(default=0)
+  # Latency histograms, see stats_framework.histogram_add().
+  wall_ms_histogram = ndb.IntegerProperty(repeated=True)
+  cpu_ms_histogram = ndb.IntegerProperty(repeated=True)
+
+  rpcs = ndb.LocalStructuredProperty(_SnapshotForRpc, repeated=True)
+
+  def get_rpc(self, name):
+    """Returns a _SnapshotForRpc instance for this method.
+
+    Creates one if necessary and keeps self.rpcs sorted.
+    """
+    for i, rpc in enumerate(self.rpcs):
+      if rpc.name == name:
+        return rpc
+      if rpc.name > name:
+        new_item = _SnapshotForRpc(name=name)
+        self.rpcs.insert(i, new_item)
+        return new_item
+    new_item = _SnapshotForRpc(name=name)
+    self.rpcs.append(new_item)
+    return new_item
+
+  def accumulate(self, rhs):
+    assert self.route == rhs.route
+    stats_framework.accumulate(
+        self, rhs, ['cpu_ms_histogram', 'route', 'rpcs', 'wall_ms_histogram'])
+    self.wall_ms_histogram = stats_framework.histogram_merge(
+        self.wall_ms_histogram, rhs.wall_ms_histogram)
+    self.cpu_ms_histogram = stats_framework.histogram_merge(
+        self.cpu_ms_histogram, rhs.cpu_ms_histogram)
+    for rpc in rhs.rpcs:
+      self.get_rpc(rpc.name).accumulate(rpc)
+
+  def to_dict(self):
+    out = {
+      'route': self.route,
+      'requests': self.requests,
+      'rpcs': dict(
+          (i.name, {'calls': i.calls, 'total_ms': i.total_ms})
+          for i in self.rpcs),
+    }
+    for p in _PERCENTILES:
+      out['wall_secs_p%d' % p] = stats_framework.histogram_percentile(
+          self.wall_ms_histogram, p)
+      out['cpu_secs_p%d' % p] = stats_framework.histogram_percentile(
+          self.cpu_ms_histogram, p)
+    return out
+
+
+class _Snapshot(ndb.Model):
+  """A snapshot of the profiles for the specific time frame."""
+  routes = ndb.LocalStructuredProperty(_SnapshotForRoute, repeated=True)
+
+  def get_route(self, route):
+    """Returns a _SnapshotForRoute instance for this route.
+
+    Creates one if necessary and keeps self.routes sorted.
+    """
+    for i, item in enumerate(self.routes):
+      if item.route == route:
+        return item
+      if item.route > route:
+        new_item = _SnapshotForRoute(route=route)
+        self.routes.insert(i, new_item)
+        return new_item
+    new_item = _SnapshotForRoute(route=route)
+    self.routes.append(new_item)
+    return new_item
+
+  def accumulate(self, rhs):
+    for item in rhs.routes:
+      self.get_route(item.route).accumulate(item)
+
+  def to_dict(self):
+    return {'routes': [i.to_dict() for i in self.routes]}
+
+
+def _parse_line(line, values):
+  """Adds a profile entry to the snapshot."""
+  data = json.loads(line)
+  route = values.get_route(data['r'])
+  route.requests += 1
+  stats_framework.histogram_add(route.wall_ms_histogram, data['w'])
+  stats_framework.histogram_add(route.cpu_ms_histogram, data['c'])
+  for name, (calls, total_ms) in sorted(data['rpc'].iteritems()):
+    rpc = route.get_rpc(name)
+    rpc.calls += calls
+    rpc.total_ms += total_ms
+
+
+def _extract_snapshot_from_logs(start_time, end_time):
+  """Returns a _Snapshot from the profile entries in this time interval."""
+  values = _Snapshot()
+  for entry in stats_framework.yield_entries(start_time, end_time, PREFIX):
+    for line in entry.entries:
+      try:
+        _parse_line(line, values)
+      except (KeyError, TypeError, ValueError) as e:
+        logging.error('Failed to parse %r: %s', line, e)
+  return values
+
+
+class _CronProfilingUpdate(webapp2.RequestHandler):
+  """Called every minute to generate the profiling snapshots."""
+  @decorators.require_cronjob
+  def get(self):
+    self.response.headers['Content-Type'] = 'text/plain'
+    minutes = STATS_HANDLER.process_next_chunk(stats_framework.TOO_RECENT)
+    if minutes is not None:
+      msg = 'Processed %d minutes' % minutes
+      logging.info(msg)
+      self.response.write(msg)
+
+
+### Public API.
+
+
+STATS_HANDLER = stats_framework.StatisticsFramework(
+    'profiling', _Snapshot, _extract_snapshot_from_logs,
+    kind_prefix='Profiling')
+
+
+def get_backend_routes():
+  # This requires a cron job to this URL.
+  return [
+    webapp2.Route(r'/internal/cron/profiling/update', _CronProfilingUpdate),
+  ]
+
+
+def start(route, force=False):
+  """Starts profiling the request handled by the current thread.
+
+  Returns the profile to pass to stop(), None if the request is not sampled
+  with PROFILE_SAMPLE_RATE and force is False.
+  """
+  if not force and (
+      PROFILE_SAMPLE_RATE < 1. and random.random() >= PROFILE_SAMPLE_RATE):
+    return None
+  _install_hooks()
+  profile = _Profile(route)
+  _LOCAL.profile = profile
+  return profile
+
+
+def stop(profile, trace=False):
+  """Stops profiling and logs the entry for STATS_HANDLER.
+
+  The full RPC trace is also logged if trace is True or if the request is
+  sampled. Does nothing if profile is None.
+  """
+  if not profile:
+    return
+  _LOCAL.profile = None
+  logging.debug(PREFIX + profile.to_entry())
+  if trace or (TRACE_SAMPLE_RATE and random.random() < TRACE_SAMPLE_RATE):
+    logging.info(
+        'Trace of %s:\n%s', profile.route,
+        '\n'.join(
+            '%6dms %6dms %s%s' % (
+                offset, duration, name, ' (%s)' % error if error else '')
+            for offset, duration, name, error in profile.trace))
@@ -15,9 +15,14 @@ import calendar
 import collections
 import datetime
 import logging
+import math
+import os
+import random
+import threading
 
 from google.appengine.api import datastore_errors
 from google.appengine.api import logservice
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from google.appengine.runtime import DeadlineExceededError
 
@@ -28,9 +33,55 @@ from components import utils
 PREFIX = 'Stats: '
 
 
-# Supported resolutions. In theory, 'weeks' and 'months' could be added one day
-# if desired.
-RESOLUTIONS = ('days', 'hours', 'minutes')
+# Memcache namespace of the entries buffered with the 'memcache' backend.
+_BUFFER_NAMESPACE = 'stats_framework_buffer'
+
+
+# Buffered entries must survive until their minute is processed.
+_BUFFER_EXPIRATION = 24*60*60
+
+
+# Counts of the entries buffered in-process by add_buffered_entry() and
+# add_buffered_request(), per minute, until flush_buffered_entries() merges
+# them into the memcache shards. Each value is {'lines': {line: count},
+# 'requests': {status: count}}.
+_BUFFER = {}
+_BUFFER_LOCK = threading.Lock()
+# Epoch of the oldest entry in _BUFFER.
+_buffer_oldest = None
+
+
+# Number of attempts to merge a minute into a memcache shard, each with a
+# different shard, before giving up.
+_BUFFER_CAS_ATTEMPTS = 3
+
+
+# In-process LRU cache of the sealed entities and of their to_dict() form, see
+# _get_multi_sealed_cached(). The least recently used items are evicted past
+# _SEALED_CACHE_MAX_ITEMS.
+_SEALED_CACHE = collections.OrderedDict()
+_SEALED_CACHE_LOCK = threading.Lock()
+_SEALED_CACHE_MAX_ITEMS = 2000
+
+
+# Holds the StatsEntry being replayed by the current thread, see
+# StatisticsFramework.replay_minute().
+_REPLAYED = threading.local()
+
+
+# Supported resolutions, from the coarsest to the finest.
+RESOLUTIONS = ('months', 'weeks', 'days', 'hours', 'minutes')
+
+
+# Approximate duration of an item for each resolution, used to select the
+# resolution when 'auto' is requested, see pick_resolution().
+_RESOLUTION_SPAN = {
+  'months': datetime.timedelta(days=31),
+  'weeks': datetime.timedelta(days=7),
+  'days': datetime.timedelta(days=1),
+  'hours': datetime.timedelta(hours=1),
+  'minutes': datetime.timedelta(minutes=1),
+}
 
 
 # Number of minutes to ignore because they are too fresh. This is done so that
@@ -39,14 +90,55 @@ RESOLUTIONS = ('days', 'hours', 'minutes')
 TOO_RECENT = 5 if not utils.is_local_dev_server() else 1
 
 
+# Supported sources for the entries used to generate the snapshots:
+# - 'logs': add_entry() logs the entries and yield_entries() scrapes them back
+#   from logservice. It also gives access to each HTTP request but costs log
+#   read quota and falls behind under high QPS.
+# - 'memcache': add_buffered_entry() and add_buffered_request() count the
+#   entries per minute in-process, then in sharded per-minute counters in
+#   memcache. yield_buffered_entries() flushes the counters of a minute to the
+#   datastore and reads them back. The requests are only counted when the
+#   application is wrapped with buffered_requests_wsgi_middleware().
+BACKENDS = ('logs', 'memcache')
+
+
+# Number of minutes to ignore when using the 'memcache' backend. There's no log
+# consistency to wait for, only the requests still running.
+TOO_RECENT_BUFFERED = 2
+
+
+# Number of counters per minute the buffered entries are spread over, so a
+# single memcache key doesn't become a hot spot.
+BUFFER_SHARDS = 16
+
+
+# Maximum number of seconds the entries are buffered in-process before being
+# merged into the memcache counters. They are merged sooner when their minute
+# is over.
+BUFFER_FLUSH_SECS = 5
+
+
 # One handled HTTP request and the associated statistics if any.
 StatsEntry = collections.namedtuple('StatsEntry', ('request', 'entries'))
 
 
+# Minimal replacement of logservice.RequestLog for replayed entries, see
+# entry_from_dict().
+ReplayedRequest = collections.namedtuple(
+    'ReplayedRequest', ('status', 'end_time'))
+
+
+# Ratio between the upper and lower bounds of a latency histogram bucket. The
+# percentiles are reported at the geometric middle of the bucket, so they are
+# within ~10% of the real value.
+HISTOGRAM_BASE = 1.2
+
+
 class StatisticsFramework(object):
   def __init__(
       self, root_key_id, snapshot_cls, generate_snapshot,
-      max_backtrack_days=5, max_minutes_per_process=120):
+      max_backtrack_days=5, max_minutes_per_process=120,
+      max_parallel_minutes=1, kind_prefix=''):
     """Creates an instance to do bookkeeping of statistics.
 
     Arguments:
@@ -62,6 +154,12 @@ class StatisticsFramework(object):
           when starting fresh. It will always start looking at 00:00 on the
           given day in UTC time.
     - max_minutes_per_process: Maximum number of minutes to process at a time.
+    - max_parallel_minutes: Maximum number of minutes to generate concurrently
+          when catching up on a backlog, e.g. the size of the pool of threads
+          generating them. 1 disables the catch-up mode.
+    - kind_prefix: Prefix of the kinds of the generated model classes. It must
+          be unique to the instance when an application has multiple instances,
+          since ndb maps each kind to a single model class.
 
     ndb access to self.root_key is using both local cache and memcache but
     access to stats_day_cls, stats_hour_cls and stats_minute_cls does not use
@@ -72,17 +170,26 @@ class StatisticsFramework(object):
     """
     assert isinstance(max_backtrack_days, int)
     assert isinstance(max_minutes_per_process, int)
+    assert isinstance(max_parallel_minutes, int) and max_parallel_minutes > 0
     self.snapshot_cls = snapshot_cls
     self._generate_snapshot = generate_snapshot
     self._max_backtrack_days = max_backtrack_days
     self._max_minutes_per_process = max_minutes_per_process
+    self._max_parallel_minutes = max_parallel_minutes
 
     # Generate the model classes. The factories are members so they can be
     # overriden if necessary.
     self.root_key = ndb.Key(StatsRoot, root_key_id)
-    self.stats_day_cls = _generate_stats_day_cls(self.snapshot_cls)
-    self.stats_hour_cls = _generate_stats_hour_cls(self.snapshot_cls)
-    self.stats_minute_cls = _generate_stats_minute_cls(self.snapshot_cls)
+    self.stats_month_cls = _generate_stats_month_cls(
+        self.snapshot_cls, kind_prefix)
+    self.stats_week_cls = _generate_stats_week_cls(
+        self.snapshot_cls, kind_prefix)
+    self.stats_day_cls = _generate_stats_day_cls(
+        self.snapshot_cls, kind_prefix)
+    self.stats_hour_cls = _generate_stats_hour_cls(
+        self.snapshot_cls, kind_prefix)
+    self.stats_minute_cls = _generate_stats_minute_cls(
+        self.snapshot_cls, kind_prefix)
 
   def process_next_chunk(self, up_to):
     """Processes as much minutes starting at a specific time.
@@ -103,10 +210,19 @@ class StatisticsFramework(object):
     count = 0
     original_minute = None
     try:
+      self._backfill_rollups()
       now = utils.utcnow()
       original_minute = self._get_next_minute_to_process(now)
       next_minute = original_minute
+      # First minute that wasn't generated in advance by _generate_minutes().
+      generated_up_to = next_minute
       while now - next_minute >= datetime.timedelta(minutes=up_to):
+        if next_minute >= generated_up_to:
+          # Catch up on the backlog, if any. Hours and days are still only
+          # accumulated in order by _process_one_minute().
+          generated_up_to = self._generate_minutes(
+              next_minute, now - datetime.timedelta(minutes=up_to),
+              self._max_minutes_per_process - count)
         self._process_one_minute(next_minute)
         count += 1
         self._set_last_processed_time(next_minute)
@@ -135,6 +251,29 @@ class StatisticsFramework(object):
         # At least something was processed, so it's fine.
         return count
 
+  def month_key(self, day):
+    """Returns the complete entity key for the month stats of a specific day.
+
+    Argument:
+      - day is a datetime.date instance.
+    """
+    assert day.__class__ is datetime.date
+    return ndb.Key(
+        self.stats_month_cls, '%04d-%02d' % (day.year, day.month),
+        parent=self.root_key)
+
+  def week_key(self, day):
+    """Returns the complete entity key for the week stats of a specific day.
+
+    Weeks start on Monday.
+
+    Argument:
+      - day is a datetime.date instance.
+    """
+    assert day.__class__ is datetime.date
+    monday = day - datetime.timedelta(days=day.weekday())
+    return ndb.Key(self.stats_week_cls, str(monday), parent=self.root_key)
+
   def day_key(self, day):
     """Returns the complete entity key for a specific day stats.
 
@@ -168,8 +307,140 @@ class StatisticsFramework(object):
         self.stats_minute_cls, '%02d' % minute.minute,
         parent=self.hour_key(minute))
 
+  def replay_minute(self, moment, entries):
+    """Regenerates a self.stats_minute_cls from previously exported entries.
+
+    The harvesting function is called as usual but yield_entries() and
+    yield_buffered_entries() return these entries instead. The minute is
+    overwritten; call rebuild_day() once all the minutes of the day are
+    replayed.
+
+    Arguments:
+    - moment: datetime.datetime of the minute.
+    - entries: list of StatsEntry, usually created with entry_from_dict().
+    """
+    assert moment.second == 0 and moment.microsecond == 0, moment
+    end = moment + datetime.timedelta(minutes=1)
+    _REPLAYED.entries = entries
+    try:
+      minute_values = self._generate_snapshot(
+          calendar.timegm(moment.timetuple()), calendar.timegm(end.timetuple()))
+    finally:
+      _REPLAYED.entries = None
+    minute_key = self.minute_key(moment)
+    self.stats_minute_cls(
+        key=minute_key, values_compressed=minute_values).put(
+            use_memcache=False)
+    _invalidate_sealed_cache([minute_key])
+
+  def rebuild_day(self, day):
+    """Recomputes the hours and the day from the stored minutes.
+
+    Unlike _process_one_minute(), it doesn't accumulate incrementally so it can
+    be run any number of times. The bitmaps are set according to the minutes
+    and the hours present. The hours without any minute are deleted.
+
+    Argument:
+      - day is a datetime.date instance.
+    """
+    assert day.__class__ is datetime.date
+    start = datetime.datetime(day.year, day.month, day.day)
+    day_entity = self.stats_day_cls(
+        key=self.day_key(day), values_compressed=self.snapshot_cls())
+    hours = []
+    stale_hours = []
+    for h in xrange(24):
+      moment = start + datetime.timedelta(hours=h)
+      hour = self.stats_hour_cls(
+          key=self.hour_key(moment), values_compressed=self.snapshot_cls())
+      minutes = ndb.get_multi(
+          [
+            self.minute_key(moment + datetime.timedelta(minutes=m))
+            for m in xrange(60)
+          ],
+          use_cache=False, use_memcache=False)
+      for m, minute in enumerate(minutes):
+        if minute:
+          hour.values.accumulate(minute.values)
+          hour.minutes_bitmap |= 1 << m
+      if hour.minutes_bitmap:
+        hours.append(hour)
+      else:
+        stale_hours.append(hour.key)
+      if hour.is_sealed():
+        day_entity.values.accumulate(hour.values)
+        day_entity.hours_bitmap |= 1 << h
+    ndb.put_multi(hours + [day_entity], use_memcache=False)
+    ndb.delete_multi(stale_hours, use_memcache=False)
+    _invalidate_sealed_cache(
+        [e.key for e in hours] + stale_hours + [day_entity.key])
+
+  def rebuild_rollups(self, day):
+    """Recomputes the week and the month of a day from the stored days.
+
+    Like rebuild_day(), it can be run any number of times. It must be run after
+    the rebuild_day() calls for all the days of the week and the month.
+
+    Argument:
+      - day is a datetime.date instance.
+    """
+    assert day.__class__ is datetime.date
+    monday = day - datetime.timedelta(days=day.weekday())
+    num_days = calendar.monthrange(day.year, day.month)[1]
+    entities = [
+      (
+        self.stats_week_cls(
+            key=self.week_key(day), values_compressed=self.snapshot_cls()),
+        [monday + datetime.timedelta(days=i) for i in xrange(7)],
+      ),
+      (
+        self.stats_month_cls(
+            key=self.month_key(day), values_compressed=self.snapshot_cls()),
+        [datetime.date(day.year, day.month, i + 1) for i in xrange(num_days)],
+      ),
+    ]
+    for entity, dates in entities:
+      days = ndb.get_multi(
+          [self.day_key(d) for d in dates], use_cache=False,
+          use_memcache=False)
+      for i, day_entity in enumerate(days):
+        if day_entity and day_entity.is_sealed():
+          entity.values.accumulate(day_entity.values)
+          entity.days_bitmap |= 1 << i
+    ndb.put_multi([e for e, _ in entities], use_memcache=False)
+    _invalidate_sealed_cache([e.key for e, _ in entities])
+
   ### Protected code.
 
+  def _backfill_rollups(self):
+    """Creates the weeks and the months of the days sealed before they were
+    rolled up by _rollup_day().
+
+    It runs once, the first time process_next_chunk() is called.
+    """
+    root = self.root_key.get() or StatsRoot(key=self.root_key)
+    if root.rollups_backfilled:
+      return
+    q = self.stats_day_cls.query(ancestor=self.root_key)
+    q = q.filter(
+        self.stats_day_cls.hours_bitmap == self.stats_day_cls.SEALED_BITMAP)
+    weeks = set()
+    months = set()
+    for key in q.iter(keys_only=True):
+      day = datetime.datetime.strptime(key.string_id(), '%Y-%m-%d').date()
+      week_key = self.week_key(day)
+      month_key = self.month_key(day)
+      if week_key not in weeks or month_key not in months:
+        # It rebuilds both from all the sealed days they contain.
+        self.rebuild_rollups(day)
+        weeks.add(week_key)
+        months.add(month_key)
+    logging.info(
+        '%s Backfilled %d weeks and %d months',
+        self.root_key.id(), len(weeks), len(months))
+    root.rollups_backfilled = True
+    root.put()
+
   def _set_last_processed_time(self, moment):
     """Saves the last minute processed.
 
@@ -277,6 +548,67 @@ class StatisticsFramework(object):
     logging.info('Using: %s', result)
     return result
 
+  def _generate_minutes(self, first, last, limit):
+    """Generates concurrently the self.stats_minute_cls from first to last.
+
+    Generates at most limit minutes with a pool of self._max_parallel_minutes
+    threads. The minutes are not accumulated into their hour,
+    _process_one_minute() does it in order afterward.
+
+    Returns the first minute that was not generated.
+    """
+    minutes = []
+    moment = first
+    while moment <= last and len(minutes) < limit:
+      minutes.append(moment)
+      moment += datetime.timedelta(minutes=1)
+    if self._max_parallel_minutes < 2 or len(minutes) < 2:
+      # Not worth it, _process_one_minute() will generate it.
+      return first
+
+    existing = ndb.get_multi(
+        [self.minute_key(m) for m in minutes], use_cache=False,
+        use_memcache=False)
+    # deque.popleft() is thread safe.
+    todo = collections.deque(m for m, e in zip(minutes, existing) if not e)
+    generated = {}
+    errors = []
+    def worker():
+      while not errors:
+        try:
+          minute = todo.popleft()
+        except IndexError:
+          return
+        end = minute + datetime.timedelta(minutes=1)
+        try:
+          generated[minute] = self._generate_snapshot(
+              calendar.timegm(minute.timetuple()),
+              calendar.timegm(end.timetuple()))
+        except Exception as e:
+          errors.append(e)
+
+    threads = [
+      threading.Thread(target=worker)
+      for _ in xrange(min(self._max_parallel_minutes, len(todo)))
+    ]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    # The minutes that succeeded are kept and will be used as is.
+    ndb.put_multi(
+        [
+          self.stats_minute_cls(key=self.minute_key(m), values_compressed=v)
+          for m, v in generated.iteritems()
+        ],
+        use_memcache=False)
+    if errors:
+      raise errors[0]
+    logging.info(
+        '%s Generated %d minutes starting at %s',
+        self.root_key.id(), len(generated), first)
+    return moment
+
   def _process_one_minute(self, moment):
     """Generates exactly one self.stats_minute_cls.
 
@@ -349,9 +681,43 @@ class StatisticsFramework(object):
           logging.info(
               '%s Day is sealed: %s', self.root_key.id(), day.key.id())
 
+    # Adds data for the past day back into its week and month.
+    if day.hours_bitmap == self.stats_day_cls.SEALED_BITMAP:
+      futures.extend(self._rollup_day(day))
+
     if futures:
       ndb.Future.wait_all(futures)
 
+  def _rollup_day(self, day):
+    """Accumulates a sealed self.stats_day_cls into its week and month.
+
+    Like the hours into the days, the days_bitmap of self.stats_week_cls and
+    self.stats_month_cls stay internally consistent with their values.
+
+    Returns the list of ndb.Future of the entities saved.
+    """
+    date = day.to_date()
+    opts = ndb.ContextOptions(use_memcache=False)
+    future_week = self.stats_week_cls.get_or_insert_async(
+        self.week_key(date).id(), parent=self.root_key,
+        values_compressed=self.snapshot_cls(), context_options=opts)
+    future_month = self.stats_month_cls.get_or_insert_async(
+        self.month_key(date).id(), parent=self.root_key,
+        values_compressed=self.snapshot_cls(), context_options=opts)
+    futures = []
+    for entity, day_bit in (
+        (future_week.get_result(), 1 << date.weekday()),
+        (future_month.get_result(), 1 << (date.day - 1))):
+      if not entity.days_bitmap & day_bit:
+        entity.values.accumulate(day.values)
+        entity.days_bitmap |= day_bit
+        futures.append(entity.put_async(use_memcache=False))
+        if entity.is_sealed():
+          logging.info(
+              '%s %s is sealed: %s',
+              self.root_key.id(), entity.key.kind(), entity.key.id())
+    return futures
+
 
 ### Private stuff.
 
@@ -364,9 +730,123 @@ class StatsRoot(ndb.Model):
   """
   created = ndb.DateTimeProperty(indexed=False, auto_now=True)
   timestamp = ndb.DateTimeProperty(indexed=False)
+  # Set once the weeks and months of the days sealed before the rollups were
+  # introduced were created, see StatisticsFramework._backfill_rollups().
+  rollups_backfilled = ndb.BooleanProperty(indexed=False, default=False)
+
+
+class StatsBuffer(ndb.Model):
+  """Counts of the entries buffered for one minute with the 'memcache' backend.
+
+  It is the durable copy of the memcache counters, saved the first time the
+  minute is read. The key id is the minute as an epoch.
+  """
+  created = ndb.DateTimeProperty(indexed=False, auto_now=True)
+  # {line: count} of the entries added with add_buffered_entry().
+  lines = ndb.JsonProperty(indexed=False, json_type=dict, compressed=True)
+  # {status: count} of the requests added with add_buffered_request().
+  requests = ndb.JsonProperty(indexed=False, json_type=dict)
+
 
+def _generate_stats_month_cls(snapshot_cls, kind_prefix=''):
+  class StatsMonth(ndb.Model):
+    """Statistics for a whole month.
 
-def _generate_stats_day_cls(snapshot_cls):
+    The Key format is YYYY-MM with 0 prefixes so the key sort naturally.
+    Ancestor is StatsRoot.
+
+    This entity is updated every time a new self.stats_day_cls is sealed, so ~1
+    update per day.
+    """
+    created = ndb.DateTimeProperty(indexed=False, auto_now=True)
+    modified = ndb.DateTimeProperty(indexed=False, auto_now_add=True)
+
+    # Statistics for the month.
+    values_compressed = ndb.LocalStructuredProperty(
+        snapshot_cls, compressed=True, name='values_c')
+
+    # Days that have been summed, the first day of the month being the bit 0.
+    days_bitmap = ndb.IntegerProperty(indexed=False, default=0)
+
+    @classmethod
+    def _get_kind(cls):
+      return kind_prefix + 'StatsMonth'
+
+    @property
+    def values(self):
+      return self.values_compressed
+
+    def is_sealed(self):
+      date = self.to_date()
+      num_days = calendar.monthrange(date.year, date.month)[1]
+      return self.days_bitmap == (1 << num_days) - 1
+
+    def get_timestamp(self):
+      return self.to_date()
+
+    def to_dict(self):
+      out = self.values.to_dict()
+      out['key'] = self.get_timestamp()
+      return out
+
+    def to_date(self):
+      """Returns the datetime.date of the first day of this month."""
+      year, month = self.key.id().split('-', 1)
+      return datetime.date(int(year), int(month), 1)
+
+  return StatsMonth
+
+
+def _generate_stats_week_cls(snapshot_cls, kind_prefix=''):
+  class StatsWeek(ndb.Model):
+    """Statistics for a whole week, starting on Monday.
+
+    The Key format is YYYY-MM-DD of the Monday with 0 prefixes so the key sort
+    naturally. Ancestor is StatsRoot.
+
+    This entity is updated every time a new self.stats_day_cls is sealed, so ~1
+    update per day.
+    """
+    created = ndb.DateTimeProperty(indexed=False, auto_now=True)
+    modified = ndb.DateTimeProperty(indexed=False, auto_now_add=True)
+
+    # Statistics for the week.
+    values_compressed = ndb.LocalStructuredProperty(
+        snapshot_cls, compressed=True, name='values_c')
+
+    # Days that have been summed, Monday being the bit 0.
+    days_bitmap = ndb.IntegerProperty(indexed=False, default=0)
+
+    SEALED_BITMAP = 0x7F
+
+    @classmethod
+    def _get_kind(cls):
+      return kind_prefix + 'StatsWeek'
+
+    @property
+    def values(self):
+      return self.values_compressed
+
+    def is_sealed(self):
+      return self.days_bitmap == self.SEALED_BITMAP
+
+    def get_timestamp(self):
+      return self.to_date()
+
+    def to_dict(self):
+      out = self.values.to_dict()
+      out['key'] = self.get_timestamp()
+      return out
+
+    def to_date(self):
+      """Returns the datetime.date of the Monday of this week."""
+      year, month, day = self.key.id().split('-', 2)
+      return datetime.date(int(year), int(month), int(day))
+
+  return StatsWeek
+
+
+def _generate_stats_day_cls(snapshot_cls, kind_prefix=''):
   class StatsDay(ndb.Model):
     """Statistics for the whole day.
 
@@ -393,10 +873,17 @@ def _generate_stats_day_cls(snapshot_cls):
     # Used for queries.
     SEALED_BITMAP = 0xFFFFFF
 
+    @classmethod
+    def _get_kind(cls):
+      return kind_prefix + 'StatsDay'
+
     @property
     def values(self):
       return self.values_compressed or self.values_uncompressed
 
+    def is_sealed(self):
+      return self.hours_bitmap == self.SEALED_BITMAP
+
     def get_timestamp(self):
       return self.to_date()
 
@@ -417,7 +904,7 @@ def _generate_stats_day_cls(snapshot_cls):
   return StatsDay
 
 
-def _generate_stats_hour_cls(snapshot_cls):
+def _generate_stats_hour_cls(snapshot_cls, kind_prefix=''):
   class StatsHour(ndb.Model):
     """Statistics for a single hour.
 
@@ -442,10 +929,17 @@ def _generate_stats_hour_cls(snapshot_cls):
     # Used for queries.
     SEALED_BITMAP = 0xFFFFFFFFFFFFFFF
 
+    @classmethod
+    def _get_kind(cls):
+      return kind_prefix + 'StatsHour'
+
     @property
     def values(self):
       return self.values_compressed or self.values_uncompressed
 
+    def is_sealed(self):
+      return self.minutes_bitmap == self.SEALED_BITMAP
+
     def get_timestamp(self):
       return self.to_datetime()
 
@@ -468,7 +962,7 @@ def _generate_stats_hour_cls(snapshot_cls):
   return StatsHour
 
 
-def _generate_stats_minute_cls(snapshot_cls):
+def _generate_stats_minute_cls(snapshot_cls, kind_prefix=''):
   class StatsMinute(ndb.Model):
     """Statistics for a single minute.
 
@@ -486,10 +980,18 @@ def _generate_stats_minute_cls(snapshot_cls):
     values_uncompressed = ndb.LocalStructuredProperty(
         snapshot_cls, name='values')
 
+    @classmethod
+    def _get_kind(cls):
+      return kind_prefix + 'StatsMinute'
+
     @property
     def values(self):
       return self.values_compressed or self.values_uncompressed
 
+    def is_sealed(self):
+      # pylint: disable=R0201
+      return True
+
     def get_timestamp(self):
       return self.to_datetime()
 
@@ -543,27 +1045,196 @@ def _yield_logs(start_time, end_time):
     yield request
 
 
-def _get_snapshot_as_dict_future(keys):
-  """Gets post-processed entities referenced by keys.
+def _get_buffer_shard_key(minute, shard):
+  """Returns the memcache key of the counters of a buffer shard."""
+  return '%d/%d' % (minute, shard)
 
-  Returns:
-    list of ndb.Future returning the to_dict() value (instead of the entity
-    itself) of the entities present or None if the entity doesn't exist.
+
+def _get_buffer_flushes_key(minute):
+  """Returns the memcache key of the number of flushes done for a minute."""
+  return '%d/flushes' % minute
+
+
+def _merge_counts(lhs, rhs):
+  """Adds the counts of the dict rhs into the dict lhs."""
+  for k, v in rhs.iteritems():
+    lhs[k] = lhs.get(k, 0) + v
+
+
+def _add_to_buffer(kind, item):
+  """Counts an item in the in-process buffer of the current minute."""
+  global _buffer_oldest
+  now = utils.time_time()
+  minute = int(now) / 60 * 60
+  with _BUFFER_LOCK:
+    counts = _BUFFER.setdefault(minute, {'lines': {}, 'requests': {}})[kind]
+    counts[item] = counts.get(item, 0) + 1
+    if _buffer_oldest is None:
+      _buffer_oldest = now
+  flush_buffered_entries()
+
+
+def _flush_minute(minute, counts):
+  """Merges the counts buffered in-process for a minute into one of its memcache
+  shards.
+
+  The shard is updated with compare-and-set. Returns True on success.
   """
-  def _fix_future(future, out):
-    """Converts a ndb.Future to a StatisticsFramework entity into a dict of the
-    snapshot.
-    """
-    result = future.get_result()
-    out.set_result(result.to_dict() if result else None)
+  client = memcache.Client()
+  for _ in xrange(_BUFFER_CAS_ATTEMPTS):
+    key = _get_buffer_shard_key(minute, random.randint(0, BUFFER_SHARDS-1))
+    shard = client.gets(key, namespace=_BUFFER_NAMESPACE)
+    if shard is None:
+      shard = {'flushes': 1, 'lines': counts['lines'],
+               'requests': counts['requests']}
+      stored = client.add(
+          key, shard, time=_BUFFER_EXPIRATION, namespace=_BUFFER_NAMESPACE)
+    else:
+      shard['flushes'] += 1
+      _merge_counts(shard['lines'], counts['lines'])
+      _merge_counts(shard['requests'], counts['requests'])
+      stored = client.cas(
+          key, shard, time=_BUFFER_EXPIRATION, namespace=_BUFFER_NAMESPACE)
+    if stored:
+      # Used by _get_buffered_minute() to detect evicted shards.
+      memcache.incr(
+          _get_buffer_flushes_key(minute), initial_value=0,
+          namespace=_BUFFER_NAMESPACE)
+      return True
+  return False
+
+
+def _get_buffered_minute(minute):
+  """Returns the StatsBuffer of a minute.
+
+  The first time, the memcache shards of the minute are merged and saved to the
+  datastore, so the counts survive the memcache eviction afterward.
+  """
+  key = ndb.Key(StatsBuffer, str(minute))
+  entity = key.get(use_cache=False, use_memcache=False)
+  if entity:
+    return entity
+  flushes_key = _get_buffer_flushes_key(minute)
+  shards = memcache.get_multi(
+      [_get_buffer_shard_key(minute, i) for i in xrange(BUFFER_SHARDS)] +
+      [flushes_key],
+      namespace=_BUFFER_NAMESPACE)
+  expected = int(shards.pop(flushes_key, 0))
+  entity = StatsBuffer(key=key, lines={}, requests={})
+  flushes = 0
+  for shard in shards.itervalues():
+    flushes += shard['flushes']
+    _merge_counts(entity.lines, shard['lines'])
+    _merge_counts(
+        entity.requests,
+        dict((str(k), v) for k, v in shard['requests'].iteritems()))
+  if flushes != expected:
+    logging.error(
+        'Lost %d of %d flushes of buffered stats entries at %d',
+        expected - flushes, expected, minute)
+  entity.put(use_memcache=False)
+  return entity
+
+
+def _get_replayed_entries(start_time, end_time):
+  """Returns the StatsEntry replayed by this thread in this time interval.
+
+  Returns None when not replaying.
+  """
+  entries = getattr(_REPLAYED, 'entries', None)
+  if entries is None:
+    return None
+  return [
+    e for e in entries
+    if (not start_time or e.request.end_time >= start_time) and
+       (not end_time or e.request.end_time < end_time)
+  ]
+
 
-  tmp = ndb.get_multi_async(keys, use_cache=False, use_memcache=False)
-  out = [ndb.Future() for _ in xrange(len(tmp))]
-  for i, f in enumerate(tmp):
-    f.add_immediate_callback(_fix_future, f, out[i])
+def _invalidate_sealed_cache(keys):
+  """Removes entities modified out of band from the caches.
+
+  Other instances may keep the stale values in their in-process cache until
+  they are restarted.
+  """
+  cache_keys = [
+    prefix + key.urlsafe() for key in keys for prefix in ('dict/', 'entity/')
+  ]
+  with _SEALED_CACHE_LOCK:
+    for k in cache_keys:
+      _SEALED_CACHE.pop(k, None)
+  memcache.delete_multi(
+      cache_keys, namespace=os.environ['CURRENT_VERSION_ID'])
+
+
+def _get_multi_sealed_cached(keys, as_dict):
+  """Gets the entities referenced by keys, or their to_dict() value.
+
+  Sealed entities never change so they are cached indefinitely, both in-process
+  and in memcache. Only the entities still open are fetched from the datastore.
+  The memcache namespace is the version since to_dict() depends on the code.
+
+  Returns:
+    list of the entities or of their to_dict() value when as_dict is True, None
+    when the entity doesn't exist.
+  """
+  prefix = 'dict/' if as_dict else 'entity/'
+  cache_keys = [prefix + key.urlsafe() for key in keys]
+  namespace = os.environ['CURRENT_VERSION_ID']
+  results = {}
+  with _SEALED_CACHE_LOCK:
+    for k in cache_keys:
+      value = _SEALED_CACHE.pop(k, None)
+      if value is not None:
+        # Mark it as the most recently used.
+        _SEALED_CACHE[k] = value
+        results[k] = value
+  missing = [k for k in cache_keys if k not in results]
+  from_memcache = {}
+  if missing:
+    from_memcache = memcache.get_multi(missing, namespace=namespace)
+    results.update(from_memcache)
+
+  to_fetch = [key for key, k in zip(keys, cache_keys) if k not in results]
+  to_cache = {}
+  entities = ndb.get_multi(to_fetch, use_cache=False, use_memcache=False)
+  for key, entity in zip(to_fetch, entities):
+    value = entity.to_dict() if entity and as_dict else entity
+    results[prefix + key.urlsafe()] = value
+    if entity and entity.is_sealed():
+      to_cache[prefix + key.urlsafe()] = value
+  if to_cache:
+    memcache.set_multi(to_cache, namespace=namespace)
+
+  with _SEALED_CACHE_LOCK:
+    for k, value in from_memcache.items() + to_cache.items():
+      _SEALED_CACHE.pop(k, None)
+      _SEALED_CACHE[k] = value
+    while len(_SEALED_CACHE) > _SEALED_CACHE_MAX_ITEMS:
+      _SEALED_CACHE.popitem(last=False)
+  return [results[k] for k in cache_keys]
+
+
+def _get_months_keys(handler, now, num_months):
+  """Returns a list of ndb.Key to Snapshot instances."""
+  today = (now or utils.utcnow()).date()
+  out = []
+  year, month = today.year, today.month
+  for _ in xrange(num_months):
+    out.append(handler.month_key(datetime.date(year, month, 1)))
+    year, month = (year, month - 1) if month > 1 else (year - 1, 12)
   return out
 
 
+def _get_weeks_keys(handler, now, num_weeks):
+  """Returns a list of ndb.Key to Snapshot instances."""
+  today = (now or utils.utcnow()).date()
+  return [
+    handler.week_key(today - datetime.timedelta(days=7*i))
+    for i in xrange(num_weeks)
+  ]
+
+
 def _get_days_keys(handler, now, num_days):
   """Returns a list of ndb.Key to Snapshot instances."""
   today = (now or utils.utcnow()).date()
@@ -602,6 +1273,75 @@ def add_entry(message):
   logging.debug(PREFIX + message)
 
 
+def add_buffered_entry(message):
+  """Counts an entry in the buffer of the current minute.
+
+  The entry is still added with add_entry() so switching back to the 'logs'
+  backend doesn't lose anything.
+  """
+  add_entry(message)
+  _add_to_buffer('lines', message)
+
+
+def add_buffered_request(status):
+  """Counts a HTTP request in the buffer of the current minute.
+
+  It is yielded back by yield_buffered_entries() as a StatsEntry without
+  entries, so the requests can be counted like with the 'logs' backend.
+  """
+  _add_to_buffer('requests', status)
+
+
+def flush_buffered_entries(force=False):
+  """Merges the entries buffered in-process into the memcache counters.
+
+  Unless force is True, it is only done once the oldest entry is
+  BUFFER_FLUSH_SECS old or once its minute is over.
+  """
+  global _buffer_oldest
+  now = utils.time_time()
+  current = int(now) / 60 * 60
+  with _BUFFER_LOCK:
+    if not _BUFFER:
+      return
+    if (not force and now - _buffer_oldest < BUFFER_FLUSH_SECS and
+        _BUFFER.keys() == [current]):
+      return
+    pending = _BUFFER.copy()
+    _BUFFER.clear()
+    _buffer_oldest = None
+  for minute, counts in sorted(pending.iteritems()):
+    if current - minute > TOO_RECENT_BUFFERED * 60:
+      logging.warning(
+          'Flushing stats entries buffered at %d late, they may be ignored',
+          minute)
+    if not _flush_minute(minute, counts):
+      logging.error(
+          'Failed to flush %d stats entries and %d requests buffered at %d',
+          sum(counts['lines'].itervalues()),
+          sum(counts['requests'].itervalues()), minute)
+
+
+def buffered_requests_wsgi_middleware(app, is_buffered):
+  """Returns a WSGI application counting the requests of app.
+
+  The requests are counted with add_buffered_request() when is_buffered()
+  returns True, then the buffered entries are flushed if due.
+  """
+  def wrapped(environ, start_response):
+    if not is_buffered():
+      return app(environ, start_response)
+    statuses = []
+    def start_response_wrapper(status, headers, exc_info=None):
+      statuses.append(int(status.split(' ', 1)[0]))
+      return start_response(status, headers, exc_info)
+    try:
+      return app(environ, start_response_wrapper)
+    finally:
+      add_buffered_request(statuses[-1] if statuses else 500)
+  return wrapped
+
+
 def accumulate(lhs, rhs, skip):
   """Adds the values from rhs into lhs.
 
@@ -658,14 +1398,67 @@ def accumulate(lhs, rhs, skip):
           logging.error('Couldn\'t set %s to %s', key, value)
 
 
-def yield_entries(start_time, end_time):
+def histogram_add(histogram, value_ms):
+  """Adds a value in ms to a latency histogram.
+
+  A histogram is a list of counts, the item i counting the values in
+  [HISTOGRAM_BASE**i, HISTOGRAM_BASE**(i+1)[ ms. The first item also counts the
+  values below 1ms. Trailing empty buckets are not stored. It is meant to be
+  saved as a repeated ndb.IntegerProperty.
+  """
+  index = 0
+  if value_ms >= 1:
+    index = int(math.log(value_ms) / math.log(HISTOGRAM_BASE))
+  if len(histogram) <= index:
+    histogram.extend([0] * (index + 1 - len(histogram)))
+  histogram[index] += 1
+
+
+def histogram_merge(lhs, rhs):
+  """Returns the sum of two latency histograms.
+
+  accumulate() can't handle repeated properties so it must be used instead.
+  """
+  if len(lhs) < len(rhs):
+    lhs, rhs = rhs, lhs
+  out = list(lhs)
+  for i, count in enumerate(rhs):
+    out[i] += count
+  return out
+
+
+def histogram_percentile(histogram, percentile):
+  """Returns the approximate percentile of a latency histogram in seconds."""
+  total = sum(histogram)
+  if not total:
+    return 0.
+  threshold = total * percentile / 100.
+  seen = 0
+  for index, count in enumerate(histogram):
+    seen += count
+    if seen >= threshold:
+      break
+  return round(HISTOGRAM_BASE ** (index + 0.5) * 0.001, 3)
+
+
+def yield_entries(start_time, end_time, prefix=PREFIX):
   """Yields StatsEntry in this time interval.
 
   Look at requests that *ended* between [start_time, end_time[. Ignore the start
   time of the request. This is because the parameters start_time and end_time of
   logserver.fetch() filters on the completion time of the request.
+
+  Only the log lines starting with prefix are returned. The replayed entries are
+  only returned for the default prefix.
   """
-  offset = len(PREFIX)
+  replayed = _get_replayed_entries(start_time, end_time)
+  if replayed is not None:
+    if prefix == PREFIX:
+      for entry in replayed:
+        yield entry
+    return
+
+  offset = len(prefix)
   for request in _yield_logs(start_time, end_time):
     if not request.finished or not request.end_time:
       continue
@@ -677,31 +1470,99 @@ def yield_entries(start_time, end_time):
     # Gathers all the entries added via add_entry().
     entries = [
       l.message[offset:] for l in request.app_logs
-      if l.level <= logservice.LOG_LEVEL_INFO and l.message.startswith(PREFIX)
+      if l.level <= logservice.LOG_LEVEL_INFO and l.message.startswith(prefix)
     ]
     yield StatsEntry(request, entries)
 
 
-def get_stats(handler, resolution, now, num_items, as_dict):
+def yield_buffered_entries(start_time, end_time):
+  """Yields StatsEntry added via add_buffered_entry() and add_buffered_request()
+  in this time interval.
+
+  start_time and end_time are epochs aligned on the minute. Per minute, one
+  StatsEntry without entries is yielded for each request, then one StatsEntry
+  holding all the entries; its request is None since the entries are not
+  associated to a HTTP request. An entry added multiple times is repeated.
+  """
+  replayed = _get_replayed_entries(start_time, end_time)
+  if replayed is not None:
+    for entry in replayed:
+      yield entry
+    return
+
+  assert not start_time % 60 and not end_time % 60, (start_time, end_time)
+  for minute in xrange(start_time, end_time, 60):
+    entity = _get_buffered_minute(minute)
+    for status, count in sorted(entity.requests.iteritems()):
+      request = ReplayedRequest(int(status), minute)
+      for _ in xrange(count):
+        yield StatsEntry(request, [])
+    if entity.lines:
+      yield StatsEntry(
+          None,
+          [
+            line for line, count in sorted(entity.lines.iteritems())
+            for _ in xrange(count)
+          ])
+
+
+def entry_to_dict(entry):
+  """Returns a StatsEntry as a json serializable dict, for exporting."""
+  return {
+    'end_time': entry.request.end_time,
+    'entries': entry.entries,
+    'status': entry.request.status,
+  }
+
+
+def entry_from_dict(data):
+  """Returns a StatsEntry from a dict created by entry_to_dict()."""
+  return StatsEntry(
+      ReplayedRequest(data['status'], data['end_time']), data['entries'])
+
+
+def get_stats(handler, resolution, now, num_items, as_dict, timespan=None):
   """Wrapper calls that returns items for the specified resolution.
 
   Arguments:
   - handler: Instance of StatisticsFramework.
-  - resolution: One of 'days', 'hours' or 'minutes'
+  - resolution: One of RESOLUTIONS or 'auto'. 'auto' uses pick_resolution() to
+        load the items covering 'timespan' in at most 'num_items'.
   - now: datetime.datetime or None.
   - num_items: Maximum number of items to return ending at 'now'.
   - as_dict: When True, preprocess the entities to convert them to_dict(). If
         False, returns the raw objects that needs to be handled manually.
+  - timespan: datetime.timedelta to cover, only used with 'auto'.
   """
+  if resolution == 'auto':
+    resolution = pick_resolution(timespan, num_items)
+    num_items = min(
+        num_items,
+        int(math.ceil(
+            timespan.total_seconds() /
+            _RESOLUTION_SPAN[resolution].total_seconds())))
   mapping = {
+    'months': _get_months_keys,
+    'weeks': _get_weeks_keys,
     'days': _get_days_keys,
     'hours': _get_hours_keys,
     'minutes': _get_minutes_keys,
   }
   keys = mapping[resolution](handler, now, num_items)
-  if as_dict:
-    return [
-      i.get_result() for i in _get_snapshot_as_dict_future(keys)
-      if i.get_result()
-    ]
-  return [i for i in ndb.get_multi(keys) if i]
+  return [i for i in _get_multi_sealed_cached(keys, as_dict) if i]
+
+
+def pick_resolution(timespan, max_items):
+  """Returns the finest resolution covering timespan in at most max_items.
+
+  The coarsest resolution, 'months', is returned if none fits. It permits long
+  range graphs to load only a handful of entities.
+
+  Arguments:
+  - timespan: datetime.timedelta to cover.
+  - max_items: maximum number of entities to load.
+  """
+  for resolution in reversed(RESOLUTIONS):
+    if timespan <= _RESOLUTION_SPAN[resolution] * max_items:
+      return resolution
+  return RESOLUTIONS[0]
@@ -4,13 +4,57 @@
 
 """GViz connector code for stats_framework.py."""
 
+import datetime
 import logging
+import os
+
+from google.appengine.api import memcache
 
 from components import stats_framework
 from components import utils
 from gviz import gviz_api
 
 
+# Maximum number of points that can be requested with the 'points' parameter.
+MAX_POINTS = 1000
+
+# Maximum number of seconds that can be requested with the 'timespan' parameter
+# when the resolution is 'auto'; 10 years.
+MAX_TIMESPAN = 10*366*24*60*60
+
+# The latest entity returned is usually not sealed yet, so the cached columnar
+# responses must expire quickly.
+_COLUMNAR_EXPIRATION = 60
+
+
+### Private stuff.
+
+
+def _downsample_rows(table, description, points):
+  """Yields tuple(avg, min, max) dicts, each summarizing consecutive rows.
+
+  At most 'points' tuples are yielded. The 'number' columns are aggregated; the
+  other ones, like 'key', use the value of the first row. Only the avg dict is
+  filled when there are few enough rows.
+  """
+  step = max(1, (len(table) + points - 1) / points) if points else 1
+  numbers = [k for k, v in description.iteritems() if v[0] == 'number']
+  for i in xrange(0, len(table), step):
+    rows = table[i:i+step]
+    avg = dict(rows[0])
+    if step == 1:
+      yield avg, None, None
+      continue
+    low = {}
+    high = {}
+    for column in numbers:
+      values = [r.get(column) or 0 for r in rows]
+      avg[column] = float(sum(values)) / len(values)
+      low[column] = min(values)
+      high[column] = max(values)
+    yield avg, low, high
+
+
 ### Public API.
 
 
@@ -38,7 +82,11 @@ def process_tqx(tqx):
 
 def get_description_key(resolution):
   """Returns GVIZ description key for the specific resolution."""
-  if resolution == 'days':
+  if resolution == 'months':
+    return {'key': ('date', 'Month')}
+  elif resolution == 'weeks':
+    return {'key': ('date', 'Week')}
+  elif resolution == 'days':
     # It permits Google Viz to properly list days instead of midnight every day.
     return {'key': ('date', 'Day')}
   elif resolution in ('hours', 'minutes'):
@@ -46,6 +94,75 @@ def get_description_key(resolution):
   raise ValueError('Unexpected resolution')
 
 
+def downsample(table, description, points):
+  """Returns at most 'points' rows, each the average of consecutive rows.
+
+  Returns the rows as-is when points is 0.
+  """
+  return [a for a, _, _ in _downsample_rows(list(table), description, points)]
+
+
+def to_columnar(table, description, order, points):
+  """Returns the table as a dict of columns, downsampled to 'points' rows.
+
+  It is much more compact than the gviz rows since the column names are not
+  repeated for each row. When rows are merged, the 'min' and 'max' lists are
+  added to each 'number' column, the 'values' list being the averages.
+  """
+  rows = list(_downsample_rows(list(table), description, points))
+  columns = []
+  for column in order:
+    kind, label = description[column]
+    item = {
+      'id': column,
+      'label': label,
+      'type': kind,
+      'values': [a.get(column) for a, _, _ in rows],
+    }
+    if kind == 'number' and rows and rows[0][1] is not None:
+      item['min'] = [l.get(column) for _, l, _ in rows]
+      item['max'] = [h.get(column) for _, _, h in rows]
+    columns.append(item)
+  return {'columns': columns, 'rows': len(rows)}
+
+
+def get_points(request):
+  """Returns the 'points' request parameter, 0 meaning no downsampling."""
+  return utils.get_request_as_int(request, 'points', 0, 0, MAX_POINTS)
+
+
+def get_cache_key(resolution, now, duration, points, filters=''):
+  """Returns the memcache key of a columnar response."""
+  return 'gviz/%s/%s/%d/%d/%s' % (
+      resolution, now.isoformat() if now else '', duration, points, filters)
+
+
+def get_columnar_json(response, get_table, description, order, cache_key,
+                      points):
+  """Writes the statistic data as compact columnar JSON, see to_columnar().
+
+  The encoded response is cached in memcache so get_table() is only called on
+  cache miss.
+
+  Arguments:
+  - response: A webapp2.Response.
+  - get_table: Function returning the rows as dicts.
+  - description: Dict describing the columns.
+  - order: List describing the order to use for the columns.
+  - cache_key: Key returned by get_cache_key().
+  - points: Maximum number of rows to return.
+  """
+  namespace = os.environ['CURRENT_VERSION_ID']
+  data = memcache.get(cache_key, namespace=namespace)
+  if data is None:
+    data = utils.encode_to_json(
+        to_columnar(get_table(), description, order, points))
+    memcache.set(
+        cache_key, data, time=_COLUMNAR_EXPIRATION, namespace=namespace)
+  response.headers['Content-Type'] = 'application/json; charset=utf-8'
+  response.write(data)
+
+
 def get_json(request, response, handler, resolution, description, order):
   """Returns the statistic data as a Google Visualization compatible reply.
 
@@ -64,18 +181,43 @@ def get_json(request, response, handler, resolution, description, order):
   - request: A webapp2.Request.
   - response: A webapp2.Response.
   - handler: A StatisticsFramework.
-  - resolution: One of 'days', 'hours' or 'minutes'.
+  - resolution: One of stats_framework.RESOLUTIONS or 'auto'.
   - description: Dict describing the columns.
   - order: List describing the order to use for the columns.
 
+  The request parameter 'points' downsamples the data and 'format=columnar'
+  returns the data as to_columnar() instead. With 'auto', the request parameter
+  'timespan' is the number of seconds to cover and 'duration' the maximum
+  number of items to load; the key column of description is set to match the
+  resolution picked.
+
   Raises:
     ValueError if a 400 should be returned.
   """
-  tqx_args = process_tqx(request.params.get('tqx', ''))
   duration = utils.get_request_as_int(request, 'duration', 120, 1, 256)
   now = utils.get_request_as_datetime(request, 'now')
+  points = get_points(request)
+  timespan = None
+  cache_resolution = resolution
+  if resolution == 'auto':
+    timespan = datetime.timedelta(
+        seconds=utils.get_request_as_int(
+            request, 'timespan', 86400, 60, MAX_TIMESPAN))
+    description = description.copy()
+    description.update(
+        get_description_key(
+            stats_framework.pick_resolution(timespan, duration)))
+    cache_resolution = 'auto/%d' % timespan.total_seconds()
+  get_table = lambda: stats_framework.get_stats(
+      handler, resolution, now, duration, True, timespan)
 
-  table = stats_framework.get_stats(handler, resolution, now, duration, True)
+  if request.params.get('format') == 'columnar':
+    return get_columnar_json(
+        response, get_table, description, order,
+        get_cache_key(cache_resolution, now, duration, points), points)
+
+  tqx_args = process_tqx(request.params.get('tqx', ''))
+  table = downsample(get_table(), description, points)
   return get_json_raw(request, response, table, description, order, tqx_args)
 
 
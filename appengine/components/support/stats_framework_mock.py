@@ -59,6 +59,7 @@ def configure(test):
       yield request
 
   test.mock(stats_framework, 'add_entry', _add_entry)
+  test.mock(stats_framework, '_SEALED_CACHE', {})
   test.mock(stats_framework, '_yield_logs', _yield_logs)
   _old_request = test.mock(webtest.TestApp, 'do_request', _do_request)
 
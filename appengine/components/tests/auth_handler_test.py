@@ -6,7 +6,10 @@
 # Disable 'Unused variable', 'Unused argument' and 'Method could be a function'.
 # pylint: disable=W0612,W0613,R0201
 
+import StringIO
 import datetime
+import gzip
+import json
 import os
 import sys
 import unittest
@@ -403,6 +406,69 @@ class AuthenticatingHandlerTest(test_case.TestCase):
     self.assertEqual('<none>', call({'X-Host-Token-V1': token}))
 
 
+class ApiHandlerTest(test_case.TestCase):
+  """Tests for ApiHandler class."""
+
+  def setUp(self):
+    super(ApiHandlerTest, self).setUp()
+    handler.configure([])
+    api.reset_local_state()
+
+  def make_test_app(self):
+    class Handler(handler.ApiHandler):
+      xsrf_token_enforce_on = ()
+
+      @api.public
+      def post(self):
+        self.send_response(self.parse_body())
+
+    return webtest.TestApp(
+        webapp2.WSGIApplication([('/request', Handler)], debug=True),
+        extra_environ={'REMOTE_ADDR': '127.0.0.1'})
+
+  def test_parse_body(self):
+    response = self.make_test_app().post(
+        '/request', json.dumps({'a': 1}),
+        headers={'Content-Type': 'application/json; charset=utf-8'})
+    self.assertEqual({'a': 1}, response.json)
+
+  def test_parse_body_gzip(self):
+    out = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+      f.write(json.dumps({'a': 1}))
+    response = self.make_test_app().post(
+        '/request', out.getvalue(),
+        headers={
+          'Content-Encoding': 'gzip',
+          'Content-Type': 'application/json; charset=utf-8',
+        })
+    self.assertEqual({'a': 1}, response.json)
+
+  def test_parse_body_gzip_invalid(self):
+    response = self.make_test_app().post(
+        '/request', 'not gzip',
+        headers={
+          'Content-Encoding': 'gzip',
+          'Content-Type': 'application/json; charset=utf-8',
+        },
+        expect_errors=True)
+    self.assertEqual(400, response.status_int)
+
+  def test_parse_body_gzip_too_large(self):
+    self.mock(handler.ApiHandler, 'MAX_DECOMPRESSED_BODY_SIZE', 16)
+    out = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+      f.write(json.dumps({'a': 'b' * 1024}))
+    response = self.make_test_app().post(
+        '/request', out.getvalue(),
+        headers={
+          'Content-Encoding': 'gzip',
+          'Content-Type': 'application/json; charset=utf-8',
+        },
+        expect_errors=True)
+    self.assertEqual(413, response.status_int)
+
+
 class CookieAuthenticationTest(test_case.TestCase):
   """Tests for cookie_authentication function."""
 
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# Copyright 2014 The Swarming Authors. All rights reserved.
+# Use of this source code is governed by the Apache v2.0 license that can be
+# found in the LICENSE file.
+
+import json
+import logging
+import sys
+import unittest
+
+import test_env
+test_env.setup_test_env()
+
+from google.appengine.api import memcache
+
+from components import profiling
+from support import test_case
+
+
+class ProfilingTest(test_case.TestCase):
+  def setUp(self):
+    super(ProfilingTest, self).setUp()
+    self.mock(profiling, 'PROFILE_SAMPLE_RATE', 1.)
+    self.logs = []
+    self.mock(
+        logging, 'debug', lambda msg, *args: self.logs.append(msg % args))
+    self.mock(
+        logging, 'info', lambda msg, *args: self.logs.append(msg % args))
+
+  def test_start_stop(self):
+    profile = profiling.start('/foo')
+    memcache.get('a')
+    memcache.get('b')
+    memcache.set('a', 'b')
+    profiling.stop(profile)
+    # Not profiled anymore.
+    memcache.get('c')
+
+    self.assertEqual(1, len(self.logs))
+    self.assertTrue(self.logs[0].startswith(profiling.PREFIX))
+    data = json.loads(self.logs[0][len(profiling.PREFIX):])
+    self.assertEqual('/foo', data['r'])
+    self.assertEqual(
+        {'memcache.Get': 2, 'memcache.Set': 1},
+        dict((k, v[0]) for k, v in data['rpc'].iteritems()))
+
+  def test_stop_trace(self):
+    profile = profiling.start('/foo')
+    memcache.get('a')
+    profiling.stop(profile, trace=True)
+    self.assertEqual(2, len(self.logs))
+    self.assertTrue(self.logs[1].startswith('Trace of /foo:\n'))
+    self.assertIn('memcache.Get', self.logs[1])
+
+  def test_start_not_sampled(self):
+    self.mock(profiling, 'PROFILE_SAMPLE_RATE', 0.)
+    profile = profiling.start('/foo')
+    self.assertEqual(None, profile)
+    memcache.get('a')
+    profiling.stop(profile)
+    self.assertEqual([], self.logs)
+
+    # A trace request is always profiled.
+    profile = profiling.start('/foo', force=True)
+    memcache.get('a')
+    profiling.stop(profile, trace=True)
+    self.assertEqual(2, len(self.logs))
+
+  def test_snapshot(self):
+    values = profiling._Snapshot()
+    profiling._parse_line(
+        '{"c":2,"r":"/foo","rpc":{"datastore_v3.Get":[2,10]},"w":20}', values)
+    profiling._parse_line(
+        '{"c":3,"r":"/bar","rpc":{},"w":2000}', values)
+    other = profiling._Snapshot()
+    profiling._parse_line(
+        '{"c":2,"r":"/foo","rpc":{"datastore_v3.Get":[1,5],'
+        '"memcache.Get":[1,1]},"w":30}',
+        other)
+    values.accumulate(other)
+
+    actual = values.to_dict()
+    self.assertEqual(['/bar', '/foo'], [i['route'] for i in actual['routes']])
+    foo = actual['routes'][1]
+    self.assertEqual(2, foo['requests'])
+    self.assertEqual(
+        {
+          'datastore_v3.Get': {'calls': 3, 'total_ms': 15},
+          'memcache.Get': {'calls': 1, 'total_ms': 1},
+        },
+        foo['rpcs'])
+    self.assertTrue(0.018 <= foo['wall_secs_p50'] <= 0.033)
+    self.assertTrue(1.8 <= actual['routes'][0]['wall_secs_p99'] <= 2.2)
+
+
+if __name__ == '__main__':
+  if '-v' in sys.argv:
+    unittest.TestCase.maxDiff = None
+  logging.basicConfig(
+      level=logging.DEBUG if '-v' in sys.argv else logging.ERROR)
+  unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Copyright 2014 The Swarming Authors. All rights reserved.
+# Use of this source code is governed by the Apache v2.0 license that can be
+# found in the LICENSE file.
+
+import datetime
+import json
+import sys
+import unittest
+
+import test_env
+test_env.setup_test_env()
+
+import webapp2
+
+from components import stats_framework_gviz
+from support import test_case
+
+
+DESCRIPTION = {
+  'key': ('datetime', 'Time'),
+  'requests': ('number', 'Total'),
+}
+
+ORDER = ('key', 'requests')
+
+
+def get_table():
+  start = datetime.datetime(2010, 1, 2, 3, 4)
+  return [
+    {'key': start + datetime.timedelta(minutes=i), 'requests': i}
+    for i in xrange(5)
+  ]
+
+
+class StatsFrameworkGvizTest(test_case.TestCase):
+  def test_downsample(self):
+    table = get_table()
+    self.assertEqual(
+        table, stats_framework_gviz.downsample(table, DESCRIPTION, 0))
+    self.assertEqual(
+        table, stats_framework_gviz.downsample(table, DESCRIPTION, 10))
+    expected = [
+      {'key': table[0]['key'], 'requests': 1.},
+      {'key': table[3]['key'], 'requests': 3.5},
+    ]
+    self.assertEqual(
+        expected, stats_framework_gviz.downsample(table, DESCRIPTION, 2))
+
+  def test_to_columnar(self):
+    table = get_table()
+    expected = {
+      'columns': [
+        {
+          'id': 'key',
+          'label': 'Time',
+          'type': 'datetime',
+          'values': [table[0]['key'], table[3]['key']],
+        },
+        {
+          'id': 'requests',
+          'label': 'Total',
+          'max': [2, 4],
+          'min': [0, 3],
+          'type': 'number',
+          'values': [1., 3.5],
+        },
+      ],
+      'rows': 2,
+    }
+    self.assertEqual(
+        expected,
+        stats_framework_gviz.to_columnar(table, DESCRIPTION, ORDER, 2))
+    actual = stats_framework_gviz.to_columnar(table, DESCRIPTION, ORDER, 0)
+    self.assertEqual(5, actual['rows'])
+    self.assertEqual([0, 1, 2, 3, 4], actual['columns'][1]['values'])
+    self.assertNotIn('min', actual['columns'][1])
+
+  def test_get_columnar_json_cached(self):
+    calls = []
+    def get_table_once():
+      calls.append(1)
+      return get_table()
+
+    key = stats_framework_gviz.get_cache_key('minutes', None, 5, 2)
+    for _ in xrange(2):
+      response = webapp2.Response()
+      stats_framework_gviz.get_columnar_json(
+          response, get_table_once, DESCRIPTION, ORDER, key, 2)
+      self.assertEqual(
+          'application/json; charset=utf-8',
+          response.headers['Content-Type'])
+      actual = json.loads(response.body)
+      self.assertEqual(2, actual['rows'])
+      self.assertEqual(
+          ['2010-01-02 03:04:00', '2010-01-02 03:07:00'],
+          actual['columns'][0]['values'])
+    self.assertEqual(1, len(calls))
+
+
+if __name__ == '__main__':
+  if '-v' in sys.argv:
+    unittest.TestCase.maxDiff = None
+  unittest.main()
@@ -4,8 +4,11 @@
 # found in the LICENSE file.
 
 import calendar
+import collections
 import datetime
+import json
 import sys
+import threading
 import time
 import unittest
 
@@ -15,6 +18,7 @@ test_env.setup_test_env()
 import webapp2
 import webtest
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from components import stats_framework
@@ -68,6 +72,10 @@ def strip_seconds(timestamp):
 
 
 class StatsFrameworkTest(test_case.TestCase, stats_framework_mock.MockMixIn):
+  def setUp(self):
+    super(StatsFrameworkTest, self).setUp()
+    self.mock(stats_framework, '_SEALED_CACHE', collections.OrderedDict())
+
   def test_empty(self):
     handler = stats_framework.StatisticsFramework(
         'test_framework', Snapshot, self.fail)
@@ -136,6 +144,7 @@ class StatsFrameworkTest(test_case.TestCase, stats_framework_mock.MockMixIn):
     timestamp = midnight + datetime.timedelta(seconds=(limit - 1)*60)
     expected = {
       'created': now,
+      'rollups_backfilled': True,
       'timestamp': timestamp,
     }
     self.assertEqual(expected, root[0].to_dict())
@@ -277,6 +286,297 @@ class StatsFrameworkTest(test_case.TestCase, stats_framework_mock.MockMixIn):
     self.assertEqual(
         expected, stats_framework.get_stats(handler, 'minutes', now, 100, True))
 
+  def test_framework_parallel(self):
+    called = []
+    threads = set()
+
+    def gen_data(start, end):
+      """Returns fake statistics."""
+      self.assertEqual(start + 60, end)
+      called.append(start)
+      threads.add(threading.current_thread())
+      return Snapshot(
+          requests=1, b=1, inner=InnerSnapshot(c='%d,' % start))
+
+    handler = stats_framework.StatisticsFramework(
+        'test_framework', Snapshot, gen_data, max_minutes_per_process=20,
+        max_parallel_minutes=8)
+
+    now = get_now()
+    self.mock_now(now, 0)
+    start = strip_seconds(now) - datetime.timedelta(seconds=30*60)
+    handler._set_last_processed_time(start)
+    i = handler.process_next_chunk(1)
+    self.assertEqual(20, i)
+
+    # The minutes were generated out of order but exactly once, by a pool of
+    # at most max_parallel_minutes threads.
+    self.assertTrue(1 <= len(threads) <= 8, threads)
+    expected_calls = [
+      calendar.timegm((start + datetime.timedelta(minutes=i)).timetuple())
+      for i in xrange(1, 21)
+    ]
+    self.assertEqual(expected_calls, sorted(called))
+    self.assertEqual(20, handler.stats_minute_cls.query().count())
+    root = handler.root_key.get()
+    self.assertEqual(start + datetime.timedelta(minutes=20), root.timestamp)
+
+    # The hour accumulated the minutes in order.
+    hour = handler.stats_hour_cls.query().get()
+    self.assertEqual(20, hour.values.requests)
+    self.assertEqual(
+        ''.join('%d,' % i for i in expected_calls), hour.values.inner.c)
+
+  def test_framework_rollup(self):
+    handler = stats_framework.StatisticsFramework(
+        'test_framework', Snapshot, lambda _s, _e: Snapshot(requests=1),
+        max_minutes_per_process=1)
+    # 2010-01-03 is a Sunday.
+    day = datetime.date(2010, 1, 3)
+    handler.stats_day_cls(
+        key=handler.day_key(day), values_compressed=Snapshot(requests=23),
+        hours_bitmap=handler.stats_day_cls.SEALED_BITMAP & ~(1 << 23)).put()
+    last_minute = datetime.datetime(2010, 1, 3, 23, 59)
+    handler.stats_hour_cls(
+        key=handler.hour_key(last_minute),
+        values_compressed=Snapshot(requests=59),
+        minutes_bitmap=handler.stats_hour_cls.SEALED_BITMAP & ~(1 << 59)).put()
+    handler._set_last_processed_time(
+        last_minute - datetime.timedelta(minutes=1))
+    self.mock_now(datetime.datetime(2010, 1, 4, 0, 10), 0)
+
+    self.assertEqual(1, handler.process_next_chunk(1))
+    self.assertEqual(True, handler.day_key(day).get().is_sealed())
+    week = handler.week_key(day).get()
+    self.assertEqual('2009-12-28', week.key.id())
+    self.assertEqual(1 << 6, week.days_bitmap)
+    self.assertEqual(83, week.values.requests)
+    self.assertEqual(False, week.is_sealed())
+    month = handler.month_key(day).get()
+    self.assertEqual('2010-01', month.key.id())
+    self.assertEqual(1 << 2, month.days_bitmap)
+    self.assertEqual(83, month.values.requests)
+
+    now = datetime.datetime(2010, 1, 4, 0, 10)
+    self.assertEqual(
+        [83],
+        [
+          i['requests']
+          for i in stats_framework.get_stats(handler, 'weeks', now, 3, True)
+        ])
+    self.assertEqual(
+        [(datetime.date(2010, 1, 1), 83)],
+        [
+          (i['key'], i['requests'])
+          for i in stats_framework.get_stats(handler, 'months', now, 3, True)
+        ])
+    # 'auto' picks the finest resolution covering the timespan in 3 items.
+    self.assertEqual(
+        [(datetime.date(2009, 12, 28), 83)],
+        [
+          (i['key'], i['requests'])
+          for i in stats_framework.get_stats(
+              handler, 'auto', now, 3, True, datetime.timedelta(days=14))
+        ])
+    self.assertEqual(
+        [(datetime.date(2010, 1, 1), 83)],
+        [
+          (i['key'], i['requests'])
+          for i in stats_framework.get_stats(
+              handler, 'auto', now, 3, True, datetime.timedelta(days=60))
+        ])
+
+  def test_backfill_rollups(self):
+    handler = stats_framework.StatisticsFramework(
+        'test_framework', Snapshot, self.fail)
+    # Days sealed before the weeks and the months were rolled up. 2010-01-03
+    # is a Sunday.
+    days = [datetime.date(2009, 12, 31), datetime.date(2010, 1, 3)]
+    for day in days:
+      handler.stats_day_cls(
+          key=handler.day_key(day), values_compressed=Snapshot(requests=1),
+          hours_bitmap=handler.stats_day_cls.SEALED_BITMAP).put()
+    # Not sealed.
+    handler.stats_day_cls(
+        key=handler.day_key(datetime.date(2010, 1, 4)),
+        values_compressed=Snapshot(requests=1)).put()
+
+    handler._backfill_rollups()
+    self.assertEqual(True, handler.root_key.get().rollups_backfilled)
+    self.assertEqual(
+        [('2009-12-28', 0x48, 2)],
+        [
+          (w.key.id(), w.days_bitmap, w.values.requests)
+          for w in handler.stats_week_cls.query()
+        ])
+    self.assertEqual(
+        [('2009-12', 1 << 30, 1), ('2010-01', 1 << 2, 1)],
+        [
+          (m.key.id(), m.days_bitmap, m.values.requests)
+          for m in handler.stats_month_cls.query()
+        ])
+
+    # It runs only once.
+    self.mock(handler, 'rebuild_rollups', self.fail)
+    handler._backfill_rollups()
+
+  def test_replay(self):
+    handler = stats_framework.StatisticsFramework(
+        'test_framework', Snapshot, generate_snapshot)
+    day = datetime.date(2010, 1, 3)
+    start = datetime.datetime(2010, 1, 3)
+    epoch = calendar.timegm(start.timetuple())
+    exported = [
+      {'end_time': epoch + 30, 'entries': ['a'], 'status': 200},
+      {'end_time': epoch + 90, 'entries': ['b', 'c'], 'status': 200},
+    ]
+    entries = [
+      stats_framework.entry_from_dict(json.loads(json.dumps(d)))
+      for d in exported
+    ]
+    self.assertEqual(
+        exported, [stats_framework.entry_to_dict(e) for e in entries])
+
+    # Replaying twice must not accumulate the values twice.
+    for _ in xrange(2):
+      for i in xrange(24*60):
+        handler.replay_minute(start + datetime.timedelta(minutes=i), entries)
+      handler.rebuild_day(day)
+      handler.rebuild_rollups(day)
+
+      minute = handler.minute_key(start).get()
+      self.assertEqual(1, minute.values.requests)
+      self.assertEqual('a', minute.values.inner.c)
+      minute = handler.minute_key(start + datetime.timedelta(minutes=1)).get()
+      self.assertEqual('bc', minute.values.inner.c)
+      self.assertEqual(0, handler.minute_key(
+          start + datetime.timedelta(minutes=2)).get().values.requests)
+      hour = handler.hour_key(start).get()
+      self.assertEqual(True, hour.is_sealed())
+      self.assertEqual(2, hour.values.requests)
+      day_entity = handler.day_key(day).get()
+      self.assertEqual(True, day_entity.is_sealed())
+      self.assertEqual(2, day_entity.values.requests)
+      week = handler.week_key(day).get()
+      self.assertEqual(1 << 6, week.days_bitmap)
+      self.assertEqual(2, week.values.requests)
+      month = handler.month_key(day).get()
+      self.assertEqual(1 << 2, month.days_bitmap)
+      self.assertEqual(2, month.values.requests)
+
+  def test_rebuild_day_stale_hour(self):
+    handler = stats_framework.StatisticsFramework(
+        'test_framework', Snapshot, generate_snapshot)
+    day = datetime.date(2010, 1, 3)
+    start = datetime.datetime(2010, 1, 3)
+    handler.replay_minute(start, [])
+    # An hour left from a previous run, its minutes are gone.
+    stale = datetime.datetime(2010, 1, 3, 5)
+    handler.stats_hour_cls(
+        key=handler.hour_key(stale), values_compressed=Snapshot(),
+        minutes_bitmap=1).put()
+
+    handler.rebuild_day(day)
+    self.assertEqual(1, handler.hour_key(start).get().minutes_bitmap)
+    self.assertEqual(None, handler.hour_key(stale).get())
+
+  def test_pick_resolution(self):
+    self.assertEqual(
+        'minutes',
+        stats_framework.pick_resolution(datetime.timedelta(hours=1), 100))
+    self.assertEqual(
+        'days',
+        stats_framework.pick_resolution(datetime.timedelta(days=30), 100))
+    self.assertEqual(
+        'weeks',
+        stats_framework.pick_resolution(datetime.timedelta(days=365), 100))
+    self.assertEqual(
+        'months',
+        stats_framework.pick_resolution(datetime.timedelta(days=3650), 100))
+    self.assertEqual(
+        'months',
+        stats_framework.pick_resolution(datetime.timedelta(days=36500), 100))
+
+  def test_get_stats_sealed_cached(self):
+    handler = stats_framework.StatisticsFramework(
+        'test_framework', Snapshot, self.fail)
+    now = get_now()
+    sealed = now - datetime.timedelta(hours=1)
+    handler.stats_hour_cls(
+        key=handler.hour_key(sealed), values_compressed=Snapshot(requests=1),
+        minutes_bitmap=handler.stats_hour_cls.SEALED_BITMAP).put()
+    handler.stats_hour_cls(
+        key=handler.hour_key(now), values_compressed=Snapshot(requests=2)).put()
+
+    def get_requests():
+      return [
+        i['requests']
+        for i in stats_framework.get_stats(handler, 'hours', now, 2, True)
+      ]
+
+    self.assertEqual([2, 1], get_requests())
+    for hour in handler.stats_hour_cls.query():
+      hour.values_compressed = Snapshot(requests=10)
+      hour.put()
+    # Only the open hour is read back from the datastore.
+    self.assertEqual([10, 1], get_requests())
+    stats_framework._SEALED_CACHE.clear()
+    self.assertEqual([10, 1], get_requests())
+    # The raw entities are cached separately.
+    self.assertEqual(
+        [10, 10],
+        [
+          i.values.requests
+          for i in stats_framework.get_stats(handler, 'hours', now, 2, False)
+        ])
+
+  def test_get_stats_sealed_cached_lru(self):
+    self.mock(stats_framework, '_SEALED_CACHE_MAX_ITEMS', 2)
+    handler = stats_framework.StatisticsFramework(
+        'test_framework', Snapshot, self.fail)
+    now = get_now()
+    hours = [now - datetime.timedelta(hours=i) for i in xrange(1, 4)]
+    for i, hour in enumerate(hours):
+      handler.stats_hour_cls(
+          key=handler.hour_key(hour), values_compressed=Snapshot(requests=i),
+          minutes_bitmap=handler.stats_hour_cls.SEALED_BITMAP).put()
+    keys = [handler.hour_key(hour) for hour in hours]
+
+    def get_cached():
+      return [k[len('dict/'):] for k in stats_framework._SEALED_CACHE]
+
+    stats_framework._get_multi_sealed_cached(keys[:2], True)
+    self.assertEqual([k.urlsafe() for k in keys[:2]], get_cached())
+    # Reading the first one makes the second one the least recently used.
+    stats_framework._get_multi_sealed_cached(keys[:1], True)
+    stats_framework._get_multi_sealed_cached(keys[2:], True)
+    self.assertEqual([keys[0].urlsafe(), keys[2].urlsafe()], get_cached())
+
+    # Invalidation removes it from the in-process cache too.
+    stats_framework._invalidate_sealed_cache(keys[:1])
+    self.assertEqual([keys[2].urlsafe()], get_cached())
+
+  def test_histogram(self):
+    lhs = []
+    rhs = []
+    for i in xrange(1, 91):
+      stats_framework.histogram_add(lhs, i * 1000.)
+    for i in xrange(91, 101):
+      stats_framework.histogram_add(rhs, i * 1000.)
+    stats_framework.histogram_add(rhs, 0.)
+    self.assertEqual(1, rhs[0])
+    merged = stats_framework.histogram_merge(lhs, rhs)
+    self.assertEqual(101, sum(merged))
+    self.assertEqual(merged, stats_framework.histogram_merge(rhs, lhs))
+    # The percentiles are within the precision of the buckets.
+    self.assertTrue(
+        45. <= stats_framework.histogram_percentile(merged, 50) <= 55.)
+    self.assertTrue(
+        85. <= stats_framework.histogram_percentile(merged, 90) <= 99.)
+    self.assertTrue(
+        90. <= stats_framework.histogram_percentile(merged, 99) <= 110.)
+    self.assertEqual(0., stats_framework.histogram_percentile([], 50))
+
   def test_keys(self):
     handler = stats_framework.StatisticsFramework(
         'test_framework', Snapshot, self.fail)
@@ -299,11 +599,79 @@ class StatsFrameworkTest(test_case.TestCase, stats_framework_mock.MockMixIn):
           'StatsMinute', '00'),
         handler.minute_key(date))
 
+  def test_keys_kind_prefix(self):
+    handler = stats_framework.StatisticsFramework(
+        'test_prefixed', Snapshot, self.fail, kind_prefix='Foo')
+    date = datetime.datetime(2010, 1, 2)
+    self.assertEqual(
+        ndb.Key(
+          'StatsRoot', 'test_prefixed',
+          'FooStatsDay', '2010-01-02',
+          'FooStatsHour', '00',
+          'FooStatsMinute', '00'),
+        handler.minute_key(date))
+    self.assertEqual('FooStatsWeek', handler.week_key(date.date()).kind())
+    self.assertEqual('FooStatsMonth', handler.month_key(date.date()).kind())
+
   def test_yield_empty(self):
     self.testbed.init_modules_stub()
     self.assertEqual(
         0, len(list(stats_framework.yield_entries(None, None))))
 
+  def test_yield_buffered_entries(self):
+    self.mock(stats_framework, '_BUFFER', {})
+    now = self.mock_now(get_now())
+    stats_framework.add_buffered_entry('Hello')
+    stats_framework.add_buffered_entry('World')
+    stats_framework.add_buffered_entry('Hello')
+    stats_framework.add_buffered_request(200)
+    # Not flushed yet, it's still buffered in-process.
+    self.assertEqual(1, len(stats_framework._BUFFER))
+    self.mock_now(now, stats_framework.BUFFER_FLUSH_SECS)
+    stats_framework.add_buffered_request(500)
+    self.assertEqual({}, stats_framework._BUFFER)
+    start = calendar.timegm(strip_seconds(now).timetuple())
+
+    actual = list(stats_framework.yield_buffered_entries(start, start + 60))
+    self.assertEqual(3, len(actual))
+    self.assertEqual(
+        [200, 500, None],
+        [e.request.status if e.request else None for e in actual])
+    self.assertEqual(['Hello', 'Hello', 'World'], actual[2].entries)
+    self.assertEqual(
+        [], list(stats_framework.yield_buffered_entries(start - 60, start)))
+    self.assertEqual(
+        [],
+        list(stats_framework.yield_buffered_entries(start + 60, start + 120)))
+
+    # The counts were saved in the datastore and survive memcache eviction.
+    memcache.flush_all()
+    actual = list(stats_framework.yield_buffered_entries(start, start + 60))
+    self.assertEqual(['Hello', 'Hello', 'World'], actual[2].entries)
+
+  def test_flush_buffered_entries_minute_over(self):
+    self.mock(stats_framework, '_BUFFER', {})
+    now = self.mock_now(strip_seconds(get_now()), 59)
+    stats_framework.add_buffered_entry('Hello')
+    self.assertEqual(1, len(stats_framework._BUFFER))
+    self.mock_now(now, 1)
+    stats_framework.flush_buffered_entries()
+    self.assertEqual({}, stats_framework._BUFFER)
+
+  def test_buffered_requests_wsgi_middleware(self):
+    self.mock(stats_framework, '_BUFFER', {})
+    now = self.mock_now(get_now())
+    def app(_environ, start_response):
+      start_response('404 Not Found', [])
+      return ['']
+    wrapped = stats_framework.buffered_requests_wsgi_middleware(
+        app, lambda: True)
+    self.assertEqual([''], wrapped({}, lambda *_: None))
+    stats_framework.flush_buffered_entries(force=True)
+    start = calendar.timegm(strip_seconds(now).timetuple())
+    actual = list(stats_framework.yield_buffered_entries(start, start + 60))
+    self.assertEqual([404], [e.request.status for e in actual])
+
 
 def generate_snapshot(start_time, end_time):
   values = Snapshot()
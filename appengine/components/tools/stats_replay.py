@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# Copyright 2014 The Swarming Authors. All rights reserved.
+# Use of this source code is governed by the Apache v2.0 license that can be
+# found in the LICENSE file.
+
+"""Regenerates stats_framework history from exported statistics entries.
+
+It is used when the statistics processing fell behind more than
+max_backtrack_days or when a bug in the parsing of the entries was fixed.
+
+The input files contain one json encoded stats_framework.entry_to_dict() record
+per line. Each day present in the input is replayed by a worker: its minutes
+covered by the input, from the first to the last record, are regenerated
+through the application harvesting function, then its hours and the day itself
+are rebuilt from the minutes. The weeks and the months are rebuilt last. The
+replayed entities are overwritten so the tool can be run again on the same
+input. Use --full-days to overwrite all the minutes of the days present in the
+input, including the minutes before the first and after the last record.
+
+By default, the entities are written to a local datastore stub, saved to
+--datastore-path if specified. Use --host to write to an instance through
+remote_api instead.
+
+Example:
+  stats_replay.py -p ../../swarming --handler server.stats.STATS_HANDLER \\
+      entries.json
+"""
+
+import datetime
+import importlib
+import json
+import logging
+import multiprocessing.pool
+import optparse
+import os
+import sys
+import urllib2
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party'))
+
+from support import gae_sdk_utils
+
+
+### Private stuff.
+
+
+def _load_entries(paths):
+  """Returns the exported records grouped by day, then by minute."""
+  days = {}
+  for path in paths:
+    with open(path, 'rb') as f:
+      for line in f:
+        line = line.strip()
+        if not line:
+          continue
+        data = json.loads(line)
+        moment = datetime.datetime.utcfromtimestamp(
+            int(data['end_time']) / 60 * 60)
+        days.setdefault(moment.date(), {}).setdefault(moment, []).append(data)
+  return days
+
+
+def _replay_day(handler, day, minutes, first, last):
+  """Regenerates the minutes of a day from first to last included, then rebuilds
+  its hours and itself.
+  """
+  from components import stats_framework
+  start = datetime.datetime(day.year, day.month, day.day)
+  moment = max(start, first)
+  last = min(start + datetime.timedelta(days=1, minutes=-1), last)
+  while moment <= last:
+    handler.replay_minute(
+        moment,
+        [stats_framework.entry_from_dict(d) for d in minutes.get(moment, [])])
+    moment += datetime.timedelta(minutes=1)
+  handler.rebuild_day(day)
+  logging.info('Replayed %s', day)
+
+
+def _setup_local(datastore_path):
+  """Uses local stubs, optionally saving the datastore to a file."""
+  from google.appengine.ext import testbed
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_datastore_v3_stub(
+      datastore_file=datastore_path, save_changes=bool(datastore_path))
+  bed.init_memcache_stub()
+  return bed
+
+
+def _setup_remote(host):
+  """Uses remote_api to access the instance at host."""
+  from google.appengine.ext.remote_api import remote_api_stub
+  remote_api_stub.ConfigureRemoteApi(
+      None,
+      '/_ah/remote_api',
+      gae_sdk_utils.get_authentication_function(),
+      host,
+      save_cookies=True,
+      secure=True)
+  remote_api_stub.MaybeInvokeAuthentication()
+
+
+def _load_handler(app_dir, name):
+  """Returns the StatisticsFramework instance at 'module.attribute'."""
+  for path in (
+      os.path.join(app_dir, 'components', 'third_party'),
+      os.path.join(app_dir, 'third_party'),
+      app_dir):
+    if os.path.isdir(path) and path not in sys.path:
+      sys.path.insert(0, path)
+  module_name, attribute = name.rsplit('.', 1)
+  return getattr(importlib.import_module(module_name), attribute)
+
+
+### Public API.
+
+
+def replay(handler, days, jobs, advance, full_days):
+  """Replays the days concurrently, then rebuilds their weeks and months.
+
+  Arguments:
+  - handler: StatisticsFramework instance.
+  - days: dict(datetime.date: dict(datetime.datetime: list of records)) as
+        returned by _load_entries().
+  - jobs: number of days replayed concurrently.
+  - advance: if True, moves the last processed minute of the handler to the
+        last minute replayed so the cron job resumes from there.
+  - full_days: if True, all the minutes of the days are replayed, otherwise
+        only the minutes from the first to the last record.
+  """
+  if full_days:
+    first = datetime.datetime.min
+    last = datetime.datetime.max
+  else:
+    first = min(min(minutes) for minutes in days.itervalues())
+    last = max(max(minutes) for minutes in days.itervalues())
+  pool = multiprocessing.pool.ThreadPool(jobs)
+  try:
+    pool.map(
+        lambda day: _replay_day(handler, day, days[day], first, last),
+        sorted(days))
+  finally:
+    pool.close()
+    pool.join()
+
+  # The weeks and months span multiple days so they are done serially once all
+  # the days are rebuilt.
+  rollups = {}
+  for day in sorted(days):
+    rollups.setdefault(handler.week_key(day), day)
+    rollups.setdefault(handler.month_key(day), day)
+  for day in sorted(set(rollups.itervalues())):
+    handler.rebuild_rollups(day)
+
+  if advance:
+    last_day = max(days)
+    last_minute = min(
+        datetime.datetime(last_day.year, last_day.month, last_day.day, 23, 59),
+        last)
+    root = handler.root_key.get()
+    if not root or not root.timestamp or root.timestamp < last_minute:
+      # pylint: disable=W0212
+      handler._set_last_processed_time(last_minute)
+
+
+def main():
+  parser = optparse.OptionParser(
+      usage='%prog [options] <files>',
+      description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '--handler',
+      help='Python path of the StatisticsFramework instance to replay, e.g. '
+           'server.stats.STATS_HANDLER')
+  parser.add_option(
+      '-j', '--jobs', type='int', default=8,
+      help='Number of days to replay concurrently, default: %default')
+  parser.add_option(
+      '-H', '--host',
+      help='Instance to write to via remote_api, e.g. '
+           'my-app.appspot.com. Uses a local datastore stub if not set')
+  parser.add_option(
+      '--datastore-path',
+      help='File to save the local datastore stub to, if --host is not set')
+  parser.add_option(
+      '--advance', action='store_true',
+      help='Moves the last processed minute to the last minute replayed')
+  parser.add_option(
+      '--full-days', action='store_true',
+      help='Overwrites all the minutes of the days present in the input, '
+           'instead of only the minutes from the first to the last record')
+  gae_sdk_utils.app_sdk_options(parser)
+  options, args = parser.parse_args()
+  if not args:
+    parser.error('Specify at least one file to replay')
+  if not options.handler:
+    parser.error('--handler is required')
+  app = gae_sdk_utils.process_sdk_options(parser, options, None)
+  gae_sdk_utils.setup_env(
+      app.app_dir, app.app_id, None, 'default', remote_api=bool(options.host))
+
+  if options.host:
+    try:
+      _setup_remote(options.host)
+    except urllib2.URLError:
+      print >> sys.stderr, 'Failed to access %s' % options.host
+      return 1
+  else:
+    _setup_local(options.datastore_path)
+
+  handler = _load_handler(app.app_dir, options.handler)
+  days = _load_entries(args)
+  if not days:
+    print >> sys.stderr, 'No entry found'
+    return 1
+  print('Replaying %d days from %s to %s' % (len(days), min(days), max(days)))
+  replay(handler, days, options.jobs, options.advance, options.full_days)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -11,6 +11,7 @@ from google.appengine.api import modules
 from google.appengine.ext import ndb
 
 from components import config
+from components import stats_framework
 from components import utils
 
 
@@ -48,6 +49,11 @@ class GlobalConfig(config.GlobalConfig):
   # id to inject into pages if applicable.
   google_analytics = ndb.StringProperty(indexed=False, default='')
 
+  # Source of the statistics entries, one of stats_framework.BACKENDS. See
+  # stats_framework for the trade offs.
+  stats_backend = ndb.StringProperty(
+      indexed=False, choices=stats_framework.BACKENDS, default='logs')
+
   def set_defaults(self):
     self.global_secret = os.urandom(16)
     self.gs_bucket = app_identity.get_application_id()
@@ -22,6 +22,7 @@ import model
 import stats
 import template
 from components import decorators
+from components import profiling
 from components import utils
 
 
@@ -486,4 +487,5 @@ def create_application(debug=False):
   """
   # Necessary due to email sent by cron job.
   template.bootstrap()
-  return webapp2.WSGIApplication(get_routes(), debug=debug)
+  return webapp2.WSGIApplication(
+      get_routes() + profiling.get_backend_routes(), debug=debug)
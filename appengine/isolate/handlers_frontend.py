@@ -18,6 +18,7 @@ import mapreduce_jobs
 import stats
 import template
 from components import auth
+from components import profiling
 from components import stats_framework
 from components import stats_framework_gviz
 from components import utils
@@ -198,6 +199,21 @@ class StatsGvizMinutesHandler(StatsGvizHandlerBase):
   RESOLUTION = 'minutes'
 
 
+class StatsProfilingHandler(auth.ApiHandler):
+  """Returns the components.profiling snapshots per route as JSON."""
+
+  @auth.require(auth.is_admin)
+  def get(self, resolution):
+    if resolution not in stats_framework.RESOLUTIONS:
+      self.abort(404)
+    duration = utils.get_request_as_int(self.request, 'duration', 120, 1, 1000)
+    now = utils.get_request_as_datetime(self.request, 'now')
+    self.send_response(
+        utils.to_json_encodable(
+            stats_framework.get_stats(
+                profiling.STATS_HANDLER, resolution, now, duration, True)))
+
+
 ###  Public pages.
 
 
@@ -251,6 +267,9 @@ def get_routes():
       webapp2.Route(r'/isolate/api/v1/stats/days', StatsGvizDaysHandler),
       webapp2.Route(r'/isolate/api/v1/stats/hours', StatsGvizHoursHandler),
       webapp2.Route(r'/isolate/api/v1/stats/minutes', StatsGvizMinutesHandler),
+      webapp2.Route(
+          r'/isolate/api/v1/stats/profiling/<resolution:[a-z]+>',
+          StatsProfilingHandler),
       webapp2.Route(r'/', RootHandler),
 
       # AppEngine-specific urls:
@@ -17,12 +17,13 @@ from components import ereporter2
 from components import utils
 
 import handlers_backend
+import stats
 
 
 def create_application():
   """Bootstraps the app and creates the url router."""
   ereporter2.register_formatter()
-  a = handlers_backend.create_application()
+  a = stats.wsgi_middleware(handlers_backend.create_application())
   # In theory we'd want to take the output of app_identity.get_application_id().
   # Sadly, this function does an RPC call and may contribute to cause time out
   # on the initial load.
@@ -16,6 +16,8 @@ from google.appengine.ext import ndb
 from components import stats_framework
 from components import utils
 
+import config
+
 
 # Class has no __init__ method - pylint: disable=W0232
 
@@ -106,18 +108,31 @@ def _parse_line(line, values):
     return False
 
 
+def _is_buffered():
+  """Returns True if the entries are buffered in memcache instead of logged."""
+  return config.settings().stats_backend == 'memcache'
+
+
 def _extract_snapshot_from_logs(start_time, end_time):
   """Returns a _Snapshot from the processed logs for the specified interval.
 
-  The data is retrieved from logservice via stats_framework.
+  The data is retrieved from logservice or from the memcache buffers via
+  stats_framework, depending on config.settings().stats_backend.
   """
   values = _Snapshot()
   total_lines = 0
   parse_errors = 0
-  for entry in stats_framework.yield_entries(start_time, end_time):
-    values.requests += 1
-    if entry.request.status >= 400:
-      values.failures += 1
+  if _is_buffered():
+    entries = stats_framework.yield_buffered_entries(start_time, end_time)
+  else:
+    entries = stats_framework.yield_entries(start_time, end_time)
+  for entry in entries:
+    # The entries buffered with the 'memcache' backend are not associated to a
+    # HTTP request, the requests are yielded on their own.
+    if entry.request:
+      values.requests += 1
+      if entry.request.status >= 400:
+        values.failures += 1
     for l in entry.entries:
       if _parse_line(l, values):
         total_lines += 1
@@ -133,24 +148,38 @@ def _extract_snapshot_from_logs(start_time, end_time):
 
 
 STATS_HANDLER = stats_framework.StatisticsFramework(
-    'global_stats', _Snapshot, _extract_snapshot_from_logs)
+    'global_stats', _Snapshot, _extract_snapshot_from_logs,
+    max_parallel_minutes=10)
 
 
 # Action to log.
 STORE, RETURN, LOOKUP, DUPE = range(4)
 
 
+def wsgi_middleware(app):
+  """Returns the WSGI application counting the HTTP requests when the entries
+  are buffered in memcache.
+  """
+  return stats_framework.buffered_requests_wsgi_middleware(app, _is_buffered)
+
+
 def add_entry(action, number, where):
   """Formatted statistics log entry so it can be processed for daily stats.
 
   The format is simple enough that it doesn't require a regexp for faster
   processing.
   """
-  stats_framework.add_entry(
-      '%s; %d; %s' % (_ACTION_NAMES[action], number, where))
+  line = '%s; %d; %s' % (_ACTION_NAMES[action], number, where)
+  if _is_buffered():
+    stats_framework.add_buffered_entry(line)
+  else:
+    stats_framework.add_entry(line)
 
 
 def generate_stats():
   """Returns the number of minutes processed."""
+  if _is_buffered():
+    return STATS_HANDLER.process_next_chunk(
+        stats_framework.TOO_RECENT_BUFFERED)
   return STATS_HANDLER.process_next_chunk(stats_framework.TOO_RECENT)
 
@@ -167,6 +167,7 @@ class MainTest(test_case.TestCase):
       'default_expiration': 123456,
       'google_analytics': 'foobar',
       'keyid': str(config.settings().key.integer_id()),
+      'stats_backend': 'logs',
       'xsrf_token': self.get_xsrf_token(),
     }
     self.assertEqual('', config.settings().google_analytics)
@@ -183,6 +184,7 @@ class MainTest(test_case.TestCase):
       'google_analytics': 'foobar',
       'keyid': str(config.settings().key.integer_id() - 1),
       'reusable_task_age_secs': 30,
+      'stats_backend': 'logs',
       'xsrf_token': self.get_xsrf_token(),
     }
     self.assertEqual('', config.settings().google_analytics)
@@ -16914,6 +16914,28 @@ Polymer('core-menu');;
 
   ;
 
+  Polymer('stats-reap-chart', {
+    isDimension: false,
+    titleText: 'Bot Polls Reaping',
+
+    populate: function() {
+      this.resetFormattedData();
+
+      // These indexes are relative to stats_gviz._Summary.ORDER.
+      this.getKeyFormatter().format(this.dataTable, 0);
+
+      var view = new google.visualization.DataView(this.dataTable);
+      if (this.isDimension) {
+        view.setColumns([0, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27]);
+      } else {
+        view.setColumns([0, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29]);
+      }
+
+      this.attachView(view);
+    }
+  });
+  ;
+
   Polymer('stats-request-chart', {
     titleText: 'Requests',
 
@@ -16998,17 +17020,27 @@ Polymer('core-menu');;
         round3.format(this.dataTable, 6);
         round3.format(this.dataTable, 7);
         round3.format(this.dataTable, 8);
+        round3.format(this.dataTable, 11);
+        round3.format(this.dataTable, 13);
+        round3.format(this.dataTable, 16);
+        round3.format(this.dataTable, 28);
+        round3.format(this.dataTable, 29);
       } else {
         round3.format(this.dataTable, 8);
         round3.format(this.dataTable, 9);
         round3.format(this.dataTable, 10);
+        round3.format(this.dataTable, 13);
+        round3.format(this.dataTable, 15);
+        round3.format(this.dataTable, 18);
+        round3.format(this.dataTable, 30);
+        round3.format(this.dataTable, 31);
       }
 
       var view = new google.visualization.DataView(this.dataTable);
       if (this.dimension) {
-        view.setColumns([0, 6, 7, 8]);
+        view.setColumns([0, 6, 7, 8, 11, 13, 16, 28, 29]);
       } else {
-        view.setColumns([0, 8, 9, 10]);
+        view.setColumns([0, 8, 9, 10, 13, 15, 18, 30, 31]);
       }
 
       this.attachView(view);
@@ -185,6 +185,7 @@ class ClientApiTest(test_env_handlers.AppTestBase):
         u'parent_task_id': None,
         u'priority': 200,
         u'properties': {
+          u'caches': [],
           u'commands': [[u'rm', u'-rf', u'/']],
           u'data': [],
           u'dimensions': {},
@@ -445,6 +446,7 @@ class ClientApiTest(test_env_handlers.AppTestBase):
       u'parent_task_id': None,
       u'priority': 100,
       u'properties': {
+        u'caches': [],
         u'commands': [[u'python', u'run_test.py']],
         u'data': [],
         u'dimensions': {u'os': u'Amiga'},
@@ -606,6 +608,7 @@ class ClientApiTest(test_env_handlers.AppTestBase):
           u'quarantined': False,
           u'state': {u'ram': 65},
           u'task_id': None,
+          u'task_ids': [],
           u'task_name': None,
           u'version': u'123456789',
         },
@@ -664,6 +667,7 @@ class ClientApiTest(test_env_handlers.AppTestBase):
       u'quarantined': False,
       u'state': {u'ram': 65},
       u'task_id': None,
+      u'task_ids': [],
       u'task_name': None,
       u'version': u'123456789',
     }
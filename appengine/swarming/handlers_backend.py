@@ -10,6 +10,7 @@ from google.appengine.api import taskqueue
 
 import mapreduce_jobs
 from components import decorators
+from components import profiling
 from server import stats
 from server import task_scheduler
 
@@ -86,4 +87,4 @@ def get_routes():
     (r'/internal/taskqueue/mapreduce/launch/<job_id:[^\/]+>',
       InternalLaunchMapReduceJobWorkerHandler),
   ]
-  return [webapp2.Route(*a) for a in routes]
+  return [webapp2.Route(*a) for a in routes] + profiling.get_backend_routes()
@@ -23,6 +23,7 @@ from components import utils
 from server import acl
 from server import bot_code
 from server import bot_management
+from server import config
 from server import stats
 from server import task_pack
 from server import task_scheduler
@@ -90,6 +91,15 @@ def has_missing_keys(minimum_keys, actual_keys, name):
     return 'Unexpected %s%s; did you make a typo?' % (name, msg_missing)
 
 
+def get_list_of_strings(values, key):
+  """Returns values[key] if it is a list of strings, an empty list otherwise."""
+  value = values.get(key)
+  if (not isinstance(value, list) or
+      not all(isinstance(i, basestring) for i in value)):
+    return []
+  return value
+
+
 class BootstrapHandler(auth.AuthenticatingHandler):
   """Returns python code to run to bootstrap a swarming bot."""
 
@@ -102,24 +112,70 @@ class BootstrapHandler(auth.AuthenticatingHandler):
         bot_code.get_bootstrap(self.request.host_url).content)
 
 
+class BotCodeManifestHandler(auth.ApiHandler):
+  """Returns the files in swarming_bot.zip along their SHA-1.
+
+  A bot updating itself uses it to fetch only the files that changed with
+  BotCodeFileHandler, instead of the whole zip.
+  """
+
+  @auth.require(acl.is_bot)
+  def get(self, version):
+    expected = bot_code.get_bot_version(self.request.host_url)
+    if version != expected:
+      logging.error('Requested Swarming bot %s, have %s', version, expected)
+      self.abort_with_error(404, error='Unknown version')
+    self.send_response({
+      'files': bot_code.get_bot_manifest(self.request.host_url),
+      'version': version,
+    })
+
+
+class BotCodeFileHandler(auth.AuthenticatingHandler):
+  """Returns a file in swarming_bot.zip, addressed by the SHA-1 of its content.
+
+  The content is immutable so it is cacheable.
+  """
+
+  @auth.require(acl.is_bot)
+  def get(self, version, digest):
+    expected = bot_code.get_bot_version(self.request.host_url)
+    if version != expected:
+      logging.error('Requested Swarming bot %s, have %s', version, expected)
+      self.abort(404)
+    content = bot_code.get_bot_file(self.request.host_url, digest)
+    if content is None:
+      self.abort(404)
+    self.response.headers['Cache-Control'] = 'public, max-age=3600'
+    self.response.headers['Content-Type'] = 'application/octet-stream'
+    self.response.out.write(content)
+
+
 class BotCodeHandler(auth.AuthenticatingHandler):
   """Returns a zip file with all the files required by a bot.
 
   Optionally specify the hash version to download. If so, the returned data is
   cacheable.
+
+  The bot version is used as the ETag, so a client sending a matching
+  If-None-Match header gets a 304 without the content.
   """
 
   @auth.require(acl.is_bot)
   def get(self, version=None):
+    expected = bot_code.get_bot_version(self.request.host_url)
     if version:
-      expected = bot_code.get_bot_version(self.request.host_url)
       if version != expected:
         # This can happen when the server is rapidly updated.
         logging.error('Requested Swarming bot %s, have %s', version, expected)
         self.abort(404)
       self.response.headers['Cache-Control'] = 'public, max-age=3600'
     else:
-      self.response.headers['Cache-Control'] = 'no-cache, no-store'
+      self.response.headers['Cache-Control'] = 'no-cache'
+    self.response.headers['ETag'] = '"%s"' % expected
+    if expected in self.request.if_none_match:
+      self.response.status = 304
+      return
     self.response.headers['Content-Type'] = 'application/octet-stream'
     self.response.headers['Content-Disposition'] = (
         'attachment; filename="swarming_bot.zip"')
@@ -282,18 +338,25 @@ class BotPollHandler(_BotBaseHandler):
         dimensions, quarantined_msg) = self._process()
     sleep_streak = state.get('sleep_streak', 0)
     quarantined = bool(quarantined_msg)
+    # A bot running tasks concurrently polls while some of its slots are still
+    # busy, see bot_main._TaskSlots. Keep it reported as busy meanwhile.
+    slots_busy = get_list_of_strings(state, 'slots_busy')
 
     # Note bot existence at two places, one for stats at 1 minute resolution,
-    # the other for the list of known bots.
+    # the other for the list of known bots. Both are done once per poll; when
+    # the bot reaps, the stats entry is written around bot_reap_task() so the
+    # reaping statistics are part of it.
     action = 'bot_inactive' if quarantined else 'bot_active'
-    stats.add_entry(action=action, bot_id=bot_id, dimensions=dimensions)
 
-    def bot_event(event_type, task_id=None, task_name=None):
+    def bot_event(event_type, task_id=None, task_name=None, add_stats=True):
+      if add_stats:
+        stats.add_entry(action=action, bot_id=bot_id, dimensions=dimensions)
       bot_management.bot_event(
           event_type=event_type, bot_id=bot_id,
           external_ip=self.request.remote_addr, dimensions=dimensions,
           state=state, version=version, quarantined=quarantined,
-          task_id=task_id, task_name=task_name, message=quarantined_msg)
+          task_id=task_id, task_name=task_name, task_ids=slots_busy,
+          message=quarantined_msg)
 
     # Bot version is host-specific because the host URL is embedded in
     # swarming_bot.zip
@@ -324,12 +387,25 @@ class BotPollHandler(_BotBaseHandler):
 
     # The bot is in good shape. Try to grab a task.
     try:
-      # This is a fairly complex function call, exceptions are expected.
-      request, run_result = task_scheduler.bot_reap_task(
-          dimensions, bot_id, version)
+      reap_stats = {}
+      reaped = False
+      try:
+        # This is a fairly complex function call, exceptions are expected.
+        request, run_result = task_scheduler.bot_reap_task(
+            dimensions, bot_id, version,
+            get_list_of_strings(state, 'named_caches'),
+            get_list_of_strings(state, 'data_cache'), reap_stats)
+        reaped = True
+      finally:
+        # The bot existence is noted even if reaping failed or hit the
+        # deadline. The reaping statistics are only valid once it completed.
+        if not reaped:
+          reap_stats = {}
+        stats.add_entry(
+            action=action, bot_id=bot_id, dimensions=dimensions, **reap_stats)
       if not request:
         # No task found, tell it to sleep a bit.
-        bot_event('request_sleep')
+        bot_event('request_sleep', add_stats=False)
         self._cmd_sleep(sleep_streak, quarantined)
         return
 
@@ -338,7 +414,7 @@ class BotPollHandler(_BotBaseHandler):
         # another one.
         bot_event(
             'request_task', task_id=run_result.key_string,
-            task_name=request.name)
+            task_name=request.name, add_stats=False)
         self._cmd_run(request, run_result.key, bot_id)
       except:
         logging.exception('Dang, exception after reaping')
@@ -358,6 +434,7 @@ class BotPollHandler(_BotBaseHandler):
       'cmd': 'run',
       'manifest': {
         'bot_id': bot_id,
+        'caches': request.properties.caches or [],
         'command': request.properties.commands[0],
         'data': request.properties.data,
         'env': request.properties.env,
@@ -462,8 +539,9 @@ class BotTaskUpdateHandler(auth.ApiHandler):
   out-of-order packets.
   """
   ACCEPTED_KEYS = {
-    u'cost_usd', u'duration', u'exit_code', u'hard_timeout',
-    u'id', u'io_timeout', u'output', u'output_chunk_start', u'task_id',
+    u'bot_timings', u'cost_usd', u'duration', u'exit_code', u'hard_timeout',
+    u'id', u'io_timeout', u'killed', u'output', u'output_chunk_start',
+    u'task_id',
   }
   REQUIRED_KEYS = {u'id', u'task_id'}
 
@@ -482,10 +560,12 @@ class BotTaskUpdateHandler(auth.ApiHandler):
     cost_usd = request['cost_usd']
     task_id = request['task_id']
 
+    bot_timings = request.get('bot_timings')
     duration = request.get('duration')
     exit_code = request.get('exit_code')
     hard_timeout = request.get('hard_timeout')
     io_timeout = request.get('io_timeout')
+    killed = request.get('killed', False)
     output = request.get('output')
     output_chunk_start = request.get('output_chunk_start')
 
@@ -503,9 +583,10 @@ class BotTaskUpdateHandler(auth.ApiHandler):
         logging.error('Failed to decode output\n%s\n%r', e, output)
 
     try:
-      success, completed = task_scheduler.bot_update_task(
+      success, completed, must_stop = task_scheduler.bot_update_task(
           run_result_key, bot_id, output, output_chunk_start,
-          exit_code, duration, hard_timeout, io_timeout, cost_usd)
+          exit_code, duration, hard_timeout, io_timeout, cost_usd,
+          bot_timings, killed)
       if not success:
         self.abort_with_error(500, error='Failed to update, please retry')
 
@@ -524,12 +605,17 @@ class BotTaskUpdateHandler(auth.ApiHandler):
     except Exception as e:
       self.abort_with_error(500, error=str(e))
 
-    # TODO(maruel): When a task is canceled, reply with 'DIE' so that the bot
-    # reboots itself to abort the task abruptly. It is useful when a task hangs
-    # and the timeout was set too long or the task was superseded by a newer
-    # task with more recent executable (e.g. a new Try Server job on a newer
-    # patchset on Rietveld).
-    self.send_response({'ok': True})
+    # When the task was canceled while running, tell the bot to kill it. It is
+    # useful when a task hangs and the timeout was set too long or the task was
+    # superseded by a newer task with more recent executable (e.g. a new Try
+    # Server job on a newer patchset on Rietveld).
+    # update_interval_secs is a hint used by the bot to space its updates, see
+    # task_runner.UpdatePolicy.
+    self.send_response({
+      'must_stop': must_stop,
+      'ok': True,
+      'update_interval_secs': config.settings().bot_update_interval_secs,
+    })
 
 
 class BotTaskErrorHandler(auth.ApiHandler):
@@ -594,6 +680,11 @@ def get_routes():
       ('/bootstrap', BootstrapHandler),
       ('/bot_code', BotCodeHandler),
       ('/swarming/api/v1/bot/bot_code/<version:[0-9a-f]{40}>', BotCodeHandler),
+      ('/swarming/api/v1/bot/bot_code/<version:[0-9a-f]{40}>/manifest',
+          BotCodeManifestHandler),
+      ('/swarming/api/v1/bot/bot_code/<version:[0-9a-f]{40}>/file/'
+          '<digest:[0-9a-f]{40}>',
+          BotCodeFileHandler),
       ('/swarming/api/v1/bot/error', BotErrorHandler),
       ('/swarming/api/v1/bot/event', BotEventHandler),
       ('/swarming/api/v1/bot/handshake', BotHandshakeHandler),
@@ -17,6 +17,7 @@ import zipfile
 # Setups environment.
 import test_env_handlers
 
+from google.appengine import runtime
 from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
@@ -29,7 +30,9 @@ from components import ereporter2
 from components import utils
 from server import bot_archive
 from server import bot_management
+from server import stats
 from server import task_result
+from server import task_scheduler
 
 
 class BotApiTest(test_env_handlers.AppTestBase):
@@ -185,6 +188,42 @@ class BotApiTest(test_env_handlers.AppTestBase):
     }
     self.assertEqual(expected, response)
 
+  def test_poll_sleep_slots_busy(self):
+    # A bot running tasks concurrently polls with a busy slot; it stays busy.
+    token, params = self.get_bot_token()
+    params['state']['slots'] = 2
+    params['state']['slots_busy'] = [u'12311']
+    response = self.post_with_token('/swarming/api/v1/bot/poll', params, token)
+    self.assertEqual(u'sleep', response[u'cmd'])
+    bot_info = bot_management.get_info_key('bot1').get()
+    self.assertEqual(u'12311', bot_info.task_id)
+    self.assertEqual([u'12311'], bot_info.task_ids)
+    self.assertEqual(True, bot_info.is_busy)
+
+  def test_poll_reap_deadline(self):
+    # The bot existence is noted even if reaping hit the deadline, without the
+    # partial reaping statistics.
+    entries = []
+    self.mock(stats, 'add_entry', lambda **kwargs: entries.append(kwargs))
+    def bot_reap_task(*args):
+      args[-1]['reap_polls'] = 1
+      raise runtime.DeadlineExceededError()
+    self.mock(task_scheduler, 'bot_reap_task', bot_reap_task)
+
+    token, params = self.get_bot_token()
+    del entries[:]
+    self.app.post_json(
+        '/swarming/api/v1/bot/poll', params=params,
+        headers={'X-XSRF-Token': token}, status=500)
+    expected = [
+      {
+        'action': 'bot_active',
+        'bot_id': u'bot1',
+        'dimensions': {u'id': [u'bot1'], u'os': [u'Amiga']},
+      },
+    ]
+    self.assertEqual(expected, entries)
+
   def test_poll_update(self):
     token, params = self.get_bot_token()
     old_version = params['version']
@@ -233,6 +272,7 @@ class BotApiTest(test_env_handlers.AppTestBase):
     expected = {
       u'cmd': u'run',
       u'manifest': {
+        u'caches': [],
         u'bot_id': u'bot1',
         u'command': [u'python', u'run_test.py'],
         u'data': [],
@@ -395,7 +435,9 @@ class BotApiTest(test_env_handlers.AppTestBase):
     def _cycle(params, expected):
       response = self.post_with_token(
           '/swarming/api/v1/bot/task_update', params, token)
-      self.assertEqual({u'ok': True}, response)
+      self.assertEqual(
+          {u'must_stop': False, u'ok': True, u'update_interval_secs': 0},
+          response)
       response = self.client_get_results(task_id)
       self.assertEqual(expected, response)
 
@@ -405,7 +447,9 @@ class BotApiTest(test_env_handlers.AppTestBase):
     params = _params()
     response = self.post_with_token(
         '/swarming/api/v1/bot/task_update', params, token)
-    self.assertEqual({u'ok': True}, response)
+    self.assertEqual(
+        {u'must_stop': False, u'ok': True, u'update_interval_secs': 0},
+        response)
     response = self.client_get_results(task_id)
     self.assertEqual(_expected(), response)
 
@@ -588,6 +632,34 @@ class BotApiTest(test_env_handlers.AppTestBase):
     with zipfile.ZipFile(StringIO.StringIO(code.body), 'r') as z:
       self.assertEqual(expected, set(z.namelist()))
 
+  def test_bot_code_incremental(self):
+    # Sets self.bot_version.
+    self.get_bot_token()
+    url = '/swarming/api/v1/bot/bot_code/%s' % self.bot_version
+    code = self.app.get(url)
+    response = self.app.get(url + '/manifest').json
+    self.assertEqual(self.bot_version, response['version'])
+    with zipfile.ZipFile(StringIO.StringIO(code.body), 'r') as z:
+      self.assertEqual(sorted(z.namelist()), sorted(response['files']))
+      digest = response['files']['bot_config.py']
+      self.assertEqual(
+          z.read('bot_config.py'),
+          self.app.get(url + '/file/' + digest).body)
+    self.app.get(url + '/file/' + 'a'*40, status=404)
+    self.app.get(
+        '/swarming/api/v1/bot/bot_code/%s/manifest' % ('a'*40), status=404)
+
+  def test_bot_code_etag(self):
+    code = self.app.get('/bot_code')
+    etag = code.headers['ETag']
+    self.assertTrue(code.body)
+    response = self.app.get(
+        '/bot_code', headers={'If-None-Match': etag}, status=304)
+    self.assertEqual('', response.body)
+    response = self.app.get(
+        '/bot_code', headers={'If-None-Match': '"foo"'}, status=200)
+    self.assertEqual(code.body, response.body)
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
@@ -63,6 +63,10 @@ class RestrictedConfigHandler(auth.AuthenticatingHandler):
       if k not in ('keyid', 'xsrf_token')
     }
     params['bot_death_timeout_secs'] = int(params['bot_death_timeout_secs'])
+    params['bot_update_interval_secs'] = int(
+        params['bot_update_interval_secs'])
+    params['cache_affinity_priority_window'] = int(
+        params['cache_affinity_priority_window'])
     params['reusable_task_age_secs'] = int(params['reusable_task_age_secs'])
     cfg = config.settings(fresh=True)
     keyid = int(self.request.get('keyid', '0'))
@@ -106,7 +110,8 @@ class UploadBotConfigHandler(auth.AuthenticatingHandler):
     if not script:
       self.abort(400, 'No script uploaded')
 
-    bot_code.store_bot_config(script.encode('utf-8', 'replace'))
+    bot_code.store_bot_config(
+        script.encode('utf-8', 'replace'), self.request.host_url)
     self.get()
 
 
@@ -745,6 +750,8 @@ def create_application(debug):
         stats_gviz.StatsGvizSummaryHandler),
       ('/swarming/api/v1/stats/dimensions/<dimensions:.+>/<resolution:[a-z]+>',
         stats_gviz.StatsGvizDimensionsHandler),
+      ('/swarming/api/v1/stats/profiling/<resolution:[a-z]+>',
+        stats_gviz.StatsProfilingHandler),
 
       ('/_ah/mail/<to:.+>', EmailHandler),
       ('/_ah/warmup', WarmupHandler),
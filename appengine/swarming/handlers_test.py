@@ -169,6 +169,13 @@ class FrontendTest(AppTestBase):
     for url in urls:
       self.app.get(url, status=200)
 
+  def test_stats_profiling(self):
+    self.set_as_anonymous()
+    self.app.get('/swarming/api/v1/stats/profiling/hours', status=403)
+    self.set_as_admin()
+    self.app.get('/swarming/api/v1/stats/profiling/hours', status=200)
+    self.app.get('/swarming/api/v1/stats/profiling/foo', status=404)
+
   def test_task_list_empty(self):
     # Just assert it doesn't throw.
     self.set_as_privileged_user()
@@ -398,9 +405,12 @@ class FrontendAdminTest(AppTestBase):
     # TODO(maruel): Use beautifulsoup?
     params = {
       'bot_death_timeout_secs': 10*60,
+      'bot_update_interval_secs': 0,
+      'cache_affinity_priority_window': 0,
       'google_analytics': 'foobar',
       'keyid': str(config.settings().key.integer_id()),
       'reusable_task_age_secs': 30,
+      'stats_backend': 'logs',
       'xsrf_token': self.get_xsrf_token(),
     }
     self.assertEqual('', config.settings().google_analytics)
@@ -415,9 +425,12 @@ class FrontendAdminTest(AppTestBase):
     # TODO(maruel): Use beautifulsoup?
     params = {
       'bot_death_timeout_secs': 10*60,
+      'bot_update_interval_secs': 0,
+      'cache_affinity_priority_window': 0,
       'google_analytics': 'foobar',
       'keyid': str(config.settings().key.integer_id() - 1),
       'reusable_task_age_secs': 30,
+      'stats_backend': 'logs',
       'xsrf_token': self.get_xsrf_token(),
     }
     self.assertEqual('', config.settings().google_analytics)
@@ -16,6 +16,7 @@ sys.path.insert(0, os.path.join(APP_DIR, 'components', 'third_party'))
 
 from components import ereporter2
 from components import utils
+from server import stats
 
 import handlers_frontend
 
@@ -29,7 +30,7 @@ logservice.AUTOFLUSH_EVERY_LINES = 1
 
 def create_application():
   ereporter2.register_formatter()
-  a = handlers_frontend.create_application(False)
+  a = stats.wsgi_middleware(handlers_frontend.create_application(False))
   # In theory we'd want to take the output of app_identity.get_application_id().
   # Sadly, this function does an RPC call and may contribute to cause time out
   # on the initial load.
@@ -8,8 +8,12 @@ It includes everything that is AppEngine specific. The non-GAE code is in
 bot_archive.py.
 """
 
+import StringIO
 import collections
+import hashlib
 import os.path
+import threading
+import zipfile
 
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
@@ -22,6 +26,25 @@ from server import bot_archive
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
+# Maximum size of a single memcache value or datastore entity holding a part of
+# swarming_bot.zip. Both are capped at 1mb, keep some slack for the overhead.
+CHUNK_SIZE = 950*1024
+
+
+# In-process copy of the BotVersion entities of this app version, as
+# dict(tuple(bot_config.py version, host): bot version). It is only ever added
+# to, so it's safe to use without a lock.
+_BOT_VERSIONS = {}
+
+
+# In-process copy of the files of the most recent swarming_bot.zip extracted, as
+# dict(bot version: dict(path: content)), see _get_bot_files(). The oldest
+# version is evicted first.
+_BOT_FILES = collections.OrderedDict()
+_BOT_FILES_LOCK = threading.Lock()
+_BOT_FILES_MAX_VERSIONS = 4
+
+
 ### Models.
 
 
@@ -53,6 +76,126 @@ class VersionedFile(ndb.Model):
     return ndb.Key(cls.ROOT_MODEL, name)
 
 
+class BotVersion(ndb.Model):
+  """Bot version computed once per app version, bot_config.py version and host.
+
+  The key id is '<app version>/<bot_config.py version>/<host>' so the entity is
+  immutable.
+  """
+  created_ts = ndb.DateTimeProperty(indexed=False, auto_now_add=True)
+  version = ndb.StringProperty(indexed=False)
+
+
+class BotArchive(ndb.Model):
+  """Manifest of a generated swarming_bot.zip.
+
+  The key id is the bot version, so the entity is immutable. The content is
+  stored in BotArchiveChunk child entities since it can be larger than the
+  maximum entity size.
+  """
+  created_ts = ndb.DateTimeProperty(indexed=False, auto_now_add=True)
+  chunk_count = ndb.IntegerProperty(indexed=False)
+  size = ndb.IntegerProperty(indexed=False)
+
+
+class BotArchiveChunk(ndb.Model):
+  """A part of swarming_bot.zip.
+
+  Parent is BotArchive. The key id is the 1-based index of the chunk.
+  """
+  content = ndb.BlobProperty()
+
+
+### Private stuff.
+
+
+def _get_bot_config_version():
+  """Returns the version of the current bot_config.py.
+
+  It is a single get of the root entity. 0 means the one embedded in the tree.
+  """
+  root = ndb.Key(VersionedFile.ROOT_MODEL, 'bot_config.py').get()
+  return (root.current if root else None) or 0
+
+
+def _get_bot_config_with_version():
+  """Returns tuple(version, content) of the current bot_config.py."""
+  root, obj = datastore_utils.get_versioned_most_recent_with_root(
+      VersionedFile, ndb.Key(VersionedFile.ROOT_MODEL, 'bot_config.py'))
+  if obj:
+    return root.current, obj.content
+  return 0, get_bot_config().content
+
+
+def _bot_version_id(config_version, host):
+  return '%s/%d/%s' % (os.environ['CURRENT_VERSION_ID'], config_version, host)
+
+
+def _split(content):
+  """Splits content in CHUNK_SIZE parts. Always returns at least one part."""
+  return [
+    content[i:i+CHUNK_SIZE]
+    for i in xrange(0, max(len(content), 1), CHUNK_SIZE)
+  ]
+
+
+def _get_zip_from_memcache(version):
+  """Returns swarming_bot.zip from memcache or None if any chunk is missing."""
+  namespace = os.environ['CURRENT_VERSION_ID']
+  manifest_key = 'bot_zip-' + version
+  chunk_count = memcache.get(manifest_key, namespace=namespace)
+  if not chunk_count:
+    return None
+  keys = ['%s-%d' % (manifest_key, i) for i in xrange(chunk_count)]
+  chunks = memcache.get_multi(keys, namespace=namespace)
+  if len(chunks) != chunk_count:
+    return None
+  return ''.join(chunks[k] for k in keys)
+
+
+def _set_zip_in_memcache(version, code):
+  """Stores swarming_bot.zip in memcache as chunks plus a manifest."""
+  namespace = os.environ['CURRENT_VERSION_ID']
+  manifest_key = 'bot_zip-' + version
+  chunks = dict(
+      ('%s-%d' % (manifest_key, i), c) for i, c in enumerate(_split(code)))
+  # The manifest is stored last so that a reader never sees a manifest without
+  # its chunks, short of eviction.
+  if memcache.set_multi(chunks, namespace=namespace):
+    # Some chunks failed to be stored.
+    return
+  memcache.set(manifest_key, len(chunks), namespace=namespace)
+
+
+def _get_zip_from_datastore(version):
+  """Returns swarming_bot.zip from the datastore or None if not present."""
+  root = BotArchive.get_by_id(version)
+  if not root:
+    return None
+  keys = [
+    ndb.Key(BotArchiveChunk, i, parent=root.key)
+    for i in xrange(1, root.chunk_count + 1)
+  ]
+  chunks = ndb.get_multi(keys)
+  if not all(chunks):
+    return None
+  return ''.join(c.content for c in chunks)
+
+
+def _set_zip_in_datastore(version, code):
+  """Stores swarming_bot.zip in the datastore."""
+  root_key = ndb.Key(BotArchive, version)
+  chunks = [
+    BotArchiveChunk(key=ndb.Key(BotArchiveChunk, i, parent=root_key), content=c)
+    for i, c in enumerate(_split(code), 1)
+  ]
+  # Chunks are stored first so that the manifest is only visible once the
+  # content is complete. The content is immutable so there's no need for a
+  # transaction.
+  ndb.put_multi(chunks)
+  BotArchive(key=root_key, chunk_count=len(chunks), size=len(code)).put()
+
+
 ### Public APIs.
 
 
@@ -92,56 +235,121 @@ def get_bot_config():
     return File(f.read(), None, None)
 
 
-def store_bot_config(content):
-  """Stores a new version of bot_config.py."""
+def store_bot_config(content, host=None):
+  """Stores a new version of bot_config.py.
+
+  The bot version and swarming_bot.zip are keyed by the bot_config.py version,
+  so there's nothing to invalidate. If host is specified, they are precomputed
+  right away instead of on the first bot poll.
+  """
   out = VersionedFile(content=content).store('bot_config.py')
-  # Clear the cached version value since it has now changed. This is *super*
-  # aggressive to flush all memcache but that's the only safe way to not send
-  # old code by accident.
-  while not memcache.flush_all():
-    pass
+  if host:
+    get_swarming_bot_zip(host)
   return out
 
 
 def get_bot_version(host):
   """Retrieves the bot version loaded on this server.
 
-  The memcache is first checked for the version, otherwise the value
-  is generated and then stored in the memcache.
+  The version is computed once per app version, bot_config.py version and host
+  and saved as a BotVersion entity. Afterward, it costs the lookup of the
+  bot_config.py version, then it is served from an in-process copy. It doesn't
+  depend on memcache.
 
   Returns:
     The hash of the current bot version.
   """
-  namespace = os.environ['CURRENT_VERSION_ID']
-  key = 'bot_version' + host
-  bot_version = memcache.get(key, namespace=namespace)
+  config_version = _get_bot_config_version()
+  bot_version = _BOT_VERSIONS.get((config_version, host))
   if bot_version:
     return bot_version
 
-  # Need to calculate it.
-  additionals = {'bot_config.py': get_bot_config().content}
-  bot_dir = os.path.join(ROOT_DIR, 'swarming_bot')
-  bot_version = bot_archive.get_swarming_bot_version(bot_dir, host, additionals)
-  memcache.set(key, bot_version, namespace=namespace)
+  entity = BotVersion.get_by_id(_bot_version_id(config_version, host))
+  if entity:
+    bot_version = entity.version
+  else:
+    # Need to calculate it. bot_config.py may have been updated in the
+    # meantime, use the version of the content actually hashed.
+    config_version, content = _get_bot_config_with_version()
+    bot_dir = os.path.join(ROOT_DIR, 'swarming_bot')
+    bot_version = bot_archive.get_swarming_bot_version(
+        bot_dir, host, {'bot_config.py': content})
+    BotVersion(
+        id=_bot_version_id(config_version, host), version=bot_version).put()
+  _BOT_VERSIONS[(config_version, host)] = bot_version
   return bot_version
 
 
 def get_swarming_bot_zip(host):
   """Returns a zipped file of all the files a bot needs to run.
 
+  The archive is looked up in memcache first, then in the datastore and is
+  only generated if not found in either. Since the archive is keyed by its
+  version, a fleet-wide update costs a single generation.
+
   Returns:
     A string representing the zipped file's contents.
   """
-  namespace = os.environ['CURRENT_VERSION_ID']
-  key = 'bot_version-%s' + get_bot_version(host)
-  code = memcache.get(key, namespace=namespace)
+  version = get_bot_version(host)
+  code = _get_zip_from_memcache(version)
   if code:
     return code
 
-  # Get the start bot script from the database, if present. Pass an empty
-  # file if the files isn't present.
-  additionals = {'bot_config.py': get_bot_config().content}
-  bot_dir = os.path.join(ROOT_DIR, 'swarming_bot')
-  code = bot_archive.get_swarming_bot_zip(bot_dir, host, additionals)
-  memcache.set(key, code, namespace=namespace)
+  code = _get_zip_from_datastore(version)
+  if not code:
+    # Get the start bot script from the database, if present. Pass an empty
+    # file if the files isn't present.
+    additionals = {'bot_config.py': get_bot_config().content}
+    bot_dir = os.path.join(ROOT_DIR, 'swarming_bot')
+    code = bot_archive.get_swarming_bot_zip(bot_dir, host, additionals)
+    _set_zip_in_datastore(version, code)
+  _set_zip_in_memcache(version, code)
   return code
+
+
+def _get_bot_files(host):
+  """Returns the files in swarming_bot.zip as dict(path: content).
+
+  The archive is only extracted once per bot version, instead of once per file
+  requested by the bots updating themselves.
+  """
+  version = get_bot_version(host)
+  with _BOT_FILES_LOCK:
+    files = _BOT_FILES.get(version)
+  if files is None:
+    code = get_swarming_bot_zip(host)
+    with zipfile.ZipFile(StringIO.StringIO(code), 'r') as zip_file:
+      files = dict((i, zip_file.read(i)) for i in zip_file.namelist())
+    with _BOT_FILES_LOCK:
+      _BOT_FILES[version] = files
+      while len(_BOT_FILES) > _BOT_FILES_MAX_VERSIONS:
+        _BOT_FILES.popitem(last=False)
+  return files
+
+
+def get_bot_manifest(host):
+  """Returns the files in swarming_bot.zip as dict(path: SHA-1 of content).
+
+  It lets a bot updating itself fetch only the files that changed, see
+  get_bot_file(). It is derived from the archive so both always match.
+  """
+  namespace = os.environ['CURRENT_VERSION_ID']
+  key = 'bot_manifest-' + get_bot_version(host)
+  manifest = memcache.get(key, namespace=namespace)
+  if manifest is None:
+    manifest = dict(
+        (path, hashlib.sha1(content).hexdigest())
+        for path, content in _get_bot_files(host).iteritems())
+    memcache.set(key, manifest, namespace=namespace)
+  return manifest
+
+
+def get_bot_file(host, digest):
+  """Returns the content of the file in swarming_bot.zip with this SHA-1.
+
+  Returns None if there's no such file in the current bot code.
+  """
+  for path, file_digest in get_bot_manifest(host).iteritems():
+    if file_digest == digest:
+      return _get_bot_files(host).get(path)
+  return None
@@ -4,6 +4,8 @@
 # found in the LICENSE file.
 
 import StringIO
+import collections
+import hashlib
 import logging
 import os
 import re
@@ -21,6 +23,8 @@ import test_env
 
 test_env.setup_test_env()
 
+from google.appengine.api import memcache
+
 from components import auth
 from server import bot_archive
 from server import bot_code
@@ -35,6 +39,8 @@ class BotManagementTest(test_case.TestCase):
     self.mock(
         auth, 'get_current_identity',
         lambda: auth.Identity(auth.IDENTITY_USER, 'joe@localhost'))
+    self.mock(bot_code, '_BOT_VERSIONS', {})
+    self.mock(bot_code, '_BOT_FILES', collections.OrderedDict())
 
   def test_store_bot_config(self):
     # When a new start bot script is uploaded, we should recalculate the
@@ -51,6 +57,23 @@ class BotManagementTest(test_case.TestCase):
     actual = bot_code.get_bot_version('http://localhost')
     self.assertTrue(re.match(r'^[0-9a-f]{40}$', actual), actual)
 
+  def test_get_bot_version_precomputed(self):
+    expected = bot_code.get_bot_version('http://localhost')
+    self.assertEqual(1, bot_code.BotVersion.query().count())
+    # Neither a memcache flush nor a new instance recomputes it.
+    self.mock(
+        bot_archive, 'get_swarming_bot_version', lambda *_: self.fail())
+    memcache.flush_all()
+    self.mock(bot_code, '_BOT_VERSIONS', {})
+    self.assertEqual(expected, bot_code.get_bot_version('http://localhost'))
+    self.assertEqual(expected, bot_code.get_bot_version('http://localhost'))
+
+  def test_store_bot_config_precompute(self):
+    bot_code.store_bot_config('dummy_script', 'http://localhost')
+    self.mock(bot_archive, 'get_swarming_bot_version', lambda *_: self.fail())
+    self.mock(bot_archive, 'get_swarming_bot_zip', lambda *_: self.fail())
+    self.assertTrue(bot_code.get_swarming_bot_zip('http://localhost'))
+
   def test_get_swarming_bot_zip(self):
     zipped_code = bot_code.get_swarming_bot_zip('http://localhost')
     # Ensure the zip is valid and all the expected files are present.
@@ -78,6 +101,43 @@ class BotManagementTest(test_case.TestCase):
     finally:
       shutil.rmtree(temp_dir)
 
+  def test_get_bot_manifest(self):
+    zipped_code = bot_code.get_swarming_bot_zip('http://localhost')
+    manifest = bot_code.get_bot_manifest('http://localhost')
+    # The archive is extracted only once.
+    self.mock(
+        bot_code, 'get_swarming_bot_zip',
+        lambda _: self.fail('Should have been cached'))
+    with zipfile.ZipFile(StringIO.StringIO(zipped_code), 'r') as zip_file:
+      self.assertEqual(sorted(zip_file.namelist()), sorted(manifest))
+      for path, digest in manifest.iteritems():
+        content = zip_file.read(path)
+        self.assertEqual(hashlib.sha1(content).hexdigest(), digest)
+        self.assertEqual(
+            content, bot_code.get_bot_file('http://localhost', digest))
+    self.assertEqual(None, bot_code.get_bot_file('http://localhost', 'a'*40))
+
+  def test_get_swarming_bot_zip_chunked(self):
+    self.mock(bot_code, 'CHUNK_SIZE', 1024)
+    expected = bot_code.get_swarming_bot_zip('http://localhost')
+    version = bot_code.get_bot_version('http://localhost')
+    root = bot_code.BotArchive.get_by_id(version)
+    self.assertEqual(len(expected), root.size)
+    self.assertEqual((len(expected) + 1023) / 1024, root.chunk_count)
+    chunks = bot_code.BotArchiveChunk.query(ancestor=root.key).count()
+    self.assertEqual(root.chunk_count, chunks)
+
+    # Served from memcache.
+    self.mock(bot_archive, 'get_swarming_bot_zip', lambda *_: self.fail())
+    actual = bot_code.get_swarming_bot_zip('http://localhost')
+    self.assertEqual(expected, actual)
+
+    # Served from the datastore once a chunk got evicted.
+    memcache.delete(
+        'bot_zip-%s-1' % version, namespace=os.environ['CURRENT_VERSION_ID'])
+    actual = bot_code.get_swarming_bot_zip('http://localhost')
+    self.assertEqual(expected, actual)
+
 
 if __name__ == '__main__':
   logging.basicConfig(
@@ -102,6 +102,10 @@ class BotInfo(_BotCommon):
   # Must only be set when self.task_id is set.
   task_name = ndb.StringProperty(indexed=False)
 
+  # All the tasks the bot is running, as it may run several concurrently, see
+  # state['slots_busy']. self.task_id is the last one.
+  task_ids = ndb.StringProperty(repeated=True, indexed=False)
+
   # Used to count the instantaneous number of busy bots.
   is_busy = ndb.ComputedProperty(lambda self: bool(self.task_id))
 
@@ -199,7 +203,7 @@ def get_settings_key(bot_id):
 
 def bot_event(
     event_type, bot_id, external_ip, dimensions, state, version, quarantined,
-    task_id, task_name, **kwargs):
+    task_id, task_name, task_ids=None, **kwargs):
   """Records when a bot has queried for work.
 
   Arguments:
@@ -215,6 +219,8 @@ def bot_event(
   - quarantined: bool to determine if the bot was declared quarantined.
   - task_id: packed task id if relevant. Set to '' to zap the stored value.
   - task_name: task name if relevant. Zapped when task_id is zapped.
+  - task_ids: packed task ids of all the tasks the bot reported running. If not
+        provided, keep previous value.
   - kwargs: optional values to add to BotEvent relevant to event_type.
   """
   if not bot_id:
@@ -231,10 +237,21 @@ def bot_event(
     bot_info.state = state
   if quarantined is not None:
     bot_info.quarantined = quarantined
+  if task_ids is not None:
+    bot_info.task_ids = task_ids
+    if (task_id is None and bot_info.task_id and
+        bot_info.task_id not in task_ids):
+      # The task previously reported is not running anymore.
+      task_id = task_ids[-1] if task_ids else ''
   if task_id is not None:
+    if task_id != bot_info.task_id:
+      # The name of the previous task is stale.
+      bot_info.task_name = None
     bot_info.task_id = task_id
   if task_name:
     bot_info.task_name = task_name
+  if event_type == 'request_task' and task_id not in bot_info.task_ids:
+    bot_info.task_ids.append(task_id)
   if version is not None:
     bot_info.version = version
 
@@ -258,8 +275,11 @@ def bot_event(
       **kwargs)
 
   if event_type in ('task_completed', 'task_error'):
-    # Special case to keep the task_id in the event but not in the summary.
-    bot_info.task_id = ''
+    # Special case to keep the task_id in the event but not in the summary. The
+    # bot stays busy with the other tasks it runs concurrently, if any.
+    bot_info.task_ids = [i for i in bot_info.task_ids if i != bot_info.task_id]
+    bot_info.task_id = bot_info.task_ids[-1] if bot_info.task_ids else ''
+    bot_info.task_name = None
 
   datastore_utils.store_new_version(event, BotRoot, [bot_info])
 
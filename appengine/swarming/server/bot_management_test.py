@@ -52,6 +52,7 @@ class BotManagementTest(test_case.TestCase):
       'quarantined': False,
       'state': {u'ram': 65},
       'task_id': None,
+      'task_ids': [],
       'task_name': None,
       'version': u'da39a3ee5e6b4b0d3255bfef95601890afd80709',
     }
@@ -101,6 +102,7 @@ class BotManagementTest(test_case.TestCase):
       'quarantined': True,
       'state': {u'ram': 65},
       'task_id': None,
+      'task_ids': [],
       'task_name': None,
       'version': u'da39a3ee5e6b4b0d3255bfef95601890afd80709',
     }
@@ -129,6 +131,7 @@ class BotManagementTest(test_case.TestCase):
       'quarantined': False,
       'state': {u'ram': 65},
       'task_id': u'12311',
+      'task_ids': [u'12311'],
       'task_name': u'yo',
       'version': u'da39a3ee5e6b4b0d3255bfef95601890afd80709',
     }
@@ -153,6 +156,40 @@ class BotManagementTest(test_case.TestCase):
         expected,
         [e.to_dict() for e in bot_management.get_events_query('id1')])
 
+    # The bot polls while running another task concurrently; the name of the
+    # previous task is not kept.
+    bot_management.bot_event(
+        event_type='request_sleep', bot_id='id1', external_ip='8.8.4.4',
+        dimensions=None, state=None, version=None, quarantined=None,
+        task_id='12312', task_name=None)
+    bot_info = bot_management.get_info_key('id1').get()
+    self.assertEqual(u'12312', bot_info.task_id)
+    self.assertEqual(None, bot_info.task_name)
+
+  def test_bot_event_task_ids(self):
+    def event(event_type, task_id, task_ids):
+      bot_management.bot_event(
+          event_type=event_type, bot_id='id1', external_ip='8.8.4.4',
+          dimensions=None, state=None, version=None, quarantined=None,
+          task_id=task_id, task_name=None, task_ids=task_ids)
+      bot_info = bot_management.get_info_key('id1').get()
+      return bot_info.task_id, bot_info.task_ids, bot_info.is_busy
+
+    # The bot reaps two tasks to run them concurrently.
+    self.assertEqual(
+        (u'12311', [u'12311'], True), event('request_task', '12311', []))
+    self.assertEqual(
+        (u'12321', [u'12311', u'12321'], True),
+        event('request_task', '12321', ['12311']))
+    # The last one completes, the bot is still busy with the first one.
+    self.assertEqual(
+        (u'12311', [u'12311'], True), event('task_completed', '12321', None))
+    # The bot polls without reporting it; the task isn't running anymore.
+    self.assertEqual(
+        (u'12311', [u'12311'], True),
+        event('request_sleep', None, ['12311']))
+    self.assertEqual((u'', [], False), event('request_sleep', None, []))
+
   def test_should_restart_bot_not_set(self):
     state = {
       'running_time': 0,
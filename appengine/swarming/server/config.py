@@ -7,6 +7,7 @@
 from google.appengine.ext import ndb
 
 from components import config
+from components import stats_framework
 
 
 class GlobalConfig(config.GlobalConfig):
@@ -21,6 +22,21 @@ class GlobalConfig(config.GlobalConfig):
   # The amount of time that has to pass before a machine is considered dead.
   bot_death_timeout_secs = ndb.IntegerProperty(default=10*60)
 
+  # Maximum priority difference with the next task in the queue for a task
+  # using a cache the bot already holds to be run first.
+  cache_affinity_priority_window = ndb.IntegerProperty(
+      indexed=False, default=0)
+
+  # Minimum interval in seconds between two task updates of a bot, advertised
+  # in the task_update replies. Raise it to shed load when the tasks are noisy.
+  # 0 lets the bots decide.
+  bot_update_interval_secs = ndb.IntegerProperty(indexed=False, default=0)
+
+  # Source of the statistics entries, one of stats_framework.BACKENDS. See
+  # stats_framework for the trade offs.
+  stats_backend = ndb.StringProperty(
+      indexed=False, choices=stats_framework.BACKENDS, default='logs')
+
 
 def settings(fresh=False):
   """Loads GlobalConfig or a default one if not present.
@@ -17,22 +17,98 @@ from google.appengine.ext import ndb
 from components import decorators
 from components import stats_framework
 from components import utils
+from server import config
 from server import task_pack
-from server import task_to_run
+
+
+# Percentiles exposed for the latency histograms.
+_PERCENTILES = (50, 90, 99)
+
+
+def _histograms_to_dict(pending_ms_histogram, runtime_ms_histogram):
+  """Returns the percentiles of the latency histograms to add to to_dict()."""
+  out = {}
+  for p in _PERCENTILES:
+    out['tasks_pending_secs_p%d' % p] = stats_framework.histogram_percentile(
+        pending_ms_histogram, p)
+    out['tasks_runtime_secs_p%d' % p] = stats_framework.histogram_percentile(
+        runtime_ms_histogram, p)
+  return out
 
 
 ### Models
 
 
+class _ReapStatsBase(ndb.Model):
+  """Statistics of the bots looking for a task to reap, meant to be subclassed.
+
+  They are returned by task_scheduler.bot_reap_task() and logged in the
+  'bot_active' entry of the poll. They help to find reaping efficiency
+  regressions. The scan_* counters are the ones of task_to_run.SCAN_COUNTERS.
+  """
+  # Number of bot polls that looked for a task.
+  reap_polls = ndb.IntegerProperty(default=0)
+  # Number of bot polls that reaped a task.
+  reap_reaped = ndb.IntegerProperty(default=0)
+  # Tasks that were reaped by another bot first.
+  reap_failures = ndb.IntegerProperty(default=0)
+  # Tasks skipped to jump ahead in the queue after failures.
+  reap_skipped = ndb.IntegerProperty(default=0)
+
+  scan_total = ndb.IntegerProperty(default=0)
+  scan_broken = ndb.IntegerProperty(default=0)
+  scan_hash_mismatch = ndb.IntegerProperty(default=0)
+  scan_cache_negative = ndb.IntegerProperty(default=0)
+  scan_no_queue = ndb.IntegerProperty(default=0)
+  scan_expired = ndb.IntegerProperty(default=0)
+  scan_dimensions_mismatch = ndb.IntegerProperty(default=0)
+  scan_yielded = ndb.IntegerProperty(default=0)
+
+  # Latency histogram of the scans, see stats_framework.histogram_add().
+  scan_ms_histogram = ndb.IntegerProperty(repeated=True)
+
+  def add_reap(self, extras):
+    """Adds the reaping statistics of a 'bot_active' entry."""
+    self.reap_polls += 1
+    self.reap_reaped += extras['reaped']
+    self.reap_failures += extras['failures']
+    self.reap_skipped += extras['skipped']
+    for key, value in extras['counters'].iteritems():
+      name = 'scan_' + key
+      if name not in _ReapStatsBase._properties or name == 'scan_ms_histogram':
+        raise ValueError('Unknown scan counter %s' % key)
+      setattr(self, name, getattr(self, name) + value)
+    stats_framework.histogram_add(
+        self.scan_ms_histogram, float(extras['scan_ms']))
+
+  def accumulate_reap(self, rhs):
+    """Adds the reaping statistics of rhs into self."""
+    # pylint: disable=W0212
+    for name in _ReapStatsBase._properties:
+      if name != 'scan_ms_histogram':
+        setattr(self, name, getattr(self, name) + getattr(rhs, name))
+    self.scan_ms_histogram = stats_framework.histogram_merge(
+        self.scan_ms_histogram, rhs.scan_ms_histogram)
+
+  def reap_to_dict(self):
+    """Returns the reaping statistics to add to to_dict()."""
+    # pylint: disable=W0212
+    out = {
+      name: getattr(self, name) for name in _ReapStatsBase._properties
+      if name != 'scan_ms_histogram'
+    }
+    for p in _PERCENTILES:
+      out['scan_secs_p%d' % p] = stats_framework.histogram_percentile(
+          self.scan_ms_histogram, p)
+    return out
+
+
 class _SnapshotBucketBase(ndb.Model):
   """Statistics for a specific bucket, meant to be subclassed.
 
   TODO(maruel): Add data about the runs (TaskRunResult), which will be higher
   than the number of tasks (TaskResultSummary) in case of retries. Until
   implemented, both values will match.
-
-  TODO(maruel): Use sampling to get median, average, 95%, 99%, 99.9% instead of
-  the raw sum for a few values. The average is not much representative.
   """
   tasks_enqueued = ndb.IntegerProperty(default=0)
 
@@ -48,10 +124,19 @@ class _SnapshotBucketBase(ndb.Model):
   tasks_completed = ndb.IntegerProperty(default=0)
   tasks_completed = ndb.IntegerProperty(default=0)
   tasks_total_runtime_secs = ndb.FloatProperty(default=0)
+  # Time spent by the bots on completed tasks outside of the command itself,
+  # e.g. downloading the data and uploading the output.
+  tasks_bot_overhead_secs = ndb.FloatProperty(default=0)
 
   tasks_bot_died = ndb.IntegerProperty(default=0)
   tasks_request_expired = ndb.IntegerProperty(default=0)
 
+  # Latency histograms of the started and completed tasks, see
+  # stats_framework.histogram_add(). Unlike the averages, they can be merged to
+  # compute the percentiles at every resolution.
+  tasks_pending_ms_histogram = ndb.IntegerProperty(repeated=True)
+  tasks_runtime_ms_histogram = ndb.IntegerProperty(repeated=True)
+
   @property
   def tasks_avg_pending_secs(self):
     if self.tasks_started:
@@ -65,10 +150,24 @@ class _SnapshotBucketBase(ndb.Model):
           self.tasks_total_runtime_secs / float(self.tasks_completed), 3)
     return 0.
 
+  def accumulate_histograms(self, rhs):
+    """Merges the latency histograms of rhs into self.
+
+    stats_framework.accumulate() can't handle repeated properties.
+    """
+    self.tasks_pending_ms_histogram = stats_framework.histogram_merge(
+        self.tasks_pending_ms_histogram, rhs.tasks_pending_ms_histogram)
+    self.tasks_runtime_ms_histogram = stats_framework.histogram_merge(
+        self.tasks_runtime_ms_histogram, rhs.tasks_runtime_ms_histogram)
+
   def to_dict(self):
     out = super(_SnapshotBucketBase, self).to_dict()
     out['tasks_avg_pending_secs'] = self.tasks_avg_pending_secs
     out['tasks_avg_runtime_secs'] = self.tasks_avg_runtime_secs
+    out.update(
+        _histograms_to_dict(
+            out.pop('tasks_pending_ms_histogram'),
+            out.pop('tasks_runtime_ms_histogram')))
     return out
 
 
@@ -81,11 +180,17 @@ class _SnapshotForUser(_SnapshotBucketBase):
 
   def accumulate(self, rhs):
     assert self.user == rhs.user
-    stats_framework.accumulate(self, rhs, ['user'])
+    stats_framework.accumulate(
+        self, rhs,
+        ['tasks_pending_ms_histogram', 'tasks_runtime_ms_histogram', 'user'])
+    self.accumulate_histograms(rhs)
+
 
+class _SnapshotForDimensions(_SnapshotBucketBase, _ReapStatsBase):
+  """Statistics for a specific bucket of TaskRequest.properties.dimensions.
 
-class _SnapshotForDimensions(_SnapshotBucketBase):
-  """Statistics for a specific bucket of TaskRequest.properties.dimensions."""
+  The reaping statistics are the ones of the bots matching these dimensions.
+  """
   # Dimensions are saved as json encoded. JSONProperty is not used so it is
   # easier to compare and sort entries containing dicts.
   dimensions = ndb.StringProperty()
@@ -109,7 +214,14 @@ class _SnapshotForDimensions(_SnapshotBucketBase):
   def accumulate(self, rhs):
     assert self.dimensions == rhs.dimensions
     stats_framework.accumulate(
-        self, rhs, ['bot_ids', 'bot_ids_bad', 'dimensions'])
+        self, rhs,
+        [
+          'bot_ids', 'bot_ids_bad', 'dimensions', 'scan_ms_histogram',
+          'tasks_pending_ms_histogram', 'tasks_runtime_ms_histogram',
+        ])
+    self.accumulate_histograms(rhs)
+    self.scan_ms_histogram = stats_framework.histogram_merge(
+        self.scan_ms_histogram, rhs.scan_ms_histogram)
     self.bot_ids = sorted(set(self.bot_ids) | set(rhs.bot_ids))
     self.bot_ids_bad = sorted(set(self.bot_ids_bad) | set(rhs.bot_ids_bad))
 
@@ -119,10 +231,12 @@ class _SnapshotForDimensions(_SnapshotBucketBase):
     out['bots_inactive'] = self.bots_inactive
     del out['bot_ids']
     del out['bot_ids_bad']
+    del out['scan_ms_histogram']
+    out.update(self.reap_to_dict())
     return out
 
 
-class _Snapshot(ndb.Model):
+class _Snapshot(_ReapStatsBase):
   """A snapshot of statistics for the specific time frame.
 
   It has references to _SnapshotForDimensions which holds the
@@ -184,6 +298,10 @@ class _Snapshot(ndb.Model):
   def tasks_total_runtime_secs(self):
     return sum(i.tasks_total_runtime_secs for i in self.buckets)
 
+  @property
+  def tasks_bot_overhead_secs(self):
+    return sum(i.tasks_bot_overhead_secs for i in self.buckets)
+
   @property
   def tasks_bot_died(self):
     return sum(i.tasks_bot_died for i in self.buckets)
@@ -214,6 +332,18 @@ class _Snapshot(ndb.Model):
       return round(runtime_secs / float(completed), 3)
     return 0.
 
+  @property
+  def tasks_pending_ms_histogram(self):
+    return reduce(
+        stats_framework.histogram_merge,
+        (i.tasks_pending_ms_histogram for i in self.buckets), [])
+
+  @property
+  def tasks_runtime_ms_histogram(self):
+    return reduce(
+        stats_framework.histogram_merge,
+        (i.tasks_runtime_ms_histogram for i in self.buckets), [])
+
   def get_dimensions(self, dimensions_json):
     """Returns a _SnapshotForDimensions instance for this dimensions key.
 
@@ -252,7 +382,10 @@ class _Snapshot(ndb.Model):
   def accumulate(self, rhs):
     """Accumulates data from rhs into self."""
     stats_framework.accumulate(
-        self, rhs, ['bot_ids', 'bot_ids_bad', 'buckets', 'users'])
+        self, rhs,
+        ['bot_ids', 'bot_ids_bad', 'buckets', 'scan_ms_histogram', 'users'])
+    self.scan_ms_histogram = stats_framework.histogram_merge(
+        self.scan_ms_histogram, rhs.scan_ms_histogram)
     self.bot_ids = sorted(set(self.bot_ids) | set(rhs.bot_ids))
     self.bot_ids_bad = sorted(set(self.bot_ids_bad) | set(rhs.bot_ids_bad))
     lhs_dimensions = dict((i.dimensions, i) for i in self.buckets)
@@ -275,14 +408,16 @@ class _Snapshot(ndb.Model):
         # Make a copy of the right hand side so no aliasing occurs.
         lhs_users[key] = rhs_users[key].__class__()
         # Call the root method directly so 'enhancements' do not get in the way.
-        lhs_users[key].populate(**ndb.Model.to_dict(lhs_users[key]))
+        lhs_users[key].populate(**ndb.Model.to_dict(rhs_users[key]))
       else:
         lhs_users[key].accumulate(rhs_users[key])
     self.users = sorted(lhs_users.itervalues(), key=lambda i: i.user)
 
   def to_dict(self):
     """Returns the summary only, not the buckets."""
-    return {
+    out = _histograms_to_dict(
+        self.tasks_pending_ms_histogram, self.tasks_runtime_ms_histogram)
+    out.update({
       'bots_active': self.bots_active,
       'bots_inactive': self.bots_inactive,
       'http_failures': self.http_failures,
@@ -291,13 +426,16 @@ class _Snapshot(ndb.Model):
       'tasks_avg_pending_secs': self.tasks_avg_pending_secs,
       'tasks_avg_runtime_secs': self.tasks_avg_runtime_secs,
       'tasks_bot_died': self.tasks_bot_died,
+      'tasks_bot_overhead_secs': self.tasks_bot_overhead_secs,
       'tasks_completed': self.tasks_completed,
       'tasks_enqueued': self.tasks_enqueued,
       'tasks_pending_secs': self.tasks_pending_secs,
       'tasks_request_expired': self.tasks_request_expired,
       'tasks_started': self.tasks_started,
       'tasks_total_runtime_secs': self.tasks_total_runtime_secs,
-    }
+    })
+    out.update(self.reap_to_dict())
+    return out
 
 
 ### Utility
@@ -325,10 +463,16 @@ _VALID_ACTIONS = frozenset(
 _KEY_MAPPING = {
   'action': 'a',
   'bot_id': 'bid',
+  'bot_overhead_ms': 'bom',
+  'counters': 'c',
   'dimensions': 'd',
+  'failures': 'f',
   'pending_ms': 'pms',
+  'reaped': 'r',
   'run_id': 'rid',
   'runtime_ms': 'rms',
+  'scan_ms': 'sms',
+  'skipped': 's',
   'task_id': 'tid',
   'user': 'u',
 }
@@ -385,7 +529,8 @@ def _unpack_entry(line):
   return {_REVERSE_KEY_MAPPING[k]: v for k, v in json.loads(line).iteritems()}
 
 
-def _parse_line(line, values, bots_active, bots_inactive, tasks_active):
+def _parse_line(
+    line, values, bots_active, bots_inactive, tasks_active, bots_reaping):
   """Updates a Snapshot instance with a processed statistics line if relevant.
 
   This function is a big switch case, so while it is long and will get longer,
@@ -402,9 +547,10 @@ def _parse_line(line, values, bots_active, bots_inactive, tasks_active):
 
     # Preemptively reduce copy-paste.
     d = None
-    if 'dimensions' in extras and action not in ('bot_active', 'bot_inactive'):
-      # Skip bot_active because we don't want complex dimensions to be created
-      # implicitly.
+    if 'dimensions' in extras and action not in (
+        'bot_active', 'bot_inactive'):
+      # Skip the bot actions because we don't want complex dimensions to be
+      # created implicitly.
       dimensions_json = utils.encode_to_json(extras['dimensions'])
       d = values.get_dimensions(dimensions_json)
     u = None
@@ -413,7 +559,22 @@ def _parse_line(line, values, bots_active, bots_inactive, tasks_active):
 
     # Please keep 'action == 'foo' conditions sorted!
     if action == 'bot_active':
-      if sorted(extras) != ['bot_id', 'dimensions']:
+      # The reaping statistics are only present when the bot looked for a task.
+      if 'reaped' in extras:
+        _assert_list(
+            extras,
+            [
+              'bot_id', 'counters', 'dimensions', 'failures', 'reaped',
+              'scan_ms', 'skipped',
+            ])
+        values.add_reap(extras)
+        # Aggregated per bot dimensions, they are added to the matching buckets
+        # in _post_process().
+        dimensions_json = utils.encode_to_json(extras['dimensions'])
+        if dimensions_json not in bots_reaping:
+          bots_reaping[dimensions_json] = _ReapStatsBase()
+        bots_reaping[dimensions_json].add_reap(extras)
+      elif sorted(extras) != ['bot_id', 'dimensions']:
         raise ValueError(','.join(sorted(extras)))
 
       bots_active[extras['bot_id']] = extras['dimensions']
@@ -433,13 +594,21 @@ def _parse_line(line, values, bots_active, bots_inactive, tasks_active):
       return True
 
     if action == 'run_completed':
+      # bot_overhead_ms is optional, older bots do not report it.
+      bot_overhead_secs = _ms_to_secs(extras.pop('bot_overhead_ms', 0))
       _assert_list(
           extras, ['bot_id', 'dimensions', 'run_id', 'runtime_ms', 'user'])
       _mark_bot_and_task_as_active(extras, bots_active, tasks_active)
       d.tasks_completed += 1
       d.tasks_total_runtime_secs += _ms_to_secs(extras['runtime_ms'])
+      d.tasks_bot_overhead_secs += bot_overhead_secs
+      stats_framework.histogram_add(
+          d.tasks_runtime_ms_histogram, float(extras['runtime_ms']))
       u.tasks_completed += 1
       u.tasks_total_runtime_secs += _ms_to_secs(extras['runtime_ms'])
+      u.tasks_bot_overhead_secs += bot_overhead_secs
+      stats_framework.histogram_add(
+          u.tasks_runtime_ms_histogram, float(extras['runtime_ms']))
       return True
 
     if action == 'run_started':
@@ -448,8 +617,12 @@ def _parse_line(line, values, bots_active, bots_inactive, tasks_active):
       _mark_bot_and_task_as_active(extras, bots_active, tasks_active)
       d.tasks_started += 1
       d.tasks_pending_secs += _ms_to_secs(extras['pending_ms'])
+      stats_framework.histogram_add(
+          d.tasks_pending_ms_histogram, float(extras['pending_ms']))
       u.tasks_started += 1
       u.tasks_pending_secs += _ms_to_secs(extras['pending_ms'])
+      stats_framework.histogram_add(
+          u.tasks_pending_ms_histogram, float(extras['pending_ms']))
       return True
 
     if action == 'run_updated':
@@ -488,40 +661,93 @@ def _parse_line(line, values, bots_active, bots_inactive, tasks_active):
     return False
 
 
-def _post_process(snapshot, bots_active, bots_inactive, tasks_active):
+class _BucketIndex(object):
+  """Inverted index of the dimensions requirements of buckets.
+
+  Finds the buckets a bot matches in time proportional to the number of
+  (key, value) pairs of the bot instead of the number of buckets. The result
+  is the same as task_to_run.match_dimensions().
+  """
+  def __init__(self, buckets):
+    # Requirement (key, json encoded value) -> indexes of the buckets requiring
+    # it. The values are json encoded since they may not be hashable.
+    self._index = {}
+    # Number of requirements of each bucket.
+    self._requirements = []
+    # Buckets without requirement, they match all the bots.
+    self._match_all = []
+    for i, bucket in enumerate(buckets):
+      requirements = json.loads(bucket.dimensions)
+      self._requirements.append(len(requirements))
+      if not requirements:
+        self._match_all.append(i)
+      for key, value in requirements.iteritems():
+        self._index.setdefault((key, utils.encode_to_json(value)), []).append(i)
+
+  def get_matches(self, bot_dimensions):
+    """Returns the indexes of the buckets these bot dimensions satisfy."""
+    pairs = set()
+    for key, value in bot_dimensions.iteritems():
+      if isinstance(value, (list, tuple)):
+        pairs.update((key, utils.encode_to_json(v)) for v in value)
+      else:
+        pairs.add((key, utils.encode_to_json(value)))
+    counts = {}
+    for pair in pairs:
+      for i in self._index.get(pair, ()):
+        counts[i] = counts.get(i, 0) + 1
+    matches = [i for i, c in counts.iteritems() if c == self._requirements[i]]
+    return matches + self._match_all
+
+
+def _post_process(
+    snapshot, bots_active, bots_inactive, tasks_active, bots_reaping):
   """Completes the _Snapshot instance with additional data."""
   for dimensions_json, tasks in tasks_active.iteritems():
     snapshot.get_dimensions(dimensions_json).tasks_active = len(tasks)
 
   snapshot.bot_ids = sorted(bots_active)
   snapshot.bot_ids_bad = sorted(bots_inactive)
-  for bot_id, dimensions in bots_active.iteritems():
-    # Looks at the current buckets, do not create one.
-    for bucket in snapshot.buckets:
-      # If this bot matches these dimensions, mark it as a member of this group.
-      if task_to_run.match_dimensions(
-          json.loads(bucket.dimensions), dimensions):
-        # This bot could be used for requests on this dimensions filter.
-        if not bot_id in bucket.bot_ids:
-          bucket.bot_ids.append(bot_id)
-          bucket.bot_ids.sort()
 
+  # Looks at the current buckets, do not create one. If a bot matches the
+  # dimensions of a bucket, it could be used for requests on this dimensions
+  # filter so mark it as a member of this group.
+  index = _BucketIndex(snapshot.buckets)
+  bot_ids = [set(b.bot_ids) for b in snapshot.buckets]
+  for bot_id, dimensions in bots_active.iteritems():
+    for i in index.get_matches(dimensions):
+      bot_ids[i].add(bot_id)
+  bot_ids_bad = [set(b.bot_ids_bad) for b in snapshot.buckets]
   for bot_id, dimensions in bots_inactive.iteritems():
-    # Looks at the current buckets, do not create one.
-    for bucket in snapshot.buckets:
-      # If this bot matches these dimensions, mark it as a member of this group.
-      if task_to_run.match_dimensions(
-          json.loads(bucket.dimensions), dimensions):
-        # This bot could be used for requests on this dimensions filter.
-        if not bot_id in bucket.bot_ids_bad:
-          bucket.bot_ids_bad.append(bot_id)
-          bucket.bot_ids_bad.sort()
+    for i in index.get_matches(dimensions):
+      bot_ids_bad[i].add(bot_id)
+
+  for i, bucket in enumerate(snapshot.buckets):
+    bucket.bot_ids = sorted(bot_ids[i])
+    bucket.bot_ids_bad = sorted(bot_ids_bad[i])
+
+  for dimensions_json, reap in bots_reaping.iteritems():
+    for i in index.get_matches(json.loads(dimensions_json)):
+      snapshot.buckets[i].accumulate_reap(reap)
+
+
+def _is_buffered():
+  """Returns True if the entries are buffered in memcache instead of logged."""
+  return config.settings().stats_backend == 'memcache'
+
+
+def _yield_entries(start_time, end_time):
+  """Yields the stats_framework.StatsEntry from the configured backend."""
+  if _is_buffered():
+    return stats_framework.yield_buffered_entries(start_time, end_time)
+  return stats_framework.yield_entries(start_time, end_time)
 
 
 def _extract_snapshot_from_logs(start_time, end_time):
   """Returns a _Snapshot from the processed logs for the specified interval.
 
-  The data is retrieved from logservice via stats_framework.
+  The data is retrieved from logservice or from the memcache buffers via
+  stats_framework, depending on config.settings().stats_backend.
   """
   snapshot = _Snapshot()
   total_lines = 0
@@ -529,19 +755,25 @@ def _extract_snapshot_from_logs(start_time, end_time):
   bots_active = {}
   bots_inactive = {}
   tasks_active = {}
+  bots_reaping = {}
 
-  for entry in stats_framework.yield_entries(start_time, end_time):
-    snapshot.http_requests += 1
-    if entry.request.status >= 500:
-      snapshot.http_failures += 1
+  for entry in _yield_entries(start_time, end_time):
+    # The entries buffered with the 'memcache' backend are not associated to a
+    # HTTP request, the requests are yielded on their own.
+    if entry.request:
+      snapshot.http_requests += 1
+      if entry.request.status >= 500:
+        snapshot.http_failures += 1
 
     for l in entry.entries:
-      if _parse_line(l, snapshot, bots_active, bots_inactive, tasks_active):
+      if _parse_line(
+          l, snapshot, bots_active, bots_inactive, tasks_active, bots_reaping):
         total_lines += 1
       else:
         parse_errors += 1
 
-  _post_process(snapshot, bots_active, bots_inactive, tasks_active)
+  _post_process(
+      snapshot, bots_active, bots_inactive, tasks_active, bots_reaping)
   logging.debug(
       '_extract_snapshot_from_logs(%s, %s): %d lines, %d errors',
       start_time, end_time, total_lines, parse_errors)
@@ -552,12 +784,23 @@ def _extract_snapshot_from_logs(start_time, end_time):
 
 
 STATS_HANDLER = stats_framework.StatisticsFramework(
-    'global_stats', _Snapshot, _extract_snapshot_from_logs)
+    'global_stats', _Snapshot, _extract_snapshot_from_logs,
+    max_parallel_minutes=10)
+
+
+def wsgi_middleware(app):
+  """Returns the WSGI application counting the HTTP requests when the entries
+  are buffered in memcache.
+  """
+  return stats_framework.buffered_requests_wsgi_middleware(app, _is_buffered)
 
 
 def add_entry(**kwargs):
   """Formatted statistics log entry so it can be processed for statistics."""
-  stats_framework.add_entry(_pack_entry(**kwargs))
+  if _is_buffered():
+    stats_framework.add_buffered_entry(_pack_entry(**kwargs))
+  else:
+    stats_framework.add_entry(_pack_entry(**kwargs))
 
 
 def add_run_entry(action, run_result_key, **kwargs):
@@ -582,7 +825,11 @@ class InternalStatsUpdateHandler(webapp2.RequestHandler):
   @decorators.require_cronjob
   def get(self):
     self.response.headers['Content-Type'] = 'text/plain'
-    i = STATS_HANDLER.process_next_chunk(stats_framework.TOO_RECENT)
+    if _is_buffered():
+      up_to = stats_framework.TOO_RECENT_BUFFERED
+    else:
+      up_to = stats_framework.TOO_RECENT
+    i = STATS_HANDLER.process_next_chunk(up_to)
     if i is not None:
       msg = 'Processed %d minutes' % i
       logging.info(msg)
@@ -11,6 +11,7 @@ import webapp2
 import template
 from components import auth
 from components import natsort
+from components import profiling
 from components import stats_framework
 from components import stats_framework_gviz
 from components import utils
@@ -39,6 +40,28 @@ class _Dimensions(object):
 
     'tasks_bot_died': ('number', 'Tasks where the bot died'),
     'tasks_request_expired': ('number', 'Tasks requests expired'),
+
+    'tasks_pending_secs_p50': ('number', 'Shard pending time p50 (s)'),
+    'tasks_pending_secs_p90': ('number', 'Shard pending time p90 (s)'),
+    'tasks_pending_secs_p99': ('number', 'Shard pending time p99 (s)'),
+    'tasks_runtime_secs_p50': ('number', 'Shard runtime p50 (s)'),
+    'tasks_runtime_secs_p90': ('number', 'Shard runtime p90 (s)'),
+    'tasks_runtime_secs_p99': ('number', 'Shard runtime p99 (s)'),
+
+    'reap_polls': ('number', 'Bot polls reaping'),
+    'reap_reaped': ('number', 'Bot polls that reaped a task'),
+    'reap_failures': ('number', 'Reaping failures'),
+    'reap_skipped': ('number', 'Tasks skipped after reaping failures'),
+    'scan_total': ('number', 'Tasks scanned'),
+    'scan_expired': ('number', 'Tasks scanned expired'),
+    'scan_no_queue': ('number', 'Tasks scanned already reaped'),
+    'scan_hash_mismatch': ('number', 'Tasks scanned hash mismatch'),
+    'scan_cache_negative': ('number', 'Tasks scanned cache negative'),
+    'scan_dimensions_mismatch': (
+        'number', 'Tasks scanned dimensions mismatch'),
+    'scan_broken': ('number', 'Tasks scanned broken'),
+    'scan_secs_p50': ('number', 'Scan time p50 (s)'),
+    'scan_secs_p99': ('number', 'Scan time p99 (s)'),
   }
 
   # Warning: modifying the order here requires updating cls.TEMPLATE.
@@ -58,6 +81,27 @@ class _Dimensions(object):
 
     'tasks_bot_died',
     'tasks_request_expired',  # 10th element.
+
+    'tasks_pending_secs_p50',
+    'tasks_pending_secs_p90',
+    'tasks_pending_secs_p99',
+    'tasks_runtime_secs_p50',
+    'tasks_runtime_secs_p90',  # 15th element.
+    'tasks_runtime_secs_p99',
+
+    'reap_polls',
+    'reap_reaped',
+    'reap_failures',
+    'reap_skipped',
+    'scan_total',
+    'scan_expired',
+    'scan_no_queue',
+    'scan_hash_mismatch',
+    'scan_cache_negative',
+    'scan_dimensions_mismatch',
+    'scan_broken',
+    'scan_secs_p50',
+    'scan_secs_p99',
   )
 
 
@@ -82,6 +126,28 @@ class _Summary(object):
 
     'tasks_bot_died': ('number', 'Tasks where the bot died'),
     'tasks_request_expired': ('number', 'Tasks requests expired'),
+
+    'tasks_pending_secs_p50': ('number', 'Shard pending time p50 (s)'),
+    'tasks_pending_secs_p90': ('number', 'Shard pending time p90 (s)'),
+    'tasks_pending_secs_p99': ('number', 'Shard pending time p99 (s)'),
+    'tasks_runtime_secs_p50': ('number', 'Shard runtime p50 (s)'),
+    'tasks_runtime_secs_p90': ('number', 'Shard runtime p90 (s)'),
+    'tasks_runtime_secs_p99': ('number', 'Shard runtime p99 (s)'),
+
+    'reap_polls': ('number', 'Bot polls reaping'),
+    'reap_reaped': ('number', 'Bot polls that reaped a task'),
+    'reap_failures': ('number', 'Reaping failures'),
+    'reap_skipped': ('number', 'Tasks skipped after reaping failures'),
+    'scan_total': ('number', 'Tasks scanned'),
+    'scan_expired': ('number', 'Tasks scanned expired'),
+    'scan_no_queue': ('number', 'Tasks scanned already reaped'),
+    'scan_hash_mismatch': ('number', 'Tasks scanned hash mismatch'),
+    'scan_cache_negative': ('number', 'Tasks scanned cache negative'),
+    'scan_dimensions_mismatch': (
+        'number', 'Tasks scanned dimensions mismatch'),
+    'scan_broken': ('number', 'Tasks scanned broken'),
+    'scan_secs_p50': ('number', 'Scan time p50 (s)'),
+    'scan_secs_p99': ('number', 'Scan time p99 (s)'),
   }
 
   # Warning: modifying the order here requires updating cls.TEMPLATE.
@@ -103,6 +169,27 @@ class _Summary(object):
 
     'tasks_bot_died',
     'tasks_request_expired',
+
+    'tasks_pending_secs_p50',  # 13th element.
+    'tasks_pending_secs_p90',
+    'tasks_pending_secs_p99',  # 15th element.
+    'tasks_runtime_secs_p50',
+    'tasks_runtime_secs_p90',
+    'tasks_runtime_secs_p99',
+
+    'reap_polls',
+    'reap_reaped',
+    'reap_failures',
+    'reap_skipped',
+    'scan_total',
+    'scan_expired',
+    'scan_no_queue',
+    'scan_hash_mismatch',
+    'scan_cache_negative',
+    'scan_dimensions_mismatch',
+    'scan_broken',
+    'scan_secs_p50',
+    'scan_secs_p99',
   )
 
 
@@ -186,6 +273,8 @@ class StatsSummaryHandler(StatsHandlerBase):
 
 
 class StatsGvizHandlerBase(webapp2.RequestHandler):
+  dimensions = None
+
   def send_response(self, res_type_info, resolution):
     if resolution not in stats_framework.RESOLUTIONS:
       self.abort(404)
@@ -193,18 +282,32 @@ class StatsGvizHandlerBase(webapp2.RequestHandler):
     duration = utils.get_request_as_int(
         self.request, 'duration', default=120, min_value=1, max_value=1000)
     now = utils.get_request_as_datetime(self.request, 'now')
+    points = stats_framework_gviz.get_points(self.request)
     description = res_type_info.DESCRIPTION.copy()
     description.update(
         stats_framework_gviz.get_description_key(resolution))
-    stats_data = stats_framework.get_stats(
-        stats.STATS_HANDLER, resolution, now, duration, False)
-    tqx_args = tqx_args = stats_framework_gviz.process_tqx(
+    get_table = lambda: self.get_table(
+        stats_framework.get_stats(
+            stats.STATS_HANDLER, resolution, now, duration, False))
+
+    if self.request.params.get('format') == 'columnar':
+      stats_framework_gviz.get_columnar_json(
+          self.response,
+          get_table,
+          description,
+          res_type_info.ORDER,
+          stats_framework_gviz.get_cache_key(
+              resolution, now, duration, points, self.dimensions or ''),
+          points)
+      return
+
+    tqx_args = stats_framework_gviz.process_tqx(
         self.request.params.get('tqx', ''))
     try:
       stats_framework_gviz.get_json_raw(
           self.request,
           self.response,
-          self.get_table(stats_data),
+          stats_framework_gviz.downsample(get_table(), description, points),
           description,
           res_type_info.ORDER,
           tqx_args)
@@ -222,8 +325,6 @@ class StatsGvizSummaryHandler(StatsGvizHandlerBase):
 
 
 class StatsGvizDimensionsHandler(StatsGvizHandlerBase):
-  dimensions = None
-
   def get(self, dimensions, resolution):
     # Save it for later use in self.process_data().
     self.dimensions = dimensions
@@ -231,3 +332,19 @@ class StatsGvizDimensionsHandler(StatsGvizHandlerBase):
 
   def get_table(self, stats_data):
     return _stats_data_to_dimensions(stats_data, self.dimensions)
+
+
+class StatsProfilingHandler(auth.ApiHandler):
+  """Returns the components.profiling snapshots per route as JSON."""
+
+  @auth.require(acl.is_admin)
+  def get(self, resolution):
+    if resolution not in stats_framework.RESOLUTIONS:
+      self.abort(404)
+    duration = utils.get_request_as_int(
+        self.request, 'duration', default=120, min_value=1, max_value=1000)
+    now = utils.get_request_as_datetime(self.request, 'now')
+    self.send_response(
+        utils.to_json_encodable(
+            stats_framework.get_stats(
+                profiling.STATS_HANDLER, resolution, now, duration, True)))
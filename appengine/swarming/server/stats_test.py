@@ -3,6 +3,9 @@
 # Use of this source code is governed by the Apache v2.0 license that can be
 # found in the LICENSE file.
 
+import calendar
+import datetime
+import json
 import logging
 import os
 import sys
@@ -15,7 +18,10 @@ import test_env
 
 test_env.setup_test_env()
 
+from components import stats_framework
+from server import config
 from server import stats
+from server import task_to_run
 from support import test_case
 
 
@@ -34,8 +40,15 @@ class StatsPrivateTest(test_case.TestCase):
     # - 300 expired
     # - 402 is running on host4
     data = (
-      stats._pack_entry(action='bot_active', bot_id='host3', dimensions={}),
       stats._pack_entry(action='bot_inactive', bot_id='failed1', dimensions={}),
+      stats._pack_entry(
+          action='bot_active', bot_id='host3', dimensions={'id': 'host3'},
+          counters={
+            'broken': 0, 'cache_negative': 1, 'dimensions_mismatch': 0,
+            'expired': 0, 'hash_mismatch': 1, 'no_queue': 0, 'total': 5,
+            'yielded': 3,
+          },
+          failures=2, reaped=1, scan_ms=30, skipped=1),
 
       stats._pack_entry(
           action='task_enqueued', task_id='100', dimensions={}, user='me'),
@@ -44,7 +57,7 @@ class StatsPrivateTest(test_case.TestCase):
           dimensions={}, pending_ms=1500, user='me'),
       stats._pack_entry(
           action='run_completed', run_id='101', bot_id='host2',
-          dimensions={}, runtime_ms=6000, user='me'),
+          dimensions={}, runtime_ms=6000, user='me', bot_overhead_ms=500),
       stats._pack_entry(
           action='task_completed', task_id='100',
           dimensions={}, pending_ms=6000, user='me'),
@@ -68,12 +81,15 @@ class StatsPrivateTest(test_case.TestCase):
     bots_active = {}
     bots_inactive = {}
     tasks_active = {}
+    bots_reaping = {}
     for line in data:
       actual = stats._parse_line(
-          line, snapshot, bots_active, bots_inactive, tasks_active)
+          line, snapshot, bots_active, bots_inactive, tasks_active,
+          bots_reaping)
       self.assertIs(True, actual, line)
 
-    stats._post_process(snapshot, bots_active, bots_inactive, tasks_active)
+    stats._post_process(
+        snapshot, bots_active, bots_inactive, tasks_active, bots_reaping)
     return snapshot
 
   def test_parse_summary(self):
@@ -83,15 +99,37 @@ class StatsPrivateTest(test_case.TestCase):
       'bots_inactive': 1,
       'http_failures': 0,
       'http_requests': 0,
+      'reap_failures': 2,
+      'reap_polls': 1,
+      'reap_reaped': 1,
+      'reap_skipped': 1,
+      'scan_broken': 0,
+      'scan_cache_negative': 1,
+      'scan_dimensions_mismatch': 0,
+      'scan_expired': 0,
+      'scan_hash_mismatch': 1,
+      'scan_no_queue': 0,
+      'scan_secs_p50': 0.029,
+      'scan_secs_p90': 0.029,
+      'scan_secs_p99': 0.029,
+      'scan_total': 5,
+      'scan_yielded': 3,
       'tasks_active': 2,
       'tasks_avg_pending_secs': 1.5,
       'tasks_avg_runtime_secs': 6.0,
       'tasks_bot_died': 1,
+      'tasks_bot_overhead_secs': 0.5,
       'tasks_completed': 1,
       'tasks_enqueued': 1,
       'tasks_pending_secs': 1.5,
+      'tasks_pending_secs_p50': 1.61,
+      'tasks_pending_secs_p90': 1.61,
+      'tasks_pending_secs_p99': 1.61,
       'tasks_request_expired': 1,
       'tasks_total_runtime_secs': 6.0,
+      'tasks_runtime_secs_p50': 5.769,
+      'tasks_runtime_secs_p90': 5.769,
+      'tasks_runtime_secs_p99': 5.769,
       'tasks_started': 1,
     }
     self.assertEqual(expected, snapshot.to_dict())
@@ -104,30 +142,74 @@ class StatsPrivateTest(test_case.TestCase):
         'bots_active': 0,
         'bots_inactive': 0,
         'dimensions': '{"os":"Amiga"}',
+        'reap_failures': 0,
+        'reap_polls': 0,
+        'reap_reaped': 0,
+        'reap_skipped': 0,
+        'scan_broken': 0,
+        'scan_cache_negative': 0,
+        'scan_dimensions_mismatch': 0,
+        'scan_expired': 0,
+        'scan_hash_mismatch': 0,
+        'scan_no_queue': 0,
+        'scan_secs_p50': 0.,
+        'scan_secs_p90': 0.,
+        'scan_secs_p99': 0.,
+        'scan_total': 0,
+        'scan_yielded': 0,
         'tasks_active': 0,
         'tasks_avg_pending_secs': 0.0,
         'tasks_avg_runtime_secs': 0.0,
         'tasks_bot_died': 1,
+        'tasks_bot_overhead_secs': 0,
         'tasks_completed': 0,
         'tasks_enqueued': 0,
         'tasks_pending_secs': 0,
+        'tasks_pending_secs_p50': 0.,
+        'tasks_pending_secs_p90': 0.,
+        'tasks_pending_secs_p99': 0.,
         'tasks_request_expired': 0,
         'tasks_total_runtime_secs': 0,
+        'tasks_runtime_secs_p50': 0.,
+        'tasks_runtime_secs_p90': 0.,
+        'tasks_runtime_secs_p99': 0.,
         'tasks_started': 0,
       },
       {
         'bots_active': 3,
         'bots_inactive': 1,
         'dimensions': '{}',
+        'reap_failures': 2,
+        'reap_polls': 1,
+        'reap_reaped': 1,
+        'reap_skipped': 1,
+        'scan_broken': 0,
+        'scan_cache_negative': 1,
+        'scan_dimensions_mismatch': 0,
+        'scan_expired': 0,
+        'scan_hash_mismatch': 1,
+        'scan_no_queue': 0,
+        'scan_secs_p50': 0.029,
+        'scan_secs_p90': 0.029,
+        'scan_secs_p99': 0.029,
+        'scan_total': 5,
+        'scan_yielded': 3,
         'tasks_active': 2,
         'tasks_avg_pending_secs': 1.5,
         'tasks_avg_runtime_secs': 6.0,
         'tasks_bot_died': 0,
+        'tasks_bot_overhead_secs': 0.5,
         'tasks_completed': 1,
         'tasks_enqueued': 1,
         'tasks_pending_secs': 1.5,
+        'tasks_pending_secs_p50': 1.61,
+        'tasks_pending_secs_p90': 1.61,
+        'tasks_pending_secs_p99': 1.61,
         'tasks_request_expired': 1,
         'tasks_total_runtime_secs': 6.0,
+        'tasks_runtime_secs_p50': 5.769,
+        'tasks_runtime_secs_p90': 5.769,
+        'tasks_runtime_secs_p99': 5.769,
         'tasks_started': 1,
       },
     ]
@@ -146,11 +228,18 @@ class StatsPrivateTest(test_case.TestCase):
         'tasks_avg_pending_secs': 0.0,
         'tasks_avg_runtime_secs': 0.0,
         'tasks_bot_died': 1,
+        'tasks_bot_overhead_secs': 0,
         'tasks_completed': 0,
         'tasks_enqueued': 0,
         'tasks_pending_secs': 0,
+        'tasks_pending_secs_p50': 0.,
+        'tasks_pending_secs_p90': 0.,
+        'tasks_pending_secs_p99': 0.,
         'tasks_request_expired': 0,
         'tasks_total_runtime_secs': 0,
+        'tasks_runtime_secs_p50': 0.,
+        'tasks_runtime_secs_p90': 0.,
+        'tasks_runtime_secs_p99': 0.,
         'tasks_started': 0,
         'user': u'joe',
       },
@@ -159,11 +248,18 @@ class StatsPrivateTest(test_case.TestCase):
         'tasks_avg_pending_secs': 1.5,
         'tasks_avg_runtime_secs': 6.0,
         'tasks_bot_died': 0,
+        'tasks_bot_overhead_secs': 0.5,
         'tasks_completed': 1,
         'tasks_enqueued': 1,
         'tasks_pending_secs': 1.5,
+        'tasks_pending_secs_p50': 1.61,
+        'tasks_pending_secs_p90': 1.61,
+        'tasks_pending_secs_p99': 1.61,
         'tasks_request_expired': 0,
         'tasks_total_runtime_secs': 6.0,
+        'tasks_runtime_secs_p50': 5.769,
+        'tasks_runtime_secs_p90': 5.769,
+        'tasks_runtime_secs_p99': 5.769,
         'tasks_started': 1,
         'user': u'me',
       },
@@ -172,11 +268,18 @@ class StatsPrivateTest(test_case.TestCase):
         'tasks_avg_pending_secs': 0.0,
         'tasks_avg_runtime_secs': 0.0,
         'tasks_bot_died': 0,
+        'tasks_bot_overhead_secs': 0,
         'tasks_completed': 0,
         'tasks_enqueued': 0,
         'tasks_pending_secs': 0,
+        'tasks_pending_secs_p50': 0.,
+        'tasks_pending_secs_p90': 0.,
+        'tasks_pending_secs_p99': 0.,
         'tasks_request_expired': 1,
         'tasks_total_runtime_secs': 0,
+        'tasks_runtime_secs_p50': 0.,
+        'tasks_runtime_secs_p90': 0.,
+        'tasks_runtime_secs_p99': 0.,
         'tasks_started': 0,
         'user': u'you',
       },
@@ -208,11 +311,14 @@ class StatsPrivateTest(test_case.TestCase):
     bots_active = {}
     bots_inactive = {}
     tasks_active = {}
+    bots_reaping = {}
     for line in data:
       actual = stats._parse_line(
-          line, snapshot, bots_active, bots_inactive, tasks_active)
+          line, snapshot, bots_active, bots_inactive, tasks_active,
+          bots_reaping)
       self.assertEqual(True, actual)
-    stats._post_process(snapshot, bots_active, bots_inactive, tasks_active)
+    stats._post_process(
+        snapshot, bots_active, bots_inactive, tasks_active, bots_reaping)
 
     expected = [
       '{"os":"Linux"}',
@@ -221,6 +327,71 @@ class StatsPrivateTest(test_case.TestCase):
     self.assertEqual(expected, [i.dimensions for i in snapshot.buckets])
     self.assertEqual(0, len(snapshot.users))
 
+  def test_bucket_index(self):
+    requests = [
+      {},
+      {'os': 'Linux'},
+      {'os': 'Linux', 'gpu': 'none'},
+      {'os': 'Windows'},
+      {'os': 'Windows', 'cores': 8},
+      {'pool': ['a']},
+    ]
+    bots = [
+      {},
+      {'os': 'Linux'},
+      {'os': ['Linux', 'Linux-12.04'], 'gpu': 'none'},
+      {'os': ['Windows', 'Windows-7'], 'cores': [4, 8]},
+      {'os': 'Windows', 'cores': 4},
+      {'pool': ['a']},
+    ]
+    snapshot = stats._Snapshot()
+    for r in requests:
+      snapshot.get_dimensions(stats.utils.encode_to_json(r))
+    index = stats._BucketIndex(snapshot.buckets)
+    for bot in bots:
+      expected = [
+        i for i, b in enumerate(snapshot.buckets)
+        if task_to_run.match_dimensions(json.loads(b.dimensions), bot)
+      ]
+      self.assertEqual(expected, sorted(index.get_matches(bot)), bot)
+
+  def test_accumulate_histograms(self):
+    lhs = stats._Snapshot()
+    stats_framework.histogram_add(
+        lhs.get_user('me').tasks_pending_ms_histogram, 1000.)
+    rhs = stats._Snapshot()
+    stats_framework.histogram_add(
+        rhs.get_user('me').tasks_pending_ms_histogram, 1000.)
+    stats_framework.histogram_add(
+        rhs.get_user('joe').tasks_runtime_ms_histogram, 10.)
+    lhs.accumulate(rhs)
+    self.assertEqual(['joe', 'me'], [u.user for u in lhs.users])
+    self.assertEqual(1, sum(lhs.users[0].tasks_runtime_ms_histogram))
+    self.assertEqual(2, sum(lhs.users[1].tasks_pending_ms_histogram))
+
+  def test_extract_snapshot_buffered(self):
+    cfg = config.settings()
+    cfg.stats_backend = 'memcache'
+    cfg.store()
+    self.mock(stats_framework, '_BUFFER', {})
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5)
+    self.mock_now(now)
+    def app(_environ, start_response):
+      stats.add_entry(
+          action='task_enqueued', task_id='100', dimensions={}, user='me')
+      start_response('500 Internal Server Error', [])
+      return ['']
+    stats.wsgi_middleware(app)({}, lambda *_: None)
+    stats_framework.flush_buffered_entries(force=True)
+
+    start = calendar.timegm(now.replace(second=0).timetuple())
+    snapshot = stats._extract_snapshot_from_logs(start, start + 60)
+    self.assertEqual(1, snapshot.to_dict()['tasks_enqueued'])
+    self.assertEqual(1, snapshot.http_requests)
+    self.assertEqual(1, snapshot.http_failures)
+    snapshot = stats._extract_snapshot_from_logs(start + 60, start + 120)
+    self.assertEqual(0, snapshot.to_dict()['tasks_enqueued'])
+
 
 if __name__ == '__main__':
   logging.basicConfig(
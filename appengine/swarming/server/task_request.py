@@ -91,13 +91,52 @@ _REQUIRED_PROPERTIES_KEYS = frozenset(
     ['commands', 'data', 'dimensions', 'env', 'execution_timeout_secs',
      'io_timeout_secs'])
 _EXPECTED_PROPERTIES_KEYS = frozenset(
-    ['commands', 'data', 'dimensions', 'env', 'execution_timeout_secs',
-    'grace_period_secs', 'idempotent', 'io_timeout_secs'])
+    ['caches', 'commands', 'data', 'dimensions', 'env',
+    'execution_timeout_secs', 'grace_period_secs', 'idempotent',
+    'io_timeout_secs'])
+
+
+# Valid named cache name, it is used as a directory name on the bot.
+_CACHE_NAME_RE = re.compile(r'^[a-z0-9_]{1,64}$')
 
 
 ### Properties validators must come before the models.
 
 
+def _validate_caches(prop, value):
+  """Validates TaskProperties.caches and sort them by name."""
+  def check(i):
+    return (
+        isinstance(i, dict) and sorted(i) == ['name', 'path'] and
+        isinstance(i['name'], unicode) and isinstance(i['path'], unicode))
+
+  # pylint: disable=W0212
+  if not all(check(i) for i in value):
+    raise TypeError('%s must be a list of {name, path}' % prop._name)
+  for i in value:
+    if not _CACHE_NAME_RE.match(i['name']):
+      raise datastore_errors.BadValueError(
+          '%s name %r must match %s' %
+          (prop._name, i['name'], _CACHE_NAME_RE.pattern))
+    # Each part must name a directory below the work directory; an empty part
+    # covers a leading, trailing or double /.
+    parts = i['path'].split('/')
+    if '\\' in i['path'] or any(j in ('', '.', '..') for j in parts):
+      raise datastore_errors.BadValueError(
+          '%s path %r must be a relative path using /' %
+          (prop._name, i['path']))
+  if len(set(i['name'] for i in value)) != len(value):
+    raise datastore_errors.BadValueError(
+        '%s names must be unique' % prop._name)
+  # A cache can't be mapped inside another one.
+  paths = sorted(i['path'] + '/' for i in value)
+  for lhs, rhs in zip(paths, paths[1:]):
+    if rhs.startswith(lhs):
+      raise datastore_errors.BadValueError(
+          '%s paths %r and %r overlap' % (prop._name, lhs[:-1], rhs[:-1]))
+  return sorted(value, key=lambda i: i['name'])
+
+
 def _validate_command(prop, value):
   """Validates TaskProperties.command."""
   # pylint: disable=W0212
@@ -238,6 +277,13 @@ class TaskProperties(ndb.Model):
   # task.
   idempotent = ndb.BooleanProperty(default=False)
 
+  # List of {'name', 'path'} of named caches the bot keeps across tasks and
+  # maps at 'path' relative to the task's work directory. A named cache is only
+  # a performance optimization, e.g. to do incremental builds. Encoded as json.
+  # Sorted by name. Optional.
+  caches = datastore_utils.DeterministicJsonProperty(
+      validator=_validate_caches, json_type=list)
+
   @property
   def properties_hash(self):
     """Calculates the hash for this entity IFF the task is idempotent.
@@ -245,12 +291,17 @@ class TaskProperties(ndb.Model):
     It uniquely identifies the TaskProperties instance to permit deduplication
     by the task scheduler. It is None if the task is not idempotent.
 
+    The named caches are not part of the hash since they do not affect the
+    result of the task.
+
     Returns:
       Hash as a compact byte str.
     """
     if not self.idempotent:
       return None
-    return self.HASHING_ALGO(utils.encode_to_json(self)).digest()
+    out = self.to_dict()
+    out.pop('caches')
+    return self.HASHING_ALGO(utils.encode_to_json(out)).digest()
 
 
 class TaskRequest(ndb.Model):
@@ -431,6 +482,7 @@ def make_request(data):
     - name
     - parent_task_id*
     - properties
+      - caches*
       - commands
       - data
       - dimensions
@@ -482,6 +534,7 @@ def make_request(data):
 
   # Class TaskProperties takes care of making everything deterministic.
   properties = TaskProperties(
+      caches=data_properties.get('caches') or [],
       commands=data_properties['commands'],
       data=data_properties['data'],
       dimensions=data_properties['dimensions'],
@@ -167,6 +167,7 @@ class TaskRequestApiTest(TestCase):
         properties=dict(idempotent=True), parent_task_id=parent_id)
     request = task_request.make_request(data)
     expected_properties = {
+      'caches': [],
       'commands': [[u'command1', u'arg1']],
       'data': [
         # Items were sorted.
@@ -244,6 +245,21 @@ class TaskRequestApiTest(TestCase):
         request_2.properties.properties_hash)
     self.assertTrue(request_1.properties.properties_hash)
 
+  def test_make_request_caches(self):
+    caches = [
+      {u'name': u'out', u'path': u'src/out'},
+      {u'name': u'git', u'path': u'git_cache'},
+    ]
+    request = task_request.make_request(
+        _gen_request_data(properties=dict(caches=caches, idempotent=True)))
+    # Items were sorted by name.
+    self.assertEqual(
+        [caches[1], caches[0]], request.to_dict()['properties']['caches'])
+    # The named caches do not affect the deduplication.
+    self.assertEqual(
+        '6ec96bdc40fad2bdaec3cbbe43594961ad72f02e',
+        request.to_dict()['properties_hash'])
+
   def test_different(self):
     # Two TestRequest with different properties.
     request_1 = task_request.make_request(
@@ -301,6 +317,45 @@ class TaskRequestApiTest(TestCase):
     task_request.make_request(
         _gen_request_data(properties=dict(data=[[u'a', u'1']])))
 
+    with self.assertRaises(TypeError):
+      task_request.make_request(
+          _gen_request_data(properties=dict(caches=[[u'a', u'b']])))
+    with self.assertRaises(TypeError):
+      task_request.make_request(
+          _gen_request_data(properties=dict(caches=[{u'name': u'a'}])))
+    with self.assertRaises(datastore_errors.BadValueError):
+      task_request.make_request(
+          _gen_request_data(
+              properties=dict(caches=[{u'name': u'A b', u'path': u'a'}])))
+    with self.assertRaises(datastore_errors.BadValueError):
+      task_request.make_request(
+          _gen_request_data(
+              properties=dict(caches=[{u'name': u'a', u'path': u'../a'}])))
+    for path in (u'/a', u'.', u'a/.', u'a//b', u'a/', u''):
+      with self.assertRaises(datastore_errors.BadValueError):
+        task_request.make_request(
+            _gen_request_data(
+                properties=dict(caches=[{u'name': u'a', u'path': path}])))
+    with self.assertRaises(datastore_errors.BadValueError):
+      task_request.make_request(
+          _gen_request_data(
+              properties=dict(
+                  caches=[
+                    {u'name': u'a', u'path': u'a'},
+                    {u'name': u'b', u'path': u'a/b'},
+                  ])))
+    with self.assertRaises(datastore_errors.BadValueError):
+      task_request.make_request(
+          _gen_request_data(
+              properties=dict(
+                  caches=[
+                    {u'name': u'a', u'path': u'a'},
+                    {u'name': u'a', u'path': u'b'},
+                  ])))
+    task_request.make_request(
+        _gen_request_data(
+            properties=dict(caches=[{u'name': u'git_cache', u'path': u'a/b'}])))
+
     with self.assertRaises(datastore_errors.BadValueError):
       task_request.make_request(
           _gen_request_data(priority=task_request.MAXIMUM_PRIORITY+1))
@@ -336,6 +391,7 @@ class TaskRequestApiTest(TestCase):
     # - idempotent was reset to False.
     # - parent_task_id was reset to None.
     expected_properties = {
+      'caches': [],
       'commands': [[u'command1', u'arg1']],
       'data': [
         # Items were sorted.
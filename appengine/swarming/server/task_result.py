@@ -60,6 +60,7 @@ from google.appengine.api import search
 from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
+from components import datastore_utils
 from components import utils
 from server import task_pack
 from server import task_request
@@ -284,19 +285,12 @@ class _TaskResultCommon(ndb.Model):
 
   @property
   def can_be_canceled(self):
-    """Returns True if the task is in a state that can be canceled."""
-    # TOOD(maruel): To be able to add State.RUNNING, the following must be done:
-    # task_scheduler.cancel_task() must be strictly a transaction relative to
-    # task_scheduler.bot_kill_task() and task_scheduler.bot_update_task().
-    #
-    # The tricky part is to keep this code performant. On the other hand, all
-    # the entities under the transaction (TaskToRun, TaskResultSummary and
-    # TaskRunResult) are under the same entity root, so it's definitely
-    # feasible, likely using a transaction is not a problem in practice. The
-    # important part would be to ensure that TaskOuputChunks are not also stored
-    # as part of the transaction, since they do not need to.
-    # https://code.google.com/p/swarming/issues/detail?id=62
-    return self.state == State.PENDING
+    """Returns True if the task is in a state that can be canceled.
+
+    A RUNNING task is canceled by asking its bot to kill it, see
+    task_scheduler.cancel_task().
+    """
+    return self.state in State.STATES_RUNNING
 
   @property
   def duration(self):
@@ -450,6 +444,15 @@ class TaskRunResult(_TaskResultCommon):
   # Effective cost of this task.
   cost_usd = ndb.FloatProperty(indexed=False, default=0.)
 
+  # Duration in seconds of each phase of the task as measured by the bot, e.g.
+  # 'setup', 'download', 'process_start', 'execution' and 'upload'.
+  bot_timings = datastore_utils.DeterministicJsonProperty(
+      json_type=dict, indexed=False)
+
+  # Set when the task was canceled while running. The bot is told to kill the
+  # task on its next task update and the task ends up as CANCELED.
+  killing = ndb.BooleanProperty(default=False, indexed=False)
+
   # A task run execution can't by definition save any cost.
   cost_saved_usd = None
 
@@ -516,6 +519,10 @@ class TaskRunResult(_TaskResultCommon):
 
   def to_dict(self):
     out = super(TaskRunResult, self).to_dict()
+    # bot_timings is only used for statistics.
+    out.pop('bot_timings')
+    # killing is an implementation detail, the state is eventually CANCELED.
+    out.pop('killing')
     out['try_number'] = self.try_number
     return out
 
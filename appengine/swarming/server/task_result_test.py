@@ -163,6 +163,8 @@ class TaskResultApiTest(TestCase):
     self.assertEqual(50, actual.priority)
     self.assertEqual(True, actual.can_be_canceled)
     actual.state = task_result.State.RUNNING
+    self.assertEqual(True, actual.can_be_canceled)
+    actual.state = task_result.State.COMPLETED
     self.assertEqual(False, actual.can_be_canceled)
 
     actual.children_task_ids = [
@@ -195,7 +197,7 @@ class TaskResultApiTest(TestCase):
     }
     self.assertEqual(expected, actual.to_dict())
     self.assertEqual(50, actual.priority)
-    self.assertEqual(False, actual.can_be_canceled)
+    self.assertEqual(True, actual.can_be_canceled)
 
   def test_integration(self):
     # Creates a TaskRequest, along its TaskResultSummary and TaskToRun. Have a
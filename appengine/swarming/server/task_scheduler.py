@@ -129,15 +129,41 @@ def _reap_task(to_run_key, request, bot_id, bot_version):
   return run_result
 
 
+def _update_reap_stats(reap_stats, start, counters, failures, skipped, reaped):
+  """Saves the efficiency of a bot_reap_task() call in reap_stats."""
+  reap_stats.update(
+      counters=counters,
+      failures=failures,
+      reaped=int(reaped),
+      scan_ms=_secs_to_ms((utils.utcnow() - start).total_seconds()),
+      skipped=skipped)
+
+
+def _bot_overhead_entry(bot_timings):
+  """Returns the stats entry arguments for the bot's own overhead.
+
+  The overhead is everything the bot did for this task beside running the
+  command itself.
+  """
+  if not bot_timings:
+    return {}
+  overhead = sum(
+      v for k, v in bot_timings.iteritems()
+      if k != 'execution' and isinstance(v, (int, float)))
+  return {'bot_overhead_ms': _secs_to_ms(overhead)}
+
+
 def _update_stats(run_result, bot_id, request, completed):
   """Updates stats after a bot task update notification."""
-  if completed:
+  # A task killed on cancellation is not counted as completed.
+  if completed and run_result.state != task_result.State.CANCELED:
     stats.add_run_entry(
         'run_completed', run_result.key,
         bot_id=bot_id,
         dimensions=request.properties.dimensions,
         runtime_ms=_secs_to_ms(run_result.duration.total_seconds()),
-        user=request.user)
+        user=request.user,
+        **_bot_overhead_entry(run_result.bot_timings))
     stats.add_task_entry(
         'task_completed',
         task_pack.request_key_to_result_summary_key(request.key),
@@ -189,7 +215,8 @@ def _handle_dead_bot(run_result_key):
       run_result.internal_failure = True
       run_result.abandoned_ts = now
       result = False
-    elif result_summary.try_number == 1 and now < request.expiration_ts:
+    elif (result_summary.try_number == 1 and now < request.expiration_ts and
+          not run_result.killing):
       # Retry it.
       to_put = (run_result, result_summary, to_run)
       to_run.queue_number = task_to_run.gen_queue_number(request)
@@ -381,18 +408,33 @@ def schedule_request(request):
   return result_summary
 
 
-def bot_reap_task(dimensions, bot_id, bot_version):
+def bot_reap_task(
+    dimensions, bot_id, bot_version, named_caches=None, data_cache=None,
+    reap_stats=None):
   """Reaps a TaskToRun if one is available.
 
   The process is to find a TaskToRun where its .queue_number is set, then
   create a TaskRunResult for it.
 
+  named_caches and data_cache are the caches the bot holds, as reported in its
+  state. The tasks using them are preferred, see
+  task_to_run.yield_next_available_task_to_dispatch().
+
+  reap_stats is an optional dict updated with the efficiency of the call, for
+  the caller to add to the 'bot_active' stats entry of the poll.
+
   Returns:
     tuple of (TaskRequest, TaskRunResult) for the task that was reaped.
     The TaskToRun involved is not returned.
   """
   assert bot_id
-  q = task_to_run.yield_next_available_task_to_dispatch(dimensions)
+  start = utils.utcnow()
+  if reap_stats is None:
+    reap_stats = {}
+  counters = {}
+  q = task_to_run.yield_next_available_task_to_dispatch(
+      dimensions, named_caches, data_cache,
+      config.settings().cache_affinity_priority_window, counters)
   # When a large number of bots try to reap hundreds of tasks simultaneously,
   # they'll constantly fail to call reap_task_to_run() as they'll get preempted
   # by other bots. So randomly jump farther in the queue when the number of
@@ -423,9 +465,8 @@ def bot_reap_task(dimensions, bot_id, bot_version):
         to_skip = min(int(round(random.gammavariate(3, 1))), 30)
       continue
 
-    # Try to optimize these values but do not add as formal stats (yet).
-    logging.info('failed %d, skipped %d', failures, total_skipped)
-
+    _update_reap_stats(
+        reap_stats, start, counters, failures, total_skipped, True)
     pending_time = run_result.started_ts - request.created_ts
     stats.add_run_entry(
         'run_started', run_result.key,
@@ -434,15 +475,15 @@ def bot_reap_task(dimensions, bot_id, bot_version):
         pending_ms=_secs_to_ms(pending_time.total_seconds()),
         user=request.user)
     return request, run_result
-  if failures:
-    logging.info(
-        'Chose nothing (failed %d, skipped %d)', failures, total_skipped)
+  _update_reap_stats(
+      reap_stats, start, counters, failures, total_skipped, False)
   return None, None
 
 
 def bot_update_task(
     run_result_key, bot_id, output, output_chunk_start,
-    exit_code, duration, hard_timeout, io_timeout, cost_usd):
+    exit_code, duration, hard_timeout, io_timeout, cost_usd,
+    bot_timings=None, killed=False):
   """Updates a TaskRunResult and TaskResultSummary, along TaskOutput.
 
   Arguments:
@@ -455,18 +496,25 @@ def bot_update_task(
   - hard_timeout: Bool set if an hard timeout occured.
   - io_timeout: Bool set if an I/O timeout occured.
   - cost_usd: Cost in $USD of this task up to now.
+  - bot_timings: dict of the duration in seconds of each phase of the task as
+        measured by the bot. Only sent along the exit code.
+  - killed: Bool set if the bot killed the task because it was canceled. Only
+        sent along the exit code.
 
   Invalid states, these are flat out refused:
   - A command is updated after it had an exit code assigned to.
 
   Returns:
-    tuple(bool, bool); first is if the update succeeded, second is if the task
-    completed.
+    tuple(bool, bool, bool); first is if the update succeeded, second is if the
+    task completed, third is if the bot must kill the task because it was
+    canceled.
   """
   assert output_chunk_start is None or isinstance(output_chunk_start, int)
   assert output is None or isinstance(output, str)
   if cost_usd is not None and cost_usd < 0.:
     raise ValueError('cost_usd must be None or greater or equal than 0')
+  if bot_timings is not None and not isinstance(bot_timings, dict):
+    raise ValueError('bot_timings must be None or a dict')
 
   result_summary_key = task_pack.run_result_key_to_result_summary_key(
       run_result_key)
@@ -509,11 +557,18 @@ def bot_update_task(
       # The command completed.
       run_result.durations.append(duration)
       run_result.exit_codes.append(exit_code)
+      if bot_timings:
+        run_result.bot_timings = bot_timings
 
     task_completed = (
         len(run_result.exit_codes) == len(request.properties.commands))
     if run_result.state in task_result.State.STATES_RUNNING:
-      if hard_timeout or io_timeout:
+      if run_result.killing and killed and exit_code is not None:
+        # The bot killed the task as requested by cancel_task(). Otherwise the
+        # task completed before the bot got to kill it.
+        run_result.state = task_result.State.CANCELED
+        run_result.abandoned_ts = now
+      elif hard_timeout or io_timeout:
         run_result.state = task_result.State.TIMED_OUT
         run_result.completed_ts = now
       elif task_completed:
@@ -547,13 +602,15 @@ def bot_update_task(
     run_result, task_completed, error = datastore_utils.transaction(run)
   except datastore_utils.CommitError:
     # It is important that the caller correctly surface this error.
-    return False, False
+    return False, False, False
 
+  must_stop = False
   if run_result:
     _update_stats(run_result, bot_id, request, task_completed)
+    must_stop = run_result.killing and not task_completed
   if error:
       logging.error('Task %s %s', packed, error)
-  return True, task_completed
+  return True, task_completed, must_stop
 
 
 def bot_kill_task(run_result_key, bot_id):
@@ -606,7 +663,16 @@ def bot_kill_task(run_result_key, bot_id):
 
 
 def cancel_task(result_summary_key):
-  """Cancels a task if possible."""
+  """Cancels a task if possible.
+
+  A PENDING task is canceled right away. A RUNNING task is flagged as killing;
+  its bot is told to kill it on its next task update, see bot_update_task(),
+  and the task becomes CANCELED once the bot reports the process exit.
+
+  Returns:
+    tuple(bool, bool); first is if the task was canceled, second is if it was
+    running.
+  """
   request_key = task_pack.result_summary_key_to_request_key(result_summary_key)
   to_run_key = task_to_run.request_to_task_to_run_key(request_key.get())
   now = utils.utcnow()
@@ -616,6 +682,15 @@ def cancel_task(result_summary_key):
     was_running = result_summary.state == task_result.State.RUNNING
     if not result_summary.can_be_canceled:
       return False, was_running
+    if was_running:
+      # The run result is in the same entity group.
+      run_result = result_summary.run_result_key.get()
+      if run_result.state != task_result.State.RUNNING:
+        # The summary is stale, this try is being retried or already ended.
+        return False, was_running
+      run_result.killing = True
+      run_result.put()
+      return True, was_running
     to_run.queue_number = None
     result_summary.state = task_result.State.CANCELED
     result_summary.abandoned_ts = now
@@ -114,7 +114,7 @@ class TaskSchedulerApiTest(test_case.TestCase):
 
   def _parse_line(self, line):
     # pylint: disable=W0212
-    actual = stats._parse_line(line, stats._Snapshot(), {}, {}, {})
+    actual = stats._parse_line(line, stats._Snapshot(), {}, {}, {}, {})
     self.assertIs(True, actual, line)
 
   def test_all_apis_are_tested(self):
@@ -143,6 +143,39 @@ class TaskSchedulerApiTest(test_case.TestCase):
     self.assertEqual('localhost', run_result.bot_id)
     self.assertEqual(None, task_to_run.TaskToRun.query().get().queue_number)
 
+  def test_bot_reap_task_stats(self):
+    entries = []
+    def add_entry(line):
+      self._parse_line(line)
+      entries.append(stats._unpack_entry(line))
+    self.mock(stats_framework, 'add_entry', add_entry)
+    bot_dimensions = {u'OS': [u'Windows', u'Windows-3.1.1'], u'foo': u'bar'}
+    reap_stats = {}
+    self.assertEqual(
+        (None, None),
+        task_scheduler.bot_reap_task(
+            bot_dimensions, 'localhost', 'abc', reap_stats=reap_stats))
+    self.assertEqual(0, reap_stats['reaped'])
+    self.assertEqual(0, reap_stats['counters']['total'])
+
+    data = _gen_request_data(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    task_scheduler.schedule_request(task_request.make_request(data))
+    del entries[:]
+    reap_stats = {}
+    task_scheduler.bot_reap_task(
+        bot_dimensions, 'localhost', 'abc', reap_stats=reap_stats)
+    self.assertEqual(1, reap_stats['reaped'])
+    self.assertEqual(0, reap_stats['failures'])
+    self.assertEqual(1, reap_stats['counters']['total'])
+    self.assertEqual(1, reap_stats['counters']['yielded'])
+    # The caller logs them, bot_reap_task() doesn't add an entry of its own.
+    self.assertEqual(['run_started'], [e['action'] for e in entries])
+    self._parse_line(
+        stats._pack_entry(
+            action='bot_active', bot_id='localhost',
+            dimensions=bot_dimensions, **reap_stats))
+
   def test_exponential_backoff(self):
     self.mock(
         task_scheduler.random, 'random',
@@ -190,7 +223,7 @@ class TaskSchedulerApiTest(test_case.TestCase):
     self.assertEqual(None, task_to_run.TaskToRun.query().get().queue_number)
     # It's important to terminate the task with success.
     self.assertEqual(
-        (True, True),
+        (True, True, False),
         task_scheduler.bot_update_task(
             run_result.key, 'localhost', 'Foo1', 0, 0, 0.1, False, False,
             0.1))
@@ -433,12 +466,12 @@ class TaskSchedulerApiTest(test_case.TestCase):
     done_ts = self.now + datetime.timedelta(seconds=120)
     self.mock_now(done_ts)
     self.assertEqual(
-        (True, True),
+        (True, True, False),
         task_scheduler.bot_update_task(
             run_result.key, 'localhost', 'Foo1', 0, 0, 0.1, False, False,
             0.1))
     self.assertEqual(
-        (True, False),
+        (True, False, False),
         task_scheduler.bot_update_task(
         run_result.key, 'localhost', 'Bar22', 0, 0, 0.2, False, False, 0.1))
     result_summary, run_results = get_results(request.key)
@@ -499,7 +532,7 @@ class TaskSchedulerApiTest(test_case.TestCase):
         {'OS': 'Windows-3.1.1'}, 'localhost', 'abc')
     self.assertEqual(request, reaped_request)
     self.assertEqual(
-        (True, True),
+        (True, True, False),
         task_scheduler.bot_update_task(
         run_result.key, 'localhost', 'Foo1', 0, 1, 0.1, False, False, 0.1))
     result_summary, run_results = get_results(request.key)
@@ -562,11 +595,11 @@ class TaskSchedulerApiTest(test_case.TestCase):
   def test_bot_update_task(self):
     run_result = _quick_reap()
     self.assertEqual(
-        (True, True),
+        (True, True, False),
         task_scheduler.bot_update_task(
             run_result.key, 'localhost', 'hi', 0, 0, 0.1, False, False, 0.1))
     self.assertEqual(
-        (True, False),
+        (True, False, False),
         task_scheduler.bot_update_task(
             run_result.key, 'localhost', 'hey', 2, 0, 0.1, False, False,
             0.1))
@@ -575,17 +608,30 @@ class TaskSchedulerApiTest(test_case.TestCase):
   def test_bot_update_task_new_overwrite(self):
     run_result = _quick_reap()
     self.assertEqual(
-        (True, False),
+        (True, False, False),
         task_scheduler.bot_update_task(
             run_result.key, 'localhost', 'hi', 0, None, None, False, False,
             0.1))
     self.assertEqual(
-        (True, False),
+        (True, False, False),
         task_scheduler.bot_update_task(
             run_result.key, 'localhost', 'hey', 1, None, None, False, False,
             0.1))
     self.assertEqual(['hhey'], list(run_result.key.get().get_outputs()))
 
+  def test_bot_update_task_bot_timings(self):
+    run_result = _quick_reap()
+    bot_timings = {'download': 1.5, 'execution': 10., 'upload': 0.5}
+    self.assertEqual(
+        (True, True, False),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', 'hi', 0, 0, 0.1, False, False, 0.1,
+            bot_timings))
+    self.assertEqual(bot_timings, run_result.key.get().bot_timings)
+    self.assertEqual(
+        {'bot_overhead_ms': 2000},
+        task_scheduler._bot_overhead_entry(bot_timings))
+
   def test_bot_update_exception(self):
     run_result = _quick_reap()
     def r(*_):
@@ -593,7 +639,7 @@ class TaskSchedulerApiTest(test_case.TestCase):
 
     self.mock(ndb, 'put_multi', r)
     self.assertEqual(
-        (False, False),
+        (False, False, False),
         task_scheduler.bot_update_task(
             run_result.key, 'localhost', 'hi', 0, 0, 0.1, False, False, 0.1))
 
@@ -606,7 +652,7 @@ class TaskSchedulerApiTest(test_case.TestCase):
     reaped_request, run_result = task_scheduler.bot_reap_task(
         {'OS': 'Windows-3.1.1'}, 'localhost', 'abc')
     self.assertEqual(
-        (True, True),
+        (True, True, False),
         task_scheduler.bot_update_task(
             run_result.key, 'localhost', 'hi', 0, 0, 0.1, hard, io, 0.1))
     expected = {
@@ -750,10 +796,55 @@ class TaskSchedulerApiTest(test_case.TestCase):
     reaped_request, run_result = task_scheduler.bot_reap_task(
         {'OS': 'Windows-3.1.1'}, 'localhost', 'abc')
     ok, was_running = task_scheduler.cancel_task(result_summary.key)
+    self.assertEqual(True, ok)
+    self.assertEqual(True, was_running)
+    # The task is still running until the bot kills it.
+    self.assertEqual(
+        task_result.State.RUNNING, result_summary.key.get().state)
+    self.assertEqual(True, run_result.key.get().killing)
+
+    # The bot is told to kill the task on its next update.
+    self.assertEqual(
+        (True, False, True),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', 'hi', 0, None, None, False, False,
+            0.1))
+    # Then it reports the process exit.
+    self.assertEqual(
+        (True, True, False),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', None, None, -15, 0.1, False, False,
+            0.1, killed=True))
+    result_summary = result_summary.key.get()
+    self.assertEqual(task_result.State.CANCELED, result_summary.state)
+    self.assertEqual(self.now, result_summary.abandoned_ts)
+    self.assertEqual([-15], result_summary.exit_codes)
+
+    # It can't be canceled twice.
+    ok, was_running = task_scheduler.cancel_task(result_summary.key)
     self.assertEqual(False, ok)
+    self.assertEqual(False, was_running)
+
+  def test_cancel_task_running_completed(self):
+    data = _gen_request_data(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    request = task_request.make_request(data)
+    result_summary = task_scheduler.schedule_request(request)
+    reaped_request, run_result = task_scheduler.bot_reap_task(
+        {'OS': 'Windows-3.1.1'}, 'localhost', 'abc')
+    ok, was_running = task_scheduler.cancel_task(result_summary.key)
+    self.assertEqual(True, ok)
     self.assertEqual(True, was_running)
+
+    # The task completed by itself before the bot got to kill it.
+    self.assertEqual(
+        (True, True, False),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', 'hi', 0, 0, 0.1, False, False, 0.1))
     result_summary = result_summary.key.get()
-    self.assertEqual(task_result.State.RUNNING, result_summary.state)
+    self.assertEqual(task_result.State.COMPLETED, result_summary.state)
+    self.assertEqual(self.now, result_summary.completed_ts)
+    self.assertEqual([0], result_summary.exit_codes)
 
   def test_cron_abort_expired_task_to_run(self):
     self.mock(random, 'getrandbits', lambda _: 0x88)
@@ -915,7 +1006,7 @@ class TaskSchedulerApiTest(test_case.TestCase):
     logging.info('%s', [t.to_dict() for t in task_to_run.TaskToRun.query()])
     self.assertEqual(2, run_result.try_number)
     self.assertEqual(
-        (True, True),
+        (True, True, False),
         task_scheduler.bot_update_task(
             run_result.key, 'localhost-second', 'Foo1', 0, 0, 0.1, False, False,
             0.1))
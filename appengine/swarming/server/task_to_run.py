@@ -42,6 +42,26 @@ from server import task_request
 MAX_DIMENSIONS = 16384
 
 
+# Maximum number of tasks held back while looking for a task with cache
+# affinity.
+_AFFINITY_MAX_LOOKAHEAD = 20
+
+
+# Counters of the queue scan done by yield_next_available_task_to_dispatch():
+# - total: TaskToRun keys looked at.
+# - broken: invalid keys.
+# - hash_mismatch: the dimensions hash doesn't match the bot.
+# - cache_negative: the task was recently reaped according to memcache.
+# - no_queue: the task was already reaped, the index was stale.
+# - expired: the task expired.
+# - dimensions_mismatch: the hash matched but not the dimensions.
+# - yielded: tasks yielded to the caller.
+SCAN_COUNTERS = (
+  'total', 'broken', 'hash_mismatch', 'cache_negative', 'no_queue', 'expired',
+  'dimensions_mismatch', 'yielded',
+)
+
+
 class TaskToRun(ndb.Model):
   """Defines a TaskRequest ready to be scheduled on a bot.
 
@@ -187,6 +207,166 @@ def _lookup_cache_is_taken(task_key):
   return bool(memcache.get(key, namespace='task_to_run'))
 
 
+def _has_affinity(request, named_caches, data_cache):
+  """Returns True if the bot already holds a named cache or a data archive used
+  by this task.
+
+  Arguments:
+  - named_caches: set of the named caches names the bot holds.
+  - data_cache: set of the sha1 hex digests of the data archives URLs the bot
+      holds.
+  """
+  for cache in request.properties.caches or []:
+    if cache['name'] in named_caches:
+      return True
+  for url, _ in request.properties.data or []:
+    if hashlib.sha1(url.encode('utf-8')).hexdigest() in data_cache:
+      return True
+  return False
+
+
+def _fetch_task_batch(task_keys, bot_dimensions, now, counters):
+  """Returns the (TaskRequest, TaskToRun) that can be reaped by the bot out of
+  a list of TaskToRun keys.
+
+  The entities are fetched with one ndb.get_multi() for the TaskToRun and one
+  for the TaskRequest.
+  """
+  # Ok, it's now worth taking a real look at the entities. The reason
+  # use_cache=False is otherwise it'll create a buffer bloat.
+  tasks = []
+  for task_key, task in zip(
+      task_keys, ndb.get_multi(task_keys, use_cache=False)):
+    # DB operations are slow, double check memcache again.
+    if _lookup_cache_is_taken(task_key):
+      counters['cache_negative'] += 1
+      continue
+
+    # It is possible for the index to be inconsistent since it is not executed
+    # in a transaction, no problem.
+    if not task or not task.queue_number:
+      counters['no_queue'] += 1
+      continue
+
+    # It expired. A cron job will cancel it eventually. Since 'now' is saved
+    # before the query, an expired task may still be reaped even if
+    # technically expired if the query is very slow. This is on purpose so
+    # slow queries do not cause exagerate expirations.
+    if task.expiration_ts < now:
+      counters['expired'] += 1
+      continue
+    tasks.append(task)
+
+  # The hash may have conflicts. Ensure the dimensions actually match by
+  # verifying the TaskRequest. There's a probability of 2**-31 of conflicts,
+  # which is low enough for our purpose.
+  out = []
+  requests = ndb.get_multi([t.request_key for t in tasks], use_cache=False)
+  for request, task in zip(requests, tasks):
+    if not match_dimensions(request.properties.dimensions, bot_dimensions):
+      counters['dimensions_mismatch'] += 1
+      continue
+    out.append((request, task))
+  return out
+
+
+def _yield_available_task_to_dispatch(bot_dimensions, counters, fetch_size):
+  """Yields next available (TaskRequest, TaskToRun) in decreasing order of
+  priority.
+
+  The entities are fetched fetch_size at a time. See
+  yield_next_available_task_to_dispatch() for details.
+  """
+  # List of all the valid dimensions hashed.
+  accepted_dimensions_hash = frozenset(
+      _hash_dimensions(utils.encode_to_json(i))
+      for i in _powerset(bot_dimensions))
+  now = utils.utcnow()
+  # Be very aggressive in fetching the largest amount of items as possible. Note
+  # that we use the default ndb.EVENTUAL_CONSISTENCY so stale items may be
+  # returned. It's handled specifically.
+  # - 100/200 gives 2s~40s of query time for 1275 items.
+  # - 250/500 gives 2s~50s of query time for 1275 items.
+  # - 50/500 gives 3s~20s of query time for 1275 items. (Slower but less
+  #   variance). Spikes in 20s~40s are rarer.
+  # The problem here are:
+  # - Outliers, some shards are simply slower at executing the query.
+  # - Median time, which we should optimize.
+  # - Abusing batching will slow down this query.
+  #
+  # TODO(maruel): Use fetch_page_async() + ndb.get_multi_async() +
+  # memcache.get_multi_async() to do pipelined processing. Should greatly reduce
+  # the effect of latency on the total duration of this function.
+  opts = ndb.QueryOptions(batch_size=50, prefetch_size=500, keys_only=True)
+  task_keys = []
+  try:
+    # Interestingly, the filter on .queue_number>0 is required otherwise all the
+    # None items are returned first.
+    q = TaskToRun.query(default_options=opts).order(
+        TaskToRun.queue_number).filter(TaskToRun.queue_number > 0)
+    for task_key in itertools.chain(q, [None]):
+      duration = (utils.utcnow() - now).total_seconds()
+      if duration > 40.:
+        # Stop searching after too long, since the odds of the request blowing
+        # up right after succeeding in reaping a task is not worth the dangling
+        # task request that will stay in limbo until the cron job reaps it and
+        # retry it. The current handlers are given 60s to complete. By using
+        # 40s, it gives 20s to complete the reaping and complete the HTTP
+        # request.
+        return
+
+      if task_key:
+        counters['total'] += 1
+        # Verify TaskToRun is what is expected. Play defensive here.
+        try:
+          validate_to_run_key(task_key)
+        except ValueError as e:
+          logging.error(str(e))
+          counters['broken'] += 1
+          continue
+
+        # integer_id() == dimensions_hash.
+        if task_key.integer_id() not in accepted_dimensions_hash:
+          counters['hash_mismatch'] += 1
+          continue
+
+        # Do this after the basic weeding out but before fetching TaskRequest.
+        if _lookup_cache_is_taken(task_key):
+          counters['cache_negative'] += 1
+          continue
+
+        task_keys.append(task_key)
+        if len(task_keys) < fetch_size:
+          continue
+
+      # Either the batch is full or the query is exhausted.
+      batch = []
+      if task_keys:
+        batch = _fetch_task_batch(task_keys, bot_dimensions, now, counters)
+      task_keys = []
+      for request, task in batch:
+        # It's a valid task! Note that in the meantime, another bot may have
+        # reaped it.
+        counters['yielded'] += 1
+        yield request, task
+  finally:
+    duration = (utils.utcnow() - now).total_seconds()
+    logging.info(
+        '%d/%s in %5.2fs: %d total, %d exp %d no_queue, %d hash mismatch, '
+        '%d cache negative, %d dimensions mismatch, %d yielded, %d broken',
+        opts.batch_size,
+        opts.prefetch_size,
+        duration,
+        counters['total'],
+        counters['expired'],
+        counters['no_queue'],
+        counters['hash_mismatch'],
+        counters['cache_negative'],
+        counters['dimensions_mismatch'],
+        counters['yielded'],
+        counters['broken'])
+
+
 ### Public API.
 
 
@@ -289,7 +469,9 @@ def set_lookup_cache(task_key, is_available_to_schedule):
     memcache.set(key, True, time=cache_lifetime, namespace='task_to_run')
 
 
-def yield_next_available_task_to_dispatch(bot_dimensions):
+def yield_next_available_task_to_dispatch(
+    bot_dimensions, named_caches=None, data_cache=None, priority_window=0,
+    counters=None):
   """Yields next available (TaskRequest, TaskToRun) in decreasing order of
   priority.
 
@@ -298,128 +480,56 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
 
   Performance is the top most priority here.
 
+  When the bot holds named caches or data archives, the tasks using them are
+  yielded first as long as their priority is within priority_window of the
+  first task available. This way tasks run where their inputs already exist.
+
   Arguments:
   - bot_dimensions: dimensions (as a dict) defined by the bot that can be
       matched.
+  - named_caches: names of the named caches the bot holds.
+  - data_cache: sha1 hex digests of the data archives URLs the bot holds.
+  - priority_window: maximum priority difference with the first task available
+      for a task with cache affinity to be yielded before it.
+  - counters: optional dict updated with the SCAN_COUNTERS as the queue is
+      scanned, so the caller can read them without exhausting the generator.
   """
-  # List of all the valid dimensions hashed.
-  accepted_dimensions_hash = frozenset(
-      _hash_dimensions(utils.encode_to_json(i))
-      for i in _powerset(bot_dimensions))
-  now = utils.utcnow()
-  broken = 0
-  cache_lookup = 0
-  expired = 0
-  hash_mismatch = 0
-  ignored = 0
-  no_queue = 0
-  real_mismatch = 0
-  total = 0
-  # Be very aggressive in fetching the largest amount of items as possible. Note
-  # that we use the default ndb.EVENTUAL_CONSISTENCY so stale items may be
-  # returned. It's handled specifically.
-  # - 100/200 gives 2s~40s of query time for 1275 items.
-  # - 250/500 gives 2s~50s of query time for 1275 items.
-  # - 50/500 gives 3s~20s of query time for 1275 items. (Slower but less
-  #   variance). Spikes in 20s~40s are rarer.
-  # The problem here are:
-  # - Outliers, some shards are simply slower at executing the query.
-  # - Median time, which we should optimize.
-  # - Abusing batching will slow down this query.
-  #
-  # TODO(maruel): Measure query performance with stats_framework!!
-  # TODO(maruel): Use fetch_page_async() + ndb.get_multi_async() +
-  # memcache.get_multi_async() to do pipelined processing. Should greatly reduce
-  # the effect of latency on the total duration of this function. I also suspect
-  # using ndb.get_multi() will return fresher objects than what is returned by
-  # the query.
-  opts = ndb.QueryOptions(batch_size=50, prefetch_size=500, keys_only=True)
-  try:
-    # Interestingly, the filter on .queue_number>0 is required otherwise all the
-    # None items are returned first.
-    q = TaskToRun.query(default_options=opts).order(
-        TaskToRun.queue_number).filter(TaskToRun.queue_number > 0)
-    for task_key in q:
-      duration = (utils.utcnow() - now).total_seconds()
-      if duration > 40.:
-        # Stop searching after too long, since the odds of the request blowing
-        # up right after succeeding in reaping a task is not worth the dangling
-        # task request that will stay in limbo until the cron job reaps it and
-        # retry it. The current handlers are given 60s to complete. By using
-        # 40s, it gives 20s to complete the reaping and complete the HTTP
-        # request.
-        return
+  if counters is None:
+    counters = {}
+  for key in SCAN_COUNTERS:
+    counters.setdefault(key, 0)
+  named_caches = frozenset(named_caches or [])
+  data_cache = frozenset(data_cache or [])
+  if not named_caches and not data_cache:
+    # The first task is usually reaped so fetch one at a time.
+    for i in _yield_available_task_to_dispatch(bot_dimensions, counters, 1):
+      yield i
+    return
 
-      total += 1
-      # Verify TaskToRun is what is expected. Play defensive here.
-      try:
-        validate_to_run_key(task_key)
-      except ValueError as e:
-        logging.error(str(e))
-        broken += 1
-        continue
-
-      # integer_id() == dimensions_hash.
-      if task_key.integer_id() not in accepted_dimensions_hash:
-        hash_mismatch += 1
-        continue
-
-      # Do this after the basic weeding out but before fetching TaskRequest.
-      if _lookup_cache_is_taken(task_key):
-        cache_lookup += 1
-        continue
-
-      # Ok, it's now worth taking a real look at the entity.
-      task = task_key.get(use_cache=False)
-
-      # DB operations are slow, double check memcache again.
-      if _lookup_cache_is_taken(task_key):
-        cache_lookup += 1
-        continue
-
-      # It is possible for the index to be inconsistent since it is not executed
-      # in a transaction, no problem.
-      if not task.queue_number:
-        no_queue += 1
-        continue
-
-      # It expired. A cron job will cancel it eventually. Since 'now' is saved
-      # before the query, an expired task may still be reaped even if
-      # technically expired if the query is very slow. This is on purpose so
-      # slow queries do not cause exagerate expirations.
-      if task.expiration_ts < now:
-        expired += 1
-        continue
-
-      # The hash may have conflicts. Ensure the dimensions actually match by
-      # verifying the TaskRequest. There's a probability of 2**-31 of conflicts,
-      # which is low enough for our purpose. The reason use_cache=False is
-      # otherwise it'll create a buffer bloat.
-      request = task.request_key.get(use_cache=False)
-      if not match_dimensions(request.properties.dimensions, bot_dimensions):
-        real_mismatch += 1
-        continue
-
-      # It's a valid task! Note that in the meantime, another bot may have
-      # reaped it.
+  # The lookahead is fetched in batches so it costs a few RPCs instead of one
+  # per task.
+  candidates = _yield_available_task_to_dispatch(
+      bot_dimensions, counters, _AFFINITY_MAX_LOOKAHEAD)
+
+  # Tasks without affinity, in queue order, held back while looking ahead.
+  pending = []
+  max_priority = None
+  for request, task in candidates:
+    if max_priority is None:
+      max_priority = request.priority + priority_window
+    if (request.priority > max_priority or
+        len(pending) >= _AFFINITY_MAX_LOOKAHEAD):
+      # Out of the window, fall back to the normal order.
+      pending.append((request, task))
+      break
+    if _has_affinity(request, named_caches, data_cache):
       yield request, task
-      ignored += 1
-  finally:
-    duration = (utils.utcnow() - now).total_seconds()
-    logging.info(
-        '%d/%s in %5.2fs: %d total, %d exp %d no_queue, %d hash mismatch, '
-        '%d cache negative, %d dimensions mismatch, %d ignored, %d broken',
-        opts.batch_size,
-        opts.prefetch_size,
-        duration,
-        total,
-        expired,
-        no_queue,
-        hash_mismatch,
-        cache_lookup,
-        real_mismatch,
-        ignored,
-        broken)
+    else:
+      pending.append((request, task))
+  for i in pending:
+    yield i
+  for i in candidates:
+    yield i
 
 
 def yield_expired_task_to_run():
@@ -573,6 +573,64 @@ class TaskToRunApiTest(TestCase):
     actual = _yield_next_available_task_to_dispatch(bot_dimensions)
     self.assertEqual(expected, actual)
 
+  def test_yield_next_available_task_to_dispatch_affinity(self):
+    to_run_1 = _gen_new_task_to_run()
+    self.mock_now(self.now, 1)
+    to_run_2 = _gen_new_task_to_run(
+        properties=dict(caches=[{u'name': u'git', u'path': u'git'}]))
+    self.mock_now(self.now, 2)
+    to_run_3 = _gen_new_task_to_run(
+        properties=dict(data=[[u'http://localhost/foo', u'foo.zip']]))
+    def get(**kwargs):
+      return [
+        to_run.key
+        for _, to_run in task_to_run.yield_next_available_task_to_dispatch(
+            {}, **kwargs)
+      ]
+
+    # Without cache, it's the queue order.
+    self.assertEqual([to_run_1.key, to_run_2.key, to_run_3.key], get())
+    self.assertEqual(
+        [to_run_2.key, to_run_1.key, to_run_3.key], get(named_caches=[u'git']))
+    data_hash = hashlib.sha1('http://localhost/foo').hexdigest()
+    self.assertEqual(
+        [to_run_3.key, to_run_1.key, to_run_2.key],
+        get(data_cache=[data_hash]))
+
+  def test_yield_next_available_task_to_dispatch_affinity_window(self):
+    to_run_1 = _gen_new_task_to_run(priority=10)
+    self.mock_now(self.now, 1)
+    to_run_2 = _gen_new_task_to_run(
+        priority=11,
+        properties=dict(caches=[{u'name': u'git', u'path': u'git'}]))
+    def get(priority_window):
+      return [
+        to_run.key
+        for _, to_run in task_to_run.yield_next_available_task_to_dispatch(
+            {}, named_caches=[u'git'], priority_window=priority_window)
+      ]
+
+    # The task with affinity has a lower priority, outside of the window.
+    self.assertEqual([to_run_1.key, to_run_2.key], get(0))
+    self.assertEqual([to_run_2.key, to_run_1.key], get(1))
+
+  def test_yield_next_available_task_to_dispatch_affinity_batched(self):
+    for i in xrange(5):
+      self.mock_now(self.now, i)
+      _gen_new_task_to_run()
+    calls = []
+    get_multi = ndb.get_multi
+    def mocked_get_multi(keys, **kwargs):
+      calls.append(len(keys))
+      return get_multi(keys, **kwargs)
+    self.mock(ndb, 'get_multi', mocked_get_multi)
+    actual = list(
+        task_to_run.yield_next_available_task_to_dispatch(
+            {}, named_caches=[u'git']))
+    self.assertEqual(5, len(actual))
+    # One fetch for the TaskToRun and one for the TaskRequest.
+    self.assertEqual([5, 5], calls)
+
   def test_yield_expired_task_to_run(self):
     _gen_new_task_to_run(scheduling_expiration_secs=60)
     self.assertEqual(1, len(_yield_next_available_task_to_dispatch({})))
@@ -12,16 +12,25 @@ It manages self-update and rebooting the host in case of problems.
 
 Set the environment variable SWARMING_LOAD_TEST=1 to disable the use of
 server-provided bot_config.py. This permits safe load testing.
+
+Set the environment variable SWARMING_WARM_TASK_RUNNER=1 to run the tasks in a
+long lived task_runner process instead of starting a new one for each task.
+
+Set the environment variable SWARMING_BOT_SLOTS=N to run up to N tasks
+concurrently, each in its own work directory.
 """
 
 import contextlib
+import hashlib
 import json
 import logging
 import optparse
 import os
+import random
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import traceback
 import zipfile
@@ -44,11 +53,39 @@ ROOT_DIR = os.path.dirname(THIS_FILE)
 
 # See task_runner.py for documentation.
 TASK_FAILED = 89
+NAMED_CACHES_DIR = 'named_caches'
+DATA_CACHE_DIR = 'data_cache'
+
+
+# Maximum number of data archives reported in the bot state, the most recently
+# used first.
+MAX_REPORTED_DATA_CACHE = 200
 
 
 _ERROR_HANDLER_WAS_REGISTERED = False
 
 
+# task_runner processes reused across tasks in warm task_runner mode, keyed by
+# work directory.
+_TASK_RUNNER_WORKERS = {}
+_TASK_RUNNER_WORKERS_LOCK = threading.Lock()
+
+
+# Interval at which the HTTP counters of the bot are sent along its state, in
+# seconds. They are not sent on every poll to keep the poll requests small.
+HTTP_STATS_INTERVAL = 600
+
+
+# Maximum delay before polling again after consecutive poll failures, in
+# seconds.
+MAX_POLL_ERROR_BACKOFF = 300
+
+
+# bot_config.py hooks, including get_state(), are not expected to be thread safe
+# while the task slots run concurrently, see _TaskSlots.
+_HOOK_LOCK = threading.Lock()
+
+
 ### bot_config handler part.
 
 
@@ -61,6 +98,57 @@ def _in_load_test_mode():
   return os.environ.get('SWARMING_LOAD_TEST') == '1'
 
 
+def _get_slots_count():
+  """Returns the number of tasks that can be run concurrently."""
+  try:
+    return max(int(os.environ.get('SWARMING_BOT_SLOTS', 1)), 1)
+  except ValueError:
+    return 1
+
+
+def _get_work_dir_name(slot):
+  """Returns the name of the work directory for a slot."""
+  # The first slot uses the same directory as when slots were not supported.
+  return 'work' if not slot else 'work%d' % slot
+
+
+def _get_named_caches(base_dir):
+  """Returns the sorted names of the named caches kept by this bot.
+
+  The caches in use by a running task are not listed.
+  """
+  cache_dir = os.path.join(base_dir, NAMED_CACHES_DIR)
+  if not os.path.isdir(cache_dir):
+    return []
+  return sorted(
+      i for i in os.listdir(cache_dir)
+      if os.path.isdir(os.path.join(cache_dir, i)))
+
+
+def _get_data_cache(base_dir):
+  """Returns the sha1 of the URLs of the data archives kept by this bot.
+
+  It is used by the server to prefer the tasks using them.
+  """
+  cache_dir = os.path.join(base_dir, DATA_CACHE_DIR)
+  if not os.path.isdir(cache_dir):
+    return []
+  items = sorted(
+      ((os.stat(os.path.join(cache_dir, i)).st_mtime, i[:-4])
+        for i in os.listdir(cache_dir) if i.endswith('.zip')),
+      reverse=True)
+  return [i for _, i in items[:MAX_REPORTED_DATA_CACHE]]
+
+
+def _in_warm_task_runner_mode():
+  """Returns True if the tasks should be run by a long lived task_runner
+  process.
+
+  This saves the python startup and the imports from the zip for each task.
+  """
+  return os.environ.get('SWARMING_WARM_TASK_RUNNER') == '1'
+
+
 def get_dimensions():
   """Returns bot_config.py's get_attributes() dict."""
   # Importing this administrator provided script could have side-effects on
@@ -99,6 +187,9 @@ def get_dimensions():
 
 def get_state(sleep_streak):
   """Returns dict with a state of the bot reported to the server with each poll.
+
+  The slow probes of os_utilities.get_state() are cached, each for its own
+  duration, so it is cheap enough to be called on each poll.
   """
   try:
     if _in_load_test_mode():
@@ -106,7 +197,8 @@ def get_state(sleep_streak):
       state['dimensions'] = os_utilities.get_dimensions()
     else:
       import bot_config
-      state = bot_config.get_state()
+      with _HOOK_LOCK:
+        state = bot_config.get_state()
       if not isinstance(state, dict):
         state = {'error': state}
   except Exception as e:
@@ -128,7 +220,8 @@ def call_hook(botobj, name, *args):
     import bot_config
     hook = getattr(bot_config, name, None)
     if hook:
-      return hook(botobj, *args)
+      with _HOOK_LOCK:
+        return hook(botobj, *args)
   except Exception as e:
     msg = '%s\n%s' % (e, traceback.format_exc()[-2048:])
     botobj.post_error('Failed to call hook %s(): %s' % (name, msg))
@@ -253,6 +346,14 @@ def get_bot():
       lambda b: call_hook(b, 'on_bot_shutdown'))
 
 
+def _poll_error_backoff(consecutive_errors):
+  """Returns the jittered delay to wait for after consecutive poll failures, so
+  the fleet doesn't hammer a server in trouble.
+  """
+  delay = min(2 ** min(consecutive_errors, 16), MAX_POLL_ERROR_BACKOFF)
+  return random.uniform(delay / 2., delay)
+
+
 def run_bot(arg_error):
   """Runs the bot until it reboots or self-update."""
   try:
@@ -277,13 +378,34 @@ def run_bot(arg_error):
   # This environment variable is accessible to the tasks executed by this bot.
   os.environ['SWARMING_BOT_ID'] = botobj.id
 
+  _start_task_runner_workers(botobj)
+
+  slots = None
+  if _get_slots_count() > 1:
+    slots = _TaskSlots(_get_slots_count())
+
   # TODO(maruel): Run 'health check' on startup.
   # https://code.google.com/p/swarming/issues/detail?id=112
   consecutive_sleeps = 0
+  consecutive_errors = 0
+  last_http_stats = None
   while True:
     try:
-      botobj.update_state(get_state(consecutive_sleeps))
-      did_something = poll_server(botobj)
+      if slots:
+        slots.wait_for_free_slot()
+      state = get_state(consecutive_sleeps)
+      if slots:
+        state.update(slots.get_state())
+      now = time.time()
+      if (last_http_stats is None or
+          now - last_http_stats >= HTTP_STATS_INTERVAL):
+        state['http'] = botobj.remote.get_stats()
+        last_http_stats = now
+      state['named_caches'] = _get_named_caches(botobj.base_dir)
+      state['data_cache'] = _get_data_cache(botobj.base_dir)
+      botobj.update_state(state)
+      did_something = poll_server(botobj, slots)
+      consecutive_errors = 0
       if did_something:
         consecutive_sleeps = 0
       else:
@@ -293,11 +415,15 @@ def run_bot(arg_error):
       msg = '%s\n%s' % (e, traceback.format_exc()[-2048:])
       botobj.post_error(msg)
       consecutive_sleeps = 0
+      consecutive_errors += 1
+      time.sleep(_poll_error_backoff(consecutive_errors))
 
 
-def poll_server(botobj):
+def poll_server(botobj, slots=None):
   """Polls the server to run one loop.
 
+  When slots is a _TaskSlots instance, the task is run in the background.
+
   Returns True if executed some action, False if server asked the bot to sleep.
   """
   # Access to a protected member _XXX of a client class - pylint: disable=W0212
@@ -312,10 +438,17 @@ def poll_server(botobj):
     return False
 
   if cmd == 'run':
-    if run_manifest(botobj, resp['manifest'], start):
+    if slots:
+      slots.run(botobj, resp['manifest'], start)
+    elif run_manifest(botobj, resp['manifest'], start):
       # Completed a task successfully so update swarming_bot.zip if necessary.
       update_lkgbc()
-  elif cmd == 'update':
+    return True
+
+  if slots:
+    # Do not interrupt the tasks running.
+    slots.wait_for_all_idle()
+  if cmd == 'update':
     update_bot(botobj, resp['version'])
   elif cmd == 'restart':
     if _in_load_test_mode():
@@ -328,7 +461,65 @@ def poll_server(botobj):
   return True
 
 
-def run_manifest(botobj, manifest, start):
+class _TaskSlots(object):
+  """Runs up to |count| tasks concurrently, each in a separate slot.
+
+  Each slot has its own work directory and its own thread waiting for its
+  task_runner process. The threads share the bot's XsrfRemote, which is thread
+  safe, and the bot_config.py hooks are serialized by call_hook().
+  """
+  def __init__(self, count):
+    self.count = count
+    self._cond = threading.Condition()
+    # Task id running in each busy slot.
+    self._busy = {}
+
+  def get_state(self):
+    """Returns the slots state to be sent along the bot state.
+
+    The server reports the bot as busy as long as slots_busy is not empty.
+    """
+    with self._cond:
+      return {
+        'slots': self.count,
+        'slots_busy': sorted(self._busy.itervalues()),
+      }
+
+  def wait_for_free_slot(self):
+    with self._cond:
+      while len(self._busy) >= self.count:
+        self._cond.wait()
+
+  def wait_for_all_idle(self):
+    with self._cond:
+      while self._busy:
+        self._cond.wait()
+
+  def run(self, botobj, manifest, start):
+    """Runs the task in the background in a free slot."""
+    with self._cond:
+      slot = min(set(xrange(self.count)).difference(self._busy))
+      self._busy[slot] = manifest.get('task_id')
+    thread = threading.Thread(
+        target=self._run, args=(slot, botobj, manifest, start),
+        name='Slot%d' % slot)
+    thread.daemon = True
+    thread.start()
+
+  def _run(self, slot, botobj, manifest, start):
+    try:
+      if run_manifest(botobj, manifest, start, slot):
+        update_lkgbc()
+    except Exception as e:
+      logging.exception('run_manifest failed')
+      botobj.post_error('%s\n%s' % (e, traceback.format_exc()[-2048:]))
+    finally:
+      with self._cond:
+        del self._busy[slot]
+        self._cond.notify_all()
+
+
+def run_manifest(botobj, manifest, start, slot=0):
   """Defers to task_runner.py.
 
   Return True if the task succeeded.
@@ -350,12 +541,10 @@ def run_manifest(botobj, manifest, start):
   internal_failure = False
   msg = None
   try:
-    # We currently do not clean up the 'work' directory now is it compartmented.
-    # TODO(maruel): Compartmentation should be done via tag. It is important to
-    # not be too aggressive about deletion because running a task with a warm
-    # cache has important performance benefit.
-    # https://code.google.com/p/swarming/issues/detail?id=149
-    work_dir = os.path.join(botobj.base_dir, 'work')
+    # We currently do not clean up the 'work' directory. The tasks that want a
+    # warm cache should request a named cache instead, which task_runner.py
+    # maps in the work directory while the task runs.
+    work_dir = os.path.join(botobj.base_dir, _get_work_dir_name(slot))
     if not os.path.isdir(work_dir):
       os.makedirs(work_dir)
 
@@ -368,31 +557,39 @@ def run_manifest(botobj, manifest, start):
     with open(path, 'wb') as f:
       f.write(json.dumps(manifest))
     call_hook(botobj, 'on_before_task')
-    command = [
-      sys.executable, THIS_FILE, 'task_runner',
-      '--swarming-server', url,
-      '--file', path,
-      '--cost-usd-hour', str(botobj.state.get('cost_usd_hour') or 0.),
-      # Include the time taken to poll the task in the cost.
-      '--start', str(start),
-    ]
-    logging.debug('Running command: %s', command)
-    proc = subprocess.Popen(command, cwd=ROOT_DIR, env=env)
-    while proc.poll() is None:
-      if time.time() - start >= hard_timeout:
-        proc.kill()
-        failure = False
-        internal_failure = True
-        msg = 'task_runner hung'
-        return False
-      # Busy loop.
-      time.sleep(0.5)
-
-    failure = proc.returncode == TASK_FAILED
-    internal_failure = not failure and bool(proc.returncode)
+    cost_usd_hour = botobj.state.get('cost_usd_hour') or 0.
+    timeout = start + hard_timeout - time.time()
+    if _in_warm_task_runner_mode():
+      returncode = _run_in_worker(
+          url, path, work_dir, cost_usd_hour, start,
+          {'SWARMING_TASK_ID': env['SWARMING_TASK_ID']}, timeout)
+    else:
+      command = [
+        sys.executable, THIS_FILE, 'task_runner',
+        '--swarming-server', url,
+        '--file', path,
+        '--work-dir', work_dir,
+        '--cost-usd-hour', str(cost_usd_hour),
+        # Include the time taken to poll the task in the cost.
+        '--start', str(start),
+      ]
+      logging.debug('Running command: %s', command)
+      proc = subprocess.Popen(command, cwd=ROOT_DIR, env=env)
+      with _kill_on_timeout(proc, timeout) as killed:
+        returncode = proc.wait()
+      if killed:
+        returncode = None
+    if returncode is None:
+      failure = False
+      internal_failure = True
+      msg = 'task_runner hung'
+      return False
+
+    failure = returncode == TASK_FAILED
+    internal_failure = not failure and bool(returncode)
     if internal_failure:
       msg = 'Execution failed, internal error.'
-    return not bool(proc.returncode)
+    return not bool(returncode)
   except Exception as e:
     # Failures include IOError when writing if the disk is full, OSError if
     # swarming_bot.zip doesn't exist anymore, etc.
@@ -406,12 +603,175 @@ def run_manifest(botobj, manifest, start):
     call_hook(botobj, 'on_after_task', failure, internal_failure)
 
 
+@contextlib.contextmanager
+def _kill_on_timeout(proc, timeout):
+  """Kills proc if the enclosed block takes more than timeout seconds.
+
+  Yields a list which is not empty if proc was killed.
+  """
+  killed = []
+  def kill():
+    killed.append(True)
+    try:
+      proc.kill()
+    except OSError:
+      # The process has already exited.
+      pass
+  timer = threading.Timer(max(timeout, 0), kill)
+  timer.daemon = True
+  timer.start()
+  try:
+    yield killed
+  finally:
+    timer.cancel()
+
+
+def _start_task_runner_worker(url, work_dir):
+  """Starts the warm task_runner process for work_dir unless it is running.
+
+  Returns the process.
+  """
+  with _TASK_RUNNER_WORKERS_LOCK:
+    proc = _TASK_RUNNER_WORKERS.get(work_dir)
+    if not proc or proc.poll() is not None:
+      command = [
+        sys.executable, THIS_FILE, 'task_runner',
+        '--swarming-server', url,
+        '--worker',
+      ]
+      logging.debug('Running command: %s', command)
+      proc = subprocess.Popen(
+          command, cwd=ROOT_DIR, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+      _TASK_RUNNER_WORKERS[work_dir] = proc
+    return proc
+
+
+def _start_task_runner_workers(botobj):
+  """Pre-forks the warm task_runner process of each task slot, so the first
+  task doesn't pay the startup either.
+  """
+  if not _in_warm_task_runner_mode():
+    return
+  for slot in xrange(_get_slots_count()):
+    _start_task_runner_worker(
+        botobj.remote.url,
+        os.path.join(botobj.base_dir, _get_work_dir_name(slot)))
+
+
+def _run_in_worker(url, path, work_dir, cost_usd_hour, start, env, timeout):
+  """Runs a task in the warm task_runner process for work_dir, starting it if
+  needed.
+
+  See task_runner.serve() for the protocol.
+
+  Returns:
+    The task_runner exit code or None if it hung.
+  """
+  proc = _start_task_runner_worker(url, work_dir)
+  request = {
+    'cost_usd_hour': cost_usd_hour,
+    'env': env,
+    'file': path,
+    'start': start,
+    'swarming_server': url,
+    'work_dir': work_dir,
+  }
+  with _kill_on_timeout(proc, timeout) as killed:
+    try:
+      proc.stdin.write(json.dumps(request) + '\n')
+      proc.stdin.flush()
+      line = proc.stdout.readline()
+    except IOError:
+      # The process died.
+      line = ''
+  if killed or not line:
+    with _TASK_RUNNER_WORKERS_LOCK:
+      _TASK_RUNNER_WORKERS.pop(work_dir, None)
+    returncode = proc.wait()
+    # Replace it right away so the next task doesn't pay the startup.
+    _start_task_runner_worker(url, work_dir)
+    # When the process exited by itself, consider it like a task_runner crash.
+    return None if killed else (returncode or 1)
+  return json.loads(line)['exit_code']
+
+
+def _stop_task_runner_workers():
+  """Stops the warm task_runner processes if running."""
+  with _TASK_RUNNER_WORKERS_LOCK:
+    procs = _TASK_RUNNER_WORKERS.values()
+    _TASK_RUNNER_WORKERS.clear()
+  for proc in procs:
+    if proc.poll() is None:
+      # task_runner.serve() returns when stdin is closed.
+      proc.stdin.close()
+      with _kill_on_timeout(proc, 60):
+        proc.wait()
+
+
+def _get_zip_contents(path):
+  """Returns the files in a zip as dict(path: content)."""
+  with contextlib.closing(zipfile.ZipFile(path, 'r')) as f:
+    return dict((i, f.read(i)) for i in f.namelist())
+
+
+def _assemble_bot_zip(botobj, version, new_zip):
+  """Creates the bot code |version| as new_zip by fetching only the files that
+  differ from the currently running swarming_bot.zip.
+
+  Returns:
+    True if new_zip was created and its content matches |version|.
+  """
+  if not THIS_FILE.endswith('.zip') or not os.path.isfile(THIS_FILE):
+    return False
+  url = botobj.remote.url + '/swarming/api/v1/bot/bot_code/%s' % version
+  resp = net.url_read_json(url + '/manifest')
+  if not resp or not isinstance(resp.get('files'), dict):
+    return False
+  try:
+    current = _get_zip_contents(THIS_FILE)
+  except (IOError, zipfile.BadZipfile) as e:
+    logging.warning('Failed to read %s: %s', THIS_FILE, e)
+    return False
+
+  files = {}
+  for path, digest in resp['files'].iteritems():
+    path = path.encode('utf-8')
+    content = current.get(path)
+    if content is None or hashlib.sha1(content).hexdigest() != digest:
+      content = net.url_read(url + '/file/' + digest)
+      if content is None or hashlib.sha1(content).hexdigest() != digest:
+        logging.warning('Failed to fetch %s', path)
+        return False
+      logging.info('Fetched %s', path)
+    files[path] = content
+
+  # Same as the server's bot_archive.get_swarming_bot_version().
+  h = hashlib.sha1()
+  for path, content in sorted(files.iteritems()):
+    h.update(path)
+    h.update('\x00')
+    h.update(content)
+    h.update('\x00')
+  if h.hexdigest() != version:
+    logging.warning('Assembled version %s, expected %s', h.hexdigest(), version)
+    return False
+
+  zip_file = zipfile.ZipFile(new_zip, 'w', zipfile.ZIP_DEFLATED)
+  with contextlib.closing(zip_file) as f:
+    for path, content in sorted(files.iteritems()):
+      f.writestr(path, content)
+  return True
+
+
 def update_bot(botobj, version):
   """Downloads the new version of the bot code and then runs it.
 
   Use alternating files; first load swarming_bot.1.zip, then swarming_bot.2.zip,
   never touching swarming_bot.zip which was the originally bootstrapped file.
 
+  Only the files that changed are downloaded when possible, the whole zip
+  otherwise.
+
   Does not return.
 
   TODO(maruel): Create LKGBC:
@@ -424,7 +784,8 @@ def update_bot(botobj, version):
 
   # Download as a new file.
   url = botobj.remote.url + '/swarming/api/v1/bot/bot_code/%s' % version
-  if not net.url_retrieve(new_zip, url):
+  if (not _assemble_bot_zip(botobj, version, new_zip) and
+      not net.url_retrieve(new_zip, url)):
     # Try without a specific version. It can happen when a server is rapidly
     # updated multiple times in a row.
     botobj.post_error(
@@ -435,6 +796,9 @@ def update_bot(botobj, version):
     return
 
   logging.info('Restarting to %s.', new_zip)
+  # The workers run the old code and their pipes would leak through
+  # os.execv().
+  _stop_task_runner_workers()
   sys.stdout.flush()
   sys.stderr.flush()
 
@@ -518,4 +882,5 @@ def main(args):
   try:
     return run_bot(error)
   finally:
+    _stop_task_runner_workers()
     call_hook(bot.Bot(None, None, None, ROOT_DIR, None), 'on_bot_shutdown')
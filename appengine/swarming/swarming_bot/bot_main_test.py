@@ -3,14 +3,19 @@
 # Use of this source code is governed by the Apache v2.0 license that can be
 # found in the LICENSE file.
 
+import StringIO
+import hashlib
+import json
 import logging
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import unittest
+import zipfile
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -98,6 +103,24 @@ class TestBotMain(net_utils.TestCase):
     expected['sleep_streak'] = 12
     self.assertEqual(expected, bot_main.get_state(12))
 
+  def test_get_named_caches(self):
+    self.assertEqual([], bot_main._get_named_caches(self.root_dir))
+    cache_dir = os.path.join(self.root_dir, bot_main.NAMED_CACHES_DIR)
+    os.makedirs(os.path.join(cache_dir, 'out'))
+    os.makedirs(os.path.join(cache_dir, 'git'))
+    self.assertEqual(['git', 'out'], bot_main._get_named_caches(self.root_dir))
+
+  def test_get_data_cache(self):
+    self.assertEqual([], bot_main._get_data_cache(self.root_dir))
+    cache_dir = os.path.join(self.root_dir, bot_main.DATA_CACHE_DIR)
+    os.makedirs(cache_dir)
+    for i, name in enumerate(('a.zip', 'b.zip', 'c.zip.1.tmp')):
+      path = os.path.join(cache_dir, name)
+      open(path, 'wb').close()
+      os.utime(path, (i, i))
+    # The most recently used first.
+    self.assertEqual(['b', 'a'], bot_main._get_data_cache(self.root_dir))
+
   def test_setup_bot(self):
     self.mock(bot_main, 'get_remote', lambda: self.server)
     setup_bots = []
@@ -160,9 +183,12 @@ class TestBotMain(net_utils.TestCase):
     class Foo(Exception):
       pass
 
-    def poll_server(botobj):
+    def poll_server(botobj, slots):
+      self.assertEqual(None, slots)
       sleep_streak = botobj.state['sleep_streak']
       self.assertEqual(botobj.remote, self.server)
+      # The HTTP counters are only sent every HTTP_STATS_INTERVAL.
+      self.assertEqual(not sleep_streak, 'http' in botobj.state)
       if sleep_streak == 5:
         raise Exception('Jumping out of the loop')
       return False
@@ -191,6 +217,35 @@ class TestBotMain(net_utils.TestCase):
     self.assertEqual(
         os_utilities.get_hostname_short(), os.environ['SWARMING_BOT_ID'])
 
+  def test_run_bot_error_backoff(self):
+    self.mock(time, 'time', lambda: 126.0)
+    self.mock(bot_main.random, 'uniform', lambda _low, high: high)
+    class Foo(Exception):
+      pass
+
+    def poll_server(_botobj, _slots):
+      raise Exception('Server in trouble')
+    self.mock(bot_main, 'poll_server', poll_server)
+    self.mock(bot.Bot, 'post_error', lambda *_: None)
+    slept = []
+    def sleep(duration):
+      slept.append(duration)
+      if len(slept) == 10:
+        raise Foo('Necessary to get out of the loop')
+    self.mock(time, 'sleep', sleep)
+    self.mock(bot_main, 'get_remote', lambda: self.server)
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/swarming/api/v1/bot/server_ping',
+            {}, 'foo', None,
+          ),
+        ])
+
+    with self.assertRaises(Foo):
+      bot_main.run_bot(None)
+    self.assertEqual([2, 4, 8, 16, 32, 64, 128, 256, 300, 300], slept)
+
   def test_poll_server_sleep(self):
     slept = []
     self.mock(time, 'sleep', slept.append)
@@ -201,7 +256,10 @@ class TestBotMain(net_utils.TestCase):
         [
           (
             'https://localhost:1/auth/api/v1/accounts/self/xsrf_token',
-            {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+            {
+              'data': {},
+              'headers': {'X-XSRF-Token-Request': '1'},
+            },
             {'xsrf_token': 'token'},
           ),
           (
@@ -229,7 +287,10 @@ class TestBotMain(net_utils.TestCase):
         [
           (
             'https://localhost:1/auth/api/v1/accounts/self/xsrf_token',
-            {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+            {
+              'data': {},
+              'headers': {'X-XSRF-Token-Request': '1'},
+            },
             {'xsrf_token': 'token'},
           ),
           (
@@ -248,6 +309,55 @@ class TestBotMain(net_utils.TestCase):
     expected = [(self.bot, {'foo': 'bar'}, time.time())]
     self.assertEqual(expected, manifest)
 
+  def test_poll_server_run_slots(self):
+    # The tasks are run concurrently, each in its own slot.
+    self.mock(time, 'sleep', self.fail)
+    self.mock(bot_main, 'update_bot', self.fail)
+    self.mock(bot_main, 'update_lkgbc', lambda: None)
+    slots = bot_main._TaskSlots(2)
+    event = threading.Event()
+    ran = []
+    def run_manifest(botobj, manifest, start, slot):
+      self.assertEqual(self.bot, botobj)
+      self.assertEqual(time.time(), start)
+      ran.append((manifest['task_id'], slot))
+      event.wait()
+      return True
+    self.mock(bot_main, 'run_manifest', run_manifest)
+
+    requests = [
+      (
+        'https://localhost:1/auth/api/v1/accounts/self/xsrf_token',
+        {
+          'data': {},
+          'headers': {'X-XSRF-Token-Request': '1'},
+        },
+        {'xsrf_token': 'token'},
+      ),
+    ]
+    for task_id in ('23', '24'):
+      requests.append(
+        (
+          'https://localhost:1/swarming/api/v1/bot/poll',
+          {
+            'data': self.bot._attributes,
+            'headers': {'X-XSRF-Token': 'token'},
+          },
+          {
+            'cmd': 'run',
+            'manifest': {'task_id': task_id},
+          },
+        ))
+    self.expected_requests(requests)
+    self.assertTrue(bot_main.poll_server(self.bot, slots))
+    self.assertTrue(bot_main.poll_server(self.bot, slots))
+    self.assertEqual(
+        {'slots': 2, 'slots_busy': ['23', '24']}, slots.get_state())
+    event.set()
+    slots.wait_for_all_idle()
+    self.assertEqual([('23', 0), ('24', 1)], sorted(ran))
+    self.assertEqual({'slots': 2, 'slots_busy': []}, slots.get_state())
+
   def test_poll_server_update(self):
     update = []
     self.mock(time, 'sleep', self.fail)
@@ -258,7 +368,10 @@ class TestBotMain(net_utils.TestCase):
         [
           (
             'https://localhost:1/auth/api/v1/accounts/self/xsrf_token',
-            {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+            {
+              'data': {},
+              'headers': {'X-XSRF-Token-Request': '1'},
+            },
             {'xsrf_token': 'token'},
           ),
           (
@@ -287,7 +400,10 @@ class TestBotMain(net_utils.TestCase):
         [
           (
             'https://localhost:1/auth/api/v1/accounts/self/xsrf_token',
-            {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+            {
+              'data': {},
+              'headers': {'X-XSRF-Token-Request': '1'},
+            },
             {'xsrf_token': 'token'},
           ),
           (
@@ -316,7 +432,10 @@ class TestBotMain(net_utils.TestCase):
         [
           (
             'https://localhost:1/auth/api/v1/accounts/self/xsrf_token',
-            {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+            {
+              'data': {},
+              'headers': {'X-XSRF-Token-Request': '1'},
+            },
             {'xsrf_token': 'token'},
           ),
           (
@@ -342,6 +461,7 @@ class TestBotMain(net_utils.TestCase):
           sys.executable, THIS_FILE, 'task_runner',
           '--swarming-server', url,
           '--file', os.path.join(self.root_dir, 'work', 'test_run.json'),
+          '--work-dir', os.path.join(self.root_dir, 'work'),
           '--cost-usd-hour', '3600.0', '--start', '100.0',
         ]
         self.assertEqual(expected, cmd)
@@ -352,11 +472,54 @@ class TestBotMain(net_utils.TestCase):
         self2.returncode = returncode
         return returncode
 
+      def wait(self2):
+        self2.returncode = returncode
+        return returncode
+
+      def kill(self2):
+        self.fail()
+
       def communicate(self2):
         self2.returncode = returncode
         return 'foo', None
     self.mock(subprocess, 'Popen', Popen)
 
+  def _mock_popen_worker(self, exit_codes):
+    """Mocks the warm task_runner process, returns the requests received."""
+    requests = []
+    # Method should have "self" as first argument - pylint: disable=E0213
+    class Popen(object):
+      def __init__(self2, cmd, cwd, stdin, stdout):
+        expected = [
+          sys.executable, THIS_FILE, 'task_runner',
+          '--swarming-server', 'https://localhost:1', '--worker',
+        ]
+        self.assertEqual(expected, cmd)
+        self.assertEqual(bot_main.ROOT_DIR, cwd)
+        self.assertEqual(subprocess.PIPE, stdin)
+        self.assertEqual(subprocess.PIPE, stdout)
+        self2.stdin = self2
+        self2.stdout = StringIO.StringIO(
+            ''.join(json.dumps({'exit_code': i}) + '\n' for i in exit_codes))
+
+      def write(self2, data):
+        requests.append(json.loads(data))
+
+      def flush(self2):
+        pass
+
+      @staticmethod
+      def poll():
+        return None
+
+      @staticmethod
+      def wait():
+        # Only called when the process died.
+        return -9
+    self.mock(subprocess, 'Popen', Popen)
+    self.mock(bot_main, '_TASK_RUNNER_WORKERS', {})
+    return requests
+
   def test_run_manifest(self):
     self.mock(bot_main, 'post_error_task', lambda *args: self.fail(args))
     def call_hook(botobj, name, *args):
@@ -424,6 +587,76 @@ class TestBotMain(net_utils.TestCase):
     expected = [(self.bot, 'Internal exception occured: Dang', '24')]
     self.assertEqual(expected, posted)
 
+  def test_run_manifest_warm(self):
+    self.mock(os, 'environ', dict(os.environ, SWARMING_WARM_TASK_RUNNER='1'))
+    self.mock(bot_main, 'post_error_task', lambda *args: self.fail(args))
+    results = []
+    def call_hook(_botobj, name, *args):
+      if name == 'on_after_task':
+        results.append(args)
+    self.mock(bot_main, 'call_hook', call_hook)
+    requests = self._mock_popen_worker([0, bot_main.TASK_FAILED])
+
+    manifest = {'hard_timeout': 60, 'task_id': '24'}
+    self.assertEqual(
+        True, bot_main.run_manifest(self.bot, manifest, time.time()))
+    work_dir = os.path.join(self.root_dir, 'work')
+    worker = bot_main._TASK_RUNNER_WORKERS[work_dir]
+    # The same process is reused for the second task.
+    self.assertEqual(
+        False, bot_main.run_manifest(self.bot, manifest, time.time()))
+    self.assertIs(worker, bot_main._TASK_RUNNER_WORKERS[work_dir])
+    self.assertEqual([(False, False), (True, False)], results)
+    expected = {
+      'cost_usd_hour': 3600.,
+      'env': {'SWARMING_TASK_ID': '24'},
+      'file': os.path.join(self.root_dir, 'work', 'test_run.json'),
+      'start': 100.,
+      'swarming_server': 'https://localhost:1',
+      'work_dir': work_dir,
+    }
+    self.assertEqual([expected, expected], requests)
+
+  def test_run_manifest_warm_died(self):
+    self.mock(os, 'environ', dict(os.environ, SWARMING_WARM_TASK_RUNNER='1'))
+    posted = []
+    self.mock(bot_main, 'post_error_task', lambda *args: posted.append(args))
+    self.mock(bot_main, 'call_hook', lambda *_: None)
+    self._mock_popen_worker([])
+
+    manifest = {'hard_timeout': 60, 'task_id': '24'}
+    work_dir = os.path.join(self.root_dir, 'work')
+    worker = bot_main._start_task_runner_worker(
+        'https://localhost:1', work_dir)
+    self.assertEqual(
+        False, bot_main.run_manifest(self.bot, manifest, time.time()))
+    # A new process was started right away for the next task.
+    self.assertEqual([work_dir], bot_main._TASK_RUNNER_WORKERS.keys())
+    self.assertIsNot(worker, bot_main._TASK_RUNNER_WORKERS[work_dir])
+    expected = [(self.bot, 'Execution failed, internal error.', '24')]
+    self.assertEqual(expected, posted)
+
+  def test_start_task_runner_workers(self):
+    self._mock_popen_worker([])
+    bot_main._start_task_runner_workers(self.bot)
+    # Not in warm task_runner mode.
+    self.assertEqual({}, bot_main._TASK_RUNNER_WORKERS)
+
+    self.mock(
+        os, 'environ',
+        dict(
+            os.environ, SWARMING_WARM_TASK_RUNNER='1', SWARMING_BOT_SLOTS='2'))
+    bot_main._start_task_runner_workers(self.bot)
+    expected = [
+      os.path.join(self.root_dir, 'work'),
+      os.path.join(self.root_dir, 'work1'),
+    ]
+    self.assertEqual(expected, sorted(bot_main._TASK_RUNNER_WORKERS))
+    workers = bot_main._TASK_RUNNER_WORKERS.copy()
+    # The running processes are kept.
+    bot_main._start_task_runner_workers(self.bot)
+    self.assertEqual(workers, bot_main._TASK_RUNNER_WORKERS)
+
   def test_update_bot_linux(self):
     self.mock(sys, 'platform', 'linux2')
 
@@ -460,6 +693,46 @@ class TestBotMain(net_utils.TestCase):
       bot_main.update_bot(self.bot, '123')
     self.assertEqual([(cmd,)], calls)
 
+  def test_update_bot_incremental(self):
+    self.mock(sys, 'platform', 'linux2')
+    self.mock(self.bot, 'post_error', lambda *_: None)
+    with zipfile.ZipFile('swarming_bot.1.zip', 'w') as f:
+      f.writestr('a.py', 'a')
+      f.writestr('b.py', 'b')
+    self.mock(bot_main, 'THIS_FILE', 'swarming_bot.1.zip')
+    new_files = {'a.py': 'a', 'b.py': 'b2', 'c.py': 'c'}
+    h = hashlib.sha1()
+    for path, content in sorted(new_files.iteritems()):
+      h.update('%s\x00%s\x00' % (path, content))
+    version = h.hexdigest()
+    url = 'https://localhost:1/swarming/api/v1/bot/bot_code/%s' % version
+    manifest = {
+      'files': dict(
+          (k, hashlib.sha1(v).hexdigest()) for k, v in new_files.iteritems()),
+      'version': version,
+    }
+    self.mock(
+        net, 'url_read_json',
+        lambda u: manifest if u == url + '/manifest' else self.fail(u))
+    # Only the files that changed are fetched.
+    by_digest = dict(
+        (hashlib.sha1(v).hexdigest(), v) for v in ('b2', 'c'))
+    fetched = []
+    def url_read(u):
+      fetched.append(u)
+      return by_digest[u.rsplit('/', 1)[1]]
+    self.mock(net, 'url_read', url_read)
+    self.mock(net, 'url_retrieve', self.fail)
+    calls = []
+    self.mock(os, 'execv', lambda *args: calls.append(args))
+
+    bot_main.update_bot(self.bot, version)
+    self.assertEqual(2, len(fetched))
+    cmd = [sys.executable, 'swarming_bot.2.zip', 'start_slave', '--survive']
+    self.assertEqual([(sys.executable, cmd)], calls)
+    self.assertEqual(
+        new_files, bot_main._get_zip_contents('swarming_bot.2.zip'))
+
   def test_get_config(self):
     expected = {
       u'server': u'http://localhost:8080',
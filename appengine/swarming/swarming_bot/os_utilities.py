@@ -31,6 +31,7 @@ import string
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import urllib
 import urllib2
@@ -138,6 +139,28 @@ else:
   cached = tools.cached
 
 
+# Values returned by _get_probe(), keyed by function.
+_PROBES_CACHE = {}
+_PROBES_CACHE_LOCK = threading.Lock()
+
+
+def _get_probe(func, ttl):
+  """Returns the value of func(), calling it at most once per ttl seconds.
+
+  Used by get_state() for the probes which are slow but whose value changes
+  over time, so @cached can't be used.
+  """
+  now = time.time()
+  with _PROBES_CACHE_LOCK:
+    item = _PROBES_CACHE.get(func)
+  if item and 0 <= now - item[0] < ttl:
+    return item[1]
+  value = func()
+  with _PROBES_CACHE_LOCK:
+    _PROBES_CACHE[func] = (now, value)
+  return value
+
+
 def _write(filepath, content):
   """Writes out a file and returns True on success."""
   logging.info('Writing in %s:\n%s', filepath, content)
@@ -1310,6 +1333,8 @@ def get_state(threshold_mb=2*1024, skip=None):
         automatically. Set to 0 or None to disable.
   - skip: list of partitions to skip for automatic quarantining on low free
         space.
+
+  The slow probes are only refreshed every few minutes, see _get_probe().
   """
   # TODO(vadimsh): Send 'uptime', number of open file descriptors, processes or
   # any other leaky resources. So that the server can decided to reboot the bot
@@ -1317,10 +1342,10 @@ def get_state(threshold_mb=2*1024, skip=None):
   state = {
     'cost_usd_hour': get_cost_hour(),
     'cwd': os.getcwd(),
-    'disks': get_disks_info(),
+    'disks': _get_probe(get_disks_info, 60),
     'gpu': get_gpu()[1],
-    'ip': get_ip(),
-    'hostname': get_hostname(),
+    'ip': _get_probe(get_ip, 5*60),
+    'hostname': _get_probe(get_hostname, 60*60),
     'ram': get_physical_ram(),
     'running_time': int(round(time.time() - _STARTED_TS)),
     'started_ts': int(round(_STARTED_TS)),
@@ -60,6 +60,22 @@ class TestOsUtilitiesPrivate(auto_stub.TestCase):
       self.assertEqual(expected, actual, (inputs, expected, actual, i))
 
 
+  def test_get_probe(self):
+    self.mock(os_utilities, '_PROBES_CACHE', {})
+    now = [100.]
+    self.mock(time, 'time', lambda: now[0])
+    calls = []
+    def probe():
+      calls.append(now[0])
+      return len(calls)
+    self.assertEqual(1, os_utilities._get_probe(probe, 60))
+    now[0] = 159.
+    self.assertEqual(1, os_utilities._get_probe(probe, 60))
+    now[0] = 160.
+    self.assertEqual(2, os_utilities._get_probe(probe, 60))
+    self.assertEqual([100., 160.], calls)
+
+
 class TestOsUtilities(auto_stub.TestCase):
   def test_get_os_version(self):
     version = os_utilities.get_os_version_number()
@@ -16,27 +16,38 @@ failure and to cancel this task run and ask the server to retry it.
 
 __version__ = '0.4'
 
-import StringIO
+import Queue
 import base64
+import errno
+import hashlib
 import json
 import logging
 import optparse
 import os
+import shutil
 import subprocess
 import sys
+import threading
 import time
 import zipfile
 
+import os_utilities
 import xsrf_client
 from utils import net
 from utils import on_error
 from utils import subprocess42
 
 
-# Sends a maximum of 100kb of stdout per task_update packet.
+# Sends 100kb of stdout per task_update packet by default. It matches the
+# server's TaskOutput.CHUNK_SIZE.
 MAX_CHUNK_SIZE = 102400
 
 
+# Maximum stdout per task_update packet, when the task is noisy. See
+# UpdatePolicy.
+MAX_PACKET_SIZE = 5 * MAX_CHUNK_SIZE
+
+
 # Maximum wait between task_update packet when there's no output.
 MAX_PACKET_INTERVAL = 30
 
@@ -45,6 +56,37 @@ MAX_PACKET_INTERVAL = 30
 MIN_PACKET_INTERNAL = 10
 
 
+# Wait between task_update packets of a task that stays quiet. It must stay
+# well below the server's BOT_PING_TOLERANCE.
+MAX_IDLE_PACKET_INTERVAL = 60
+
+
+# Maximum stdout sent along the exit code in the last task_update packet. More
+# is sent in a packet before so its upload is included in the 'upload' timing.
+MAX_FINAL_OUTPUT = 10240
+
+
+# Maximum amount of stdout buffered while waiting for the server. When reached,
+# reading the pipe is paused until a task_update packet was sent, but never
+# past the next timeout check.
+MAX_BUFFERED_OUTPUT = 10 * MAX_CHUNK_SIZE
+
+
+# Maximum number of task data archives downloaded concurrently.
+MAX_CONCURRENT_DOWNLOADS = 8
+
+
+# Free disk space to keep on the partition holding the data cache, in Mb. The
+# least recently used archives are evicted until this much space is free.
+MIN_FREE_DISK_MB = 4096
+
+
+# Directories holding the data cache and the named caches, siblings of the work
+# directory. Keep in sync with bot_main.py.
+DATA_CACHE_DIR = 'data_cache'
+NAMED_CACHES_DIR = 'named_caches'
+
+
 # Exit code used to indicate the task failed. Keep in sync with bot_main.py. The
 # reason for its existance is that if an exception occurs, task_runner's exit
 # code will be 1. If the process is killed, it'll likely be -9. In these cases,
@@ -66,15 +108,231 @@ def monotonic_time():
   return _last_now
 
 
-def download_data(root_dir, files):
-  """Downloads and expands the zip files enumerated in the test run data."""
-  for data_url, _ in files:
-    logging.info('Downloading: %s', data_url)
-    content = net.url_read(data_url)
-    if content is None:
+def _get_free_disk_mb(path):
+  """Returns the free space in Mb of the partition holding path or None."""
+  path = os.path.abspath(path) + os.sep
+  if sys.platform == 'win32':
+    path = path.lower()
+  mount_point = None
+  free_mb = None
+  for mount, info in os_utilities.get_disks_info().iteritems():
+    prefix = mount if mount.endswith(os.sep) else mount + os.sep
+    if path.startswith(prefix) and len(mount) > len(mount_point or ''):
+      mount_point = mount
+      free_mb = info['free_mb']
+  return free_mb
+
+
+def _trim_lru(cache_dir, names, remove, min_free_mb):
+  """Calls remove() on the least recently used items until min_free_mb are
+  free.
+  """
+  # The cache is shared by the task_runner processes of all the slots, so an
+  # item may be removed or in use by another one meanwhile.
+  items = []
+  for name in names:
+    try:
+      items.append((os.stat(os.path.join(cache_dir, name)).st_mtime, name))
+    except OSError:
+      pass
+  items.sort()
+  while items:
+    free_mb = _get_free_disk_mb(cache_dir)
+    if free_mb is None or free_mb >= min_free_mb:
+      break
+    _, name = items.pop(0)
+    logging.info('Evicting %s from %s', name, cache_dir)
+    try:
+      remove(os.path.join(cache_dir, name))
+    except OSError as e:
+      logging.warning('Failed to evict %s: %s', name, e)
+
+
+def trim_data_cache(cache_dir, min_free_mb):
+  """Evicts the least recently used archives until min_free_mb are free."""
+  if not os.path.isdir(cache_dir):
+    return
+  names = [i for i in os.listdir(cache_dir) if i.endswith('.zip')]
+  _trim_lru(cache_dir, names, os.remove, min_free_mb)
+
+
+def trim_named_caches(cache_dir, min_free_mb):
+  """Evicts the least recently used named caches until min_free_mb are free."""
+  if not os.path.isdir(cache_dir):
+    return
+  names = [
+    i for i in os.listdir(cache_dir)
+    if os.path.isdir(os.path.join(cache_dir, i))
+  ]
+  _trim_lru(cache_dir, names, shutil.rmtree, min_free_mb)
+
+
+def install_named_caches(root_dir, caches, cache_dir):
+  """Moves the named caches requested by the task into root_dir.
+
+  A cache the bot doesn't have yet is created empty. Nothing is moved if a path
+  is already used in root_dir; it is never deleted since it is not known where
+  it comes from.
+  """
+  for cache in caches:
+    dst = os.path.join(root_dir, *cache['path'].split('/'))
+    if os.path.lexists(dst):
+      raise ValueError(
+          'Can\'t map the named cache %s, %s already exists' %
+          (cache['name'], cache['path']))
+  for cache in caches:
+    src = os.path.join(cache_dir, cache['name'])
+    dst = os.path.join(root_dir, *cache['path'].split('/'))
+    if not os.path.isdir(os.path.dirname(dst)):
+      os.makedirs(os.path.dirname(dst))
+    if os.path.isdir(src):
+      logging.info('Named cache hit: %s', cache['name'])
+      os.rename(src, dst)
+    else:
+      os.mkdir(dst)
+
+
+def uninstall_named_caches(root_dir, caches, cache_dir):
+  """Moves the named caches used by the task back into cache_dir."""
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  for cache in caches:
+    src = os.path.join(root_dir, *cache['path'].split('/'))
+    dst = os.path.join(cache_dir, cache['name'])
+    if not os.path.isdir(src):
+      continue
+    if os.path.isdir(dst):
+      # Another task on this bot saved the same cache in the meantime.
+      shutil.rmtree(src)
+      continue
+    os.rename(src, dst)
+    # Update the timestamp used for LRU eviction.
+    os.utime(dst, None)
+  trim_named_caches(cache_dir, MIN_FREE_DISK_MB)
+
+
+def _fetch_to_cache(cache_dir, data_url):
+  """Streams data_url to the cache if not already present.
+
+  Returns:
+    Path to the verified archive in the cache.
+  """
+  path = os.path.join(cache_dir, hashlib.sha1(data_url).hexdigest() + '.zip')
+  if os.path.isfile(path):
+    logging.info('Cache hit: %s', data_url)
+    # Update the timestamp used for LRU eviction.
+    os.utime(path, None)
+    return path
+
+  logging.info('Downloading: %s', data_url)
+  tmp = '%s.%d.tmp' % (path, os.getpid())
+  try:
+    if not net.url_retrieve(tmp, data_url):
       raise Exception('Failed to download %s' % data_url)
-    with zipfile.ZipFile(StringIO.StringIO(content)) as zip_file:
-      zip_file.extractall(root_dir)
+    # The files' CRC32 are verified while being extracted.
+    if not zipfile.is_zipfile(tmp):
+      raise Exception('%s is not a valid zip file' % data_url)
+    try:
+      os.rename(tmp, path)
+    except OSError:
+      # Another process stored it meanwhile. This happens on Windows.
+      if not os.path.isfile(path):
+        raise
+  finally:
+    if os.path.isfile(tmp):
+      os.remove(tmp)
+  return path
+
+
+def _open_from_cache(cache_dir, data_url):
+  """Returns the archive of data_url opened from the cache, fetching it first
+  if necessary.
+
+  The archive is opened right away so another task_runner trimming the cache
+  can't take it away before it is extracted; an open file can't be removed on
+  Windows and stays readable on POSIX. It is fetched again if it was evicted
+  before being opened.
+  """
+  for _ in xrange(2):
+    path = _fetch_to_cache(cache_dir, data_url)
+    try:
+      return zipfile.ZipFile(path)
+    except IOError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      logging.warning('%s was evicted, fetching it again', data_url)
+    except zipfile.BadZipfile:
+      # Do not keep a corrupted archive around.
+      os.remove(path)
+      raise Exception('Failed to extract %s' % data_url)
+  raise Exception('Failed to fetch %s' % data_url)
+
+
+def download_data(root_dir, files, cache_dir):
+  """Downloads and expands the zip files enumerated in the test run data.
+
+  The archives are fetched concurrently and streamed into cache_dir, which
+  keeps them across tasks. They are expanded in order as soon as each one is
+  available, so that a file present in multiple archives is overwritten like
+  before.
+  """
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+
+  results = [Queue.Queue(maxsize=1) for _ in files]
+  pending = Queue.Queue()
+  for i, (data_url, _) in enumerate(files):
+    pending.put((i, data_url))
+
+  def fetch():
+    while True:
+      try:
+        i, data_url = pending.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[i].put((_open_from_cache(cache_dir, data_url), None))
+      except Exception as e:
+        results[i].put((None, e))
+
+  threads = [
+    threading.Thread(target=fetch, name='download_data')
+    for _ in xrange(min(len(files), MAX_CONCURRENT_DOWNLOADS))
+  ]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  try:
+    for (data_url, _), result in zip(files, results):
+      zip_file, error = result.get()
+      if error:
+        raise error
+      try:
+        with zip_file:
+          zip_file.extractall(root_dir)
+      except zipfile.BadZipfile:
+        # Do not keep a corrupted archive around.
+        if os.path.isfile(zip_file.filename):
+          os.remove(zip_file.filename)
+        raise Exception('Failed to extract %s' % data_url)
+  finally:
+    # On failure, stop the downloads not yet started.
+    while True:
+      try:
+        pending.get_nowait()
+      except Queue.Empty:
+        break
+    for t in threads:
+      t.join()
+    # Close the archives that were not extracted.
+    for result in results:
+      try:
+        zip_file, _ = result.get_nowait()
+      except Queue.Empty:
+        continue
+      if zip_file:
+        zip_file.close()
+  trim_data_cache(cache_dir, MIN_FREE_DISK_MB)
 
 
 class TaskDetails(object):
@@ -83,6 +341,7 @@ class TaskDetails(object):
 
     It is expected to have at least:
      - bot_id
+     - caches as a list of {name, path}, optional for older servers
      - command as a list of str
      - data as a list of urls
      - env as a dict
@@ -95,6 +354,7 @@ class TaskDetails(object):
 
     # Get all the data first so it fails early if the task details is invalid.
     self.bot_id = data['bot_id']
+    self.caches = data.get('caches', [])
     self.command = data['command']
     self.data = data['data']
     self.env = os.environ.copy()
@@ -107,7 +367,7 @@ class TaskDetails(object):
     self.task_id = data['task_id']
 
 
-def load_and_run(filename, swarming_server, cost_usd_hour, start):
+def load_and_run(filename, swarming_server, cost_usd_hour, start, work_dir):
   """Loads the task's metadata and execute it.
 
   This may throw all sorts of exceptions in case of failure. It's up to the
@@ -121,18 +381,34 @@ def load_and_run(filename, swarming_server, cost_usd_hour, start):
   # bot_main.py and contains the manifest. Temporary files will be downloaded
   # there. It's bot_main.py that will delete the directory afterward. Tests are
   # not run from there.
-  root_dir = os.path.abspath('work')
+  # Time spent between the poll request in bot_main.py and now; it includes
+  # polling, writing the manifest and starting this process.
+  timings = {'setup': monotonic_time() - start}
+  root_dir = os.path.abspath(work_dir)
   if not os.path.isdir(root_dir):
     raise ValueError('%s expected to exist' % root_dir)
 
   with open(filename, 'rb') as f:
     task_details = TaskDetails(json.load(f))
 
-  # Download the script to run in the temporary directory.
-  download_data(root_dir, task_details.data)
-
-  exit_code = run_command(
-      swarming_server, task_details, root_dir, cost_usd_hour, start)
+  # The named caches are kept in the named_caches directory across tasks and
+  # moved in the work directory only while the task runs. They are mapped first
+  # so the data archives can't end up where a cache is expected.
+  named_caches_dir = os.path.join(os.path.dirname(root_dir), NAMED_CACHES_DIR)
+  install_named_caches(root_dir, task_details.caches, named_caches_dir)
+  try:
+    # Download the script to run in the temporary directory. The archives are
+    # kept in the data_cache directory, a sibling of the work directory, so
+    # that tasks using the same archives start faster.
+    cache_dir = os.path.join(os.path.dirname(root_dir), DATA_CACHE_DIR)
+    download_start = monotonic_time()
+    download_data(root_dir, task_details.data, cache_dir)
+    timings['download'] = monotonic_time() - download_start
+
+    exit_code = run_command(
+        swarming_server, task_details, root_dir, cost_usd_hour, start, timings)
+  finally:
+    uninstall_named_caches(root_dir, task_details.caches, named_caches_dir)
   return not bool(exit_code)
 
 
@@ -146,6 +422,11 @@ def post_update(swarming_server, params, exit_code, stdout, output_chunk_start):
     stdout: Incremental output since last call, if any.
     output_chunk_start: Total number of stdout previously sent, for coherency
         with the server.
+
+  Returns:
+    The server reply as a dict. 'must_stop' is True if the task must be killed
+    because it was canceled and 'update_interval_secs' is the server hint for
+    UpdatePolicy.
   """
   params = params.copy()
   if exit_code is not None:
@@ -155,62 +436,242 @@ def post_update(swarming_server, params, exit_code, stdout, output_chunk_start):
     # chunks are processed and saved in the DB in order.
     params['output'] = base64.b64encode(stdout)
     params['output_chunk_start'] = output_chunk_start
-  # TODO(maruel): Support early cancellation.
-  # https://code.google.com/p/swarming/issues/detail?id=62
   resp = swarming_server.url_read_json(
       '/swarming/api/v1/bot/task_update/%s' % params['task_id'], data=params)
   logging.debug('post_update() = %s', resp)
   if resp.get('error'):
     # Abandon it. This will force a process exit.
     raise ValueError(resp.get('error'))
+  return resp
 
 
-def should_post_update(stdout, now, last_packet):
-  """Returns True if it's time to send a task_update packet via post_update().
+class UpdatePolicy(object):
+  """Decides when to send a task_update packet and how much stdout it holds.
 
-  Sends a packet when one of this condition is met:
-  - more than MAX_CHUNK_SIZE of stdout is buffered.
-  - last packet was sent more than MIN_PACKET_INTERNAL seconds ago and there was
-    stdout.
-  - last packet was sent more than MAX_PACKET_INTERVAL seconds ago.
+  By default, a packet is sent when MAX_CHUNK_SIZE of stdout is buffered, every
+  MIN_PACKET_INTERNAL seconds when there is stdout and every MAX_PACKET_INTERVAL
+  seconds otherwise. Then it adapts to what was measured:
+  - A noisy task sends larger packets, up to MAX_PACKET_SIZE, to hold the output
+    produced during one interval. It reduces the number of server transactions.
+  - The interval is stretched when the server is slow so that at most
+    1/RTT_RATIO of the time is spent waiting for it.
+  - A quiet task doubles its interval up to MAX_IDLE_PACKET_INTERVAL.
+  - The 'update_interval_secs' hint in the server reply is a minimum interval.
+  """
+  # Weight of the new sample in the exponential moving averages.
+  ALPHA = 0.3
+  RTT_RATIO = 10
+
+  def __init__(self):
+    # Exponential moving averages of the server round trip time in seconds and
+    # of the output rate in bytes/s.
+    self.rtt = 0.
+    self.output_rate = 0.
+    self.server_hint = 0.
+    self.idle_interval = MAX_PACKET_INTERVAL
+
+  @property
+  def packet_size(self):
+    """Returns the stdout size at which a packet is sent right away."""
+    wanted = int(self.output_rate * self.packet_interval(True))
+    chunks = (wanted + MAX_CHUNK_SIZE - 1) / MAX_CHUNK_SIZE
+    return min(max(chunks, 1) * MAX_CHUNK_SIZE, MAX_PACKET_SIZE)
+
+  def packet_interval(self, has_stdout):
+    """Returns the maximum number of seconds between two packets."""
+    if has_stdout:
+      interval = max(MIN_PACKET_INTERNAL, self.RTT_RATIO * self.rtt)
+    else:
+      interval = self.idle_interval
+    return min(max(interval, self.server_hint), MAX_IDLE_PACKET_INTERVAL)
+
+  def should_post(self, stdout, now, last_packet):
+    """Returns True if it's time to send a packet via post_update()."""
+    return (
+        len(stdout) >= self.packet_size or
+        (now - last_packet) > self.packet_interval(bool(stdout)))
+
+  def on_packet_sent(self, size, elapsed, rtt, resp):
+    """Updates the policy after a packet was sent.
+
+    Arguments:
+      size: stdout sent in the packet.
+      elapsed: seconds since the previous packet.
+      rtt: seconds spent in post_update().
+      resp: reply returned by post_update().
+    """
+    self.rtt += self.ALPHA * (rtt - self.rtt)
+    if elapsed > 0:
+      self.output_rate += self.ALPHA * (size / elapsed - self.output_rate)
+    if size:
+      self.idle_interval = MAX_PACKET_INTERVAL
+    else:
+      self.idle_interval = min(
+          2 * self.idle_interval, MAX_IDLE_PACKET_INTERVAL)
+    self.server_hint = float(resp.get('update_interval_secs') or 0)
+
+
+def calc_yield_wait(task_details, start, last_io, timed_out):
+  """Calculates the maximum number of seconds to wait in yield_any().
+
+  Sending task_update packets is done by _OutputUploader so only the timeouts
+  are considered, capped to MIN_PACKET_INTERNAL so a cancellation received by
+  _OutputUploader is acted upon even if the child process is silent.
   """
-  packet_interval = MIN_PACKET_INTERNAL if stdout else MAX_PACKET_INTERVAL
-  return len(stdout) >= MAX_CHUNK_SIZE or (now - last_packet) > packet_interval
-
-
-def calc_yield_wait(task_details, start, last_io, timed_out, stdout):
-  """Calculates the maximum number of seconds to wait in yield_any()."""
   now = monotonic_time()
   if timed_out:
     # Give a |grace_period| seconds delay.
     return max(now - timed_out - task_details.grace_period, 0.)
 
-  packet_interval = MIN_PACKET_INTERNAL if stdout else MAX_PACKET_INTERVAL
   hard_timeout = start + task_details.hard_timeout - now
   io_timeout = last_io + task_details.io_timeout - now
-  out = max(min(min(packet_interval, hard_timeout), io_timeout), 0)
+  out = max(min(hard_timeout, io_timeout, MIN_PACKET_INTERNAL), 0)
   logging.debug('calc_yield_wait() = %d', out)
   return out
 
 
+class _OutputUploader(threading.Thread):
+  """Sends the child process output to the server in the background.
+
+  The pipe is drained by run_command() which calls add(), so a slow server
+  doesn't block the child process on a full pipe nor skew the I/O timeout.
+  Packets are sent per UpdatePolicy semantics. There's at most one
+  request in flight since the server expects the chunks in order. When more
+  than MAX_BUFFERED_OUTPUT is buffered, add() waits for a packet to be sent,
+  for at most the timeout specified by the caller so it can still enforce the
+  task timeouts and the cancellation.
+  """
+  def __init__(self, swarming_server, params, cost_usd_hour, task_start):
+    super(_OutputUploader, self).__init__(name='OutputUploader')
+    self.daemon = True
+    self._swarming_server = swarming_server
+    self._params = params.copy()
+    self._cost_usd_hour = cost_usd_hour
+    self._task_start = task_start
+    self._cond = threading.Condition()
+    self._stdout = ''
+    self._output_chunk_start = 0
+    self._last_packet = monotonic_time()
+    self._stopping = False
+    self._error = None
+    self._policy = UpdatePolicy()
+    # Set when the server asked to kill the task because it was canceled.
+    self.must_stop = False
+
+  def add(self, data, timeout):
+    """Buffers output read from the child process.
+
+    If MAX_BUFFERED_OUTPUT is reached, waits up to timeout seconds for a packet
+    to be sent. The output is never dropped.
+    """
+    with self._cond:
+      if self._error:
+        raise self._error
+      self._stdout += data
+      self._cond.notify_all()
+      if len(self._stdout) >= MAX_BUFFERED_OUTPUT and timeout > 0:
+        self._cond.wait(timeout)
+
+  def stop(self):
+    """Stops the thread after it sent the output, except up to
+    MAX_FINAL_OUTPUT.
+
+    Returns:
+      tuple(stdout not yet sent, output_chunk_start)
+    """
+    with self._cond:
+      self._stopping = True
+      self._cond.notify_all()
+    self.join()
+    if self._error:
+      raise self._error
+    return self._stdout, self._output_chunk_start
+
+  def run(self):
+    try:
+      while True:
+        with self._cond:
+          stdout = self._get_packet_locked()
+          if stdout is None:
+            return
+          output_chunk_start = self._output_chunk_start
+        # Do the HTTP request without holding the lock so the pipe can still be
+        # read meanwhile.
+        now = monotonic_time()
+        elapsed = now - self._last_packet
+        self._last_packet = now
+        self._params['cost_usd'] = (
+            self._cost_usd_hour * (now - self._task_start) / 60. / 60.)
+        resp = post_update(
+            self._swarming_server, self._params, None, stdout,
+            output_chunk_start)
+        self._policy.on_packet_sent(
+            len(stdout), elapsed, monotonic_time() - now, resp)
+        if resp.get('must_stop'):
+          self.must_stop = True
+        with self._cond:
+          self._stdout = self._stdout[len(stdout):]
+          self._output_chunk_start += len(stdout)
+          self._cond.notify_all()
+    except Exception as e:
+      logging.exception('Failed to send task_update')
+      with self._cond:
+        self._error = e
+        self._cond.notify_all()
+
+  def _get_packet_locked(self):
+    """Waits for the next packet to send.
+
+    Returns None when the thread shall stop. Once stopping, the output is sent
+    until at most MAX_FINAL_OUTPUT is left to run_command() for the last packet.
+    """
+    while True:
+      packet_size = self._policy.packet_size
+      if len(self._stdout) >= packet_size:
+        return self._stdout[:packet_size]
+      if self._stopping:
+        if len(self._stdout) > MAX_FINAL_OUTPUT:
+          return self._stdout
+        return None
+      now = monotonic_time()
+      if self._policy.should_post(self._stdout, now, self._last_packet):
+        return self._stdout
+      packet_interval = self._policy.packet_interval(bool(self._stdout))
+      self._cond.wait(max(self._last_packet + packet_interval - now, 0.1))
+
+
 def run_command(
-    swarming_server, task_details, root_dir, cost_usd_hour, task_start):
+    swarming_server, task_details, root_dir, cost_usd_hour, task_start,
+    timings=None):
   """Runs a command and sends packets to the server to stream results back.
 
   Implements both I/O and hard timeouts. Sends the packets numbered, so the
-  server can ensure they are processed in order.
+  server can ensure they are processed in order. The intermediary packets are
+  sent by a _OutputUploader thread so the child process output is continuously
+  read even when the server is slow.
+
+  When the server replies that the task was canceled, the child process is
+  terminated with the same grace period as a timeout and its exit code is
+  reported as usual.
+
+  The duration of each phase of the task, in seconds, is sent as 'bot_timings'
+  in the last packet. `timings` are the phases already measured by the caller.
+  The 'upload' phase can't include the last packet itself, so it is kept small,
+  see MAX_FINAL_OUTPUT.
 
   Returns:
     Child process exit code.
   """
+  timings = (timings or {}).copy()
   # Signal the command is about to be started.
-  last_packet = start = now = monotonic_time()
+  start = now = monotonic_time()
   params = {
     'cost_usd': cost_usd_hour * (now - task_start) / 60. / 60.,
     'id': task_details.bot_id,
     'task_id': task_details.task_id,
   }
-  post_update(swarming_server, params, None, '', 0)
+  must_stop = post_update(swarming_server, params, None, '', 0).get(
+      'must_stop')
 
   logging.info('Executing: %s', task_details.command)
   # TODO(maruel): Support both channels independently and display stderr in red.
@@ -235,40 +696,42 @@ def run_command(
     params['duration'] = now - start
     params['io_timeout'] = False
     params['hard_timeout'] = False
+    timings['process_start'] = now - start
+    params['bot_timings'] = timings
     post_update(swarming_server, params, 1, stdout, 0)
     return 1
 
-  output_chunk_start = 0
-  stdout = ''
+  process_started = monotonic_time()
+  timings['process_start'] = process_started - start
+  uploader = _OutputUploader(swarming_server, params, cost_usd_hour, task_start)
+  uploader.start()
   exit_code = None
   had_hard_timeout = False
   had_io_timeout = False
+  killed = False
   timed_out = None
   try:
-    calc = lambda: calc_yield_wait(
-        task_details, start, last_io, timed_out, stdout)
-    maxsize = lambda: MAX_CHUNK_SIZE - len(stdout)
+    calc = lambda: calc_yield_wait(task_details, start, last_io, timed_out)
     last_io = monotonic_time()
-    for _, new_data in proc.yield_any(maxsize=maxsize, soft_timeout=calc):
+    for _, new_data in proc.yield_any(
+        maxsize=MAX_CHUNK_SIZE, soft_timeout=calc):
       now = monotonic_time()
       if new_data:
-        stdout += new_data
         last_io = now
+        # Do not wait on a slow server past the next timeout check.
+        uploader.add(new_data, calc())
+        now = monotonic_time()
 
-      # Post update if necessary.
-      if should_post_update(stdout, now, last_packet):
-        last_packet = monotonic_time()
-        params['cost_usd'] = (
-            cost_usd_hour * (last_packet - task_start) / 60. / 60.)
-        post_update(swarming_server, params, None, stdout, output_chunk_start)
-        output_chunk_start += len(stdout)
-        stdout = ''
-
-      # Send signal on timeout if necessary. Both are failures, not
-      # internal_failures.
+      # Send signal on cancellation or timeout if necessary. Timeouts are
+      # failures, not internal_failures.
       # Eventually kill but return 0 so bot_main.py doesn't cancel the task.
       if not timed_out:
-        if now - last_io > task_details.io_timeout:
+        if must_stop or uploader.must_stop:
+          killed = True
+          logging.warning('Task canceled')
+          proc.terminate()
+          timed_out = monotonic_time()
+        elif now - last_io > task_details.io_timeout:
           had_io_timeout = True
           logging.warning('I/O timeout')
           proc.terminate()
@@ -311,12 +774,24 @@ def run_command(
       exit_code = proc.wait()
       logging.info('Waiting for proces exit in finally - done')
 
+    process_exited = monotonic_time()
+    timings['execution'] = process_exited - process_started
+
+    # Get the output that wasn't sent yet.
+    stdout, output_chunk_start = uploader.stop()
+
     # This is the very last packet for this command.
     now = monotonic_time()
+    timings['upload'] = now - process_exited
     params['cost_usd'] = cost_usd_hour * (now - task_start) / 60. / 60.
     params['duration'] = now - start
     params['io_timeout'] = had_io_timeout
     params['hard_timeout'] = had_hard_timeout
+    params['bot_timings'] = timings
+    if killed:
+      # Tells the server the task ended because it was canceled, as it may
+      # have completed by itself just before.
+      params['killed'] = True
     # At worst, it'll re-throw, which will be caught by bot_main.py.
     post_update(swarming_server, params, exit_code, stdout, output_chunk_start)
     output_chunk_start += len(stdout)
@@ -327,6 +802,45 @@ def run_command(
   return exit_code
 
 
+def serve(stdin, stdout):
+  """Runs the tasks sent by bot_main.py one after the other.
+
+  Used by the warm task_runner mode to skip the process startup for each task.
+  Each request is a JSON encoded line on stdin with the keys file,
+  swarming_server, cost_usd_hour, start, env and work_dir. For each one, a JSON
+  encoded line with the exit_code is written back to stdout, with the same
+  meaning as the process exit code in the normal mode.
+
+  Returns when stdin is closed.
+  """
+  for line in iter(stdin.readline, ''):
+    request = json.loads(line)
+    logging.info('serve(): %s', request['file'])
+    # Keep the variables only for this task.
+    old_env = os.environ.copy()
+    os.environ.update(
+        (k.encode('utf-8'), v.encode('utf-8'))
+        for k, v in request['env'].iteritems())
+    try:
+      remote = xsrf_client.XsrfRemote(request['swarming_server'])
+      start = min(request['start'], monotonic_time())
+      if load_and_run(
+          request['file'], remote, request['cost_usd_hour'], start,
+          request['work_dir']):
+        exit_code = 0
+      else:
+        exit_code = TASK_FAILED
+    except Exception:
+      # Same as an unhandled exception in the normal mode.
+      logging.exception('load_and_run() failed')
+      exit_code = 1
+    finally:
+      os.environ.clear()
+      os.environ.update(old_env)
+    stdout.write(json.dumps({'exit_code': exit_code}) + '\n')
+    stdout.flush()
+
+
 def main(args):
   parser = optparse.OptionParser(
       description=sys.modules[__name__].__doc__,
@@ -337,15 +851,32 @@ def main(args):
   parser.add_option(
       '--cost-usd-hour', type='float', help='Cost of this VM in $/h')
   parser.add_option('--start', type='float', help='Time this task was started')
+  parser.add_option(
+      '--work-dir', default='work',
+      help='Directory where the task is run, must exist')
+  parser.add_option(
+      '--worker', action='store_true',
+      help='Runs the tasks received on stdin, see serve()')
 
   options, args = parser.parse_args(args)
-  if not options.file:
+  if not options.file and not options.worker:
     parser.error('You must provide the request file name.')
   if args:
     parser.error('Unknown args: %s' % args)
 
   on_error.report_on_exception_exit(options.swarming_server)
 
+  if options.worker:
+    logging.info('starting worker')
+    # stdout is reserved for the replies.
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+      serve(sys.stdin, stdout)
+      return 0
+    finally:
+      logging.info('quitting')
+
   logging.info('starting')
   remote = xsrf_client.XsrfRemote(options.swarming_server)
 
@@ -355,7 +886,8 @@ def main(args):
 
   try:
     if not load_and_run(
-        options.file, remote, options.cost_usd_hour, options.start):
+        options.file, remote, options.cost_usd_hour, options.start,
+        options.work_dir):
       return TASK_FAILED
     return 0
   finally:
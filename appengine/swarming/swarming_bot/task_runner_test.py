@@ -6,6 +6,7 @@
 
 import StringIO
 import base64
+import gzip
 import json
 import logging
 import os
@@ -14,6 +15,7 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import unittest
 import zipfile
@@ -27,6 +29,7 @@ if os.path.isfile(os.path.join(THIS_DIR, 'utils')):
 
 # Import everything that does not require sys.path hack first.
 import logging_utils
+import os_utilities
 import task_runner
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -63,6 +66,8 @@ class TestTaskRunnerBase(net_utils.TestCase):
     self.work_dir = os.path.join(self.root_dir, 'work')
     os.chdir(self.root_dir)
     os.mkdir(self.work_dir)
+    # Disable data cache eviction by default.
+    self.mock(os_utilities, 'get_disks_info', lambda: {})
 
   def tearDown(self):
     os.chdir(BASE_DIR)
@@ -75,6 +80,7 @@ class TestTaskRunnerBase(net_utils.TestCase):
     return task_runner.TaskDetails(
         {
           'bot_id': 'localhost',
+          'caches': [],
           'command': [sys.executable, '-u', '-c', script],
           'data': [],
           'env': {},
@@ -88,7 +94,10 @@ class TestTaskRunnerBase(net_utils.TestCase):
     requests = [
       (
         'https://localhost:1/auth/api/v1/accounts/self/xsrf_token',
-        {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+        {
+          'data': {},
+          'headers': {'X-XSRF-Token-Request': '1'},
+        },
         {'xsrf_token': 'token'},
       ),
       (
@@ -104,6 +113,19 @@ class TestTaskRunnerBase(net_utils.TestCase):
     ]
     self.expected_requests(requests)
 
+  def mock_url_retrieve(self, archives):
+    """Mocks net.url_retrieve() and returns the list of urls fetched."""
+    fetched = []
+    def url_retrieve(filepath, url):
+      fetched.append(url)
+      if url not in archives:
+        return False
+      with open(filepath, 'wb') as f:
+        f.write(compress_to_zip(archives[url]))
+      return True
+    self.mock(task_runner.net, 'url_retrieve', url_retrieve)
+    return fetched
+
   def get_check_first(self, cost_usd):
     def check_first(kwargs):
       self.assertLessEqual(cost_usd, kwargs['data'].pop('cost_usd'))
@@ -124,13 +146,16 @@ class TestTaskRunner(TestTaskRunnerBase):
     super(TestTaskRunner, self).setUp()
     self.mock(time, 'time', lambda: 1000000000.)
 
-  def get_check_final(self, exit_code=0, output='hi\n'):
+  def get_check_final(self, exit_code=0, output='hi\n', bot_timings=None):
+    if bot_timings is None:
+      bot_timings = {'execution': 0., 'process_start': 0., 'upload': 0.}
     def check_final(kwargs):
       # It makes the diffing easier.
       kwargs['data']['output'] = base64.b64decode(kwargs['data']['output'])
       self.assertEqual(
           {
             'data': {
+              'bot_timings': bot_timings,
               'cost_usd': 10.,
               'duration': 0.,
               'exit_code': exit_code,
@@ -154,47 +179,152 @@ class TestTaskRunner(TestTaskRunnerBase):
         server, task_details, '.', 3600., start)
 
   def test_download_data(self):
-    requests = [
-      (
-        'https://localhost:1/a',
-        {},
-        compress_to_zip({'file1': 'content1', 'file2': 'content2'}),
-        None,
-      ),
-      (
-        'https://localhost:1/b',
-        {},
-        compress_to_zip({'file3': 'content3'}),
-        None,
-      ),
-    ]
-    self.expected_requests(requests)
-    items = [(i[0], 'foo.zip') for i in requests]
-    task_runner.download_data(self.root_dir, items)
+    archives = {
+      'https://localhost:1/a': {'file1': 'content1', 'file2': 'content2'},
+      'https://localhost:1/b': {'file3': 'content3'},
+    }
+    fetched = self.mock_url_retrieve(archives)
+    items = [(i, 'foo.zip') for i in sorted(archives)]
+    cache_dir = os.path.join(self.root_dir, 'data_cache')
+    task_runner.download_data(self.work_dir, items, cache_dir)
     self.assertEqual(
-        ['file1', 'file2', 'file3', 'work'], sorted(os.listdir(self.root_dir)))
+        ['file1', 'file2', 'file3'], sorted(os.listdir(self.work_dir)))
+    self.assertEqual(sorted(archives), sorted(fetched))
+    self.assertEqual(2, len(os.listdir(cache_dir)))
 
-  def test_load_and_run(self):
-    requests = [
-      (
-        'https://localhost:1/f',
-        {},
-        compress_to_zip({'file3': 'content3'}),
-        None,
-      ),
+    # Second time, it's served from the cache.
+    shutil.rmtree(self.work_dir)
+    os.mkdir(self.work_dir)
+    task_runner.download_data(self.work_dir, items, cache_dir)
+    self.assertEqual(
+        ['file1', 'file2', 'file3'], sorted(os.listdir(self.work_dir)))
+    self.assertEqual(2, len(fetched))
+
+  def test_download_data_order(self):
+    # When a file is present in multiple archives, the last one wins.
+    archives = {
+      'https://localhost:1/a': {'file1': 'a'},
+      'https://localhost:1/b': {'file1': 'b'},
+    }
+    self.mock_url_retrieve(archives)
+    items = [('https://localhost:1/a', 'a'), ('https://localhost:1/b', 'b')]
+    cache_dir = os.path.join(self.root_dir, 'data_cache')
+    task_runner.download_data(self.work_dir, items, cache_dir)
+    with open(os.path.join(self.work_dir, 'file1'), 'rb') as f:
+      self.assertEqual('b', f.read())
+
+  def test_download_data_fail(self):
+    self.mock_url_retrieve({})
+    cache_dir = os.path.join(self.root_dir, 'data_cache')
+    with self.assertRaises(Exception):
+      task_runner.download_data(
+          self.work_dir, [('https://localhost:1/a', 'a')], cache_dir)
+    self.assertEqual([], os.listdir(cache_dir))
+
+  def test_download_data_evicted(self):
+    # The archive is evicted by another task_runner right after the cache hit.
+    archives = {'https://localhost:1/a': {'file1': 'content1'}}
+    fetched = self.mock_url_retrieve(archives)
+    items = [('https://localhost:1/a', 'a')]
+    cache_dir = os.path.join(self.root_dir, 'data_cache')
+    task_runner.download_data(self.work_dir, items, cache_dir)
+    self.assertEqual(1, len(fetched))
+
+    # pylint: disable=W0212
+    fetch_to_cache = task_runner._fetch_to_cache
+    def _fetch_to_cache(*args):
+      path = fetch_to_cache(*args)
+      if len(fetched) == 1:
+        os.remove(path)
+      return path
+    self.mock(task_runner, '_fetch_to_cache', _fetch_to_cache)
+    os.remove(os.path.join(self.work_dir, 'file1'))
+    task_runner.download_data(self.work_dir, items, cache_dir)
+    self.assertEqual(['file1'], os.listdir(self.work_dir))
+    self.assertEqual(2, len(fetched))
+
+  def test_trim_data_cache(self):
+    cache_dir = os.path.join(self.root_dir, 'data_cache')
+    os.mkdir(cache_dir)
+    for i, name in enumerate(('b.zip', 'a.zip', 'c.zip')):
+      path = os.path.join(cache_dir, name)
+      with open(path, 'wb') as f:
+        f.write(name)
+      os.utime(path, (i, i))
+    # Each eviction frees 1Mb.
+    free = [1]
+    def get_disks_info():
+      free[0] += 1
+      return {self.root_dir: {'free_mb': free[0], 'size_mb': 100}}
+    self.mock(os_utilities, 'get_disks_info', get_disks_info)
+    task_runner.trim_data_cache(cache_dir, 4)
+    self.assertEqual(['c.zip'], os.listdir(cache_dir))
+
+  def test_named_caches(self):
+    cache_dir = os.path.join(self.root_dir, task_runner.NAMED_CACHES_DIR)
+    caches = [
+      {'name': 'git', 'path': 'git_cache'},
+      {'name': 'out', 'path': 'src/out'},
     ]
-    self.expected_requests(requests)
+    # The first task starts with empty caches.
+    task_runner.install_named_caches(self.work_dir, caches, cache_dir)
+    self.assertEqual([], os.listdir(os.path.join(self.work_dir, 'git_cache')))
+    with open(os.path.join(self.work_dir, 'src', 'out', 'a'), 'wb') as f:
+      f.write('a')
+    task_runner.uninstall_named_caches(self.work_dir, caches, cache_dir)
+    self.assertEqual(['git', 'out'], sorted(os.listdir(cache_dir)))
+    self.assertEqual(['src'], os.listdir(self.work_dir))
+
+    # The second task gets the warm cache.
+    task_runner.install_named_caches(self.work_dir, caches[1:], cache_dir)
+    self.assertEqual(['git'], os.listdir(cache_dir))
+    self.assertEqual(['a'], os.listdir(os.path.join(self.work_dir, 'src/out')))
+
+  def test_named_caches_conflict(self):
+    cache_dir = os.path.join(self.root_dir, task_runner.NAMED_CACHES_DIR)
+    os.makedirs(os.path.join(cache_dir, 'git'))
+    os.makedirs(os.path.join(self.work_dir, 'src', 'out'))
+    caches = [
+      {'name': 'git', 'path': 'git_cache'},
+      {'name': 'out', 'path': 'src/out'},
+    ]
+    with self.assertRaises(ValueError):
+      task_runner.install_named_caches(self.work_dir, caches, cache_dir)
+    # Nothing was moved nor deleted.
+    self.assertEqual(['git'], os.listdir(cache_dir))
+    self.assertEqual(['src'], os.listdir(self.work_dir))
+    self.assertEqual(['out'], os.listdir(os.path.join(self.work_dir, 'src')))
+
+  def test_trim_named_caches(self):
+    cache_dir = os.path.join(self.root_dir, task_runner.NAMED_CACHES_DIR)
+    for i, name in enumerate(('b', 'a', 'c')):
+      path = os.path.join(cache_dir, name)
+      os.makedirs(path)
+      os.utime(path, (i, i))
+    # Each eviction frees 1Mb.
+    free = [1]
+    def get_disks_info():
+      free[0] += 1
+      return {self.root_dir: {'free_mb': free[0], 'size_mb': 100}}
+    self.mock(os_utilities, 'get_disks_info', get_disks_info)
+    task_runner.trim_named_caches(cache_dir, 4)
+    self.assertEqual(['c'], os.listdir(cache_dir))
+
+  def test_load_and_run(self):
+    self.mock_url_retrieve({'https://localhost:1/f': {'file3': 'content3'}})
     server = xsrf_client.XsrfRemote('https://localhost:1/')
 
     runs = []
     def run_command(
-        swarming_server, task_details, work_dir, cost_usd_hour, start):
+        swarming_server, task_details, work_dir, cost_usd_hour, start,
+        timings):
       self.assertEqual(server, swarming_server)
       # Necessary for OSX.
       self.assertEqual(os.path.realpath(self.work_dir), work_dir)
       self.assertTrue(isinstance(task_details, task_runner.TaskDetails))
       self.assertEqual(3600., cost_usd_hour)
       self.assertEqual(time.time(), start)
+      self.assertEqual({'download': 0., 'setup': 0.}, timings)
       runs.append(0)
       return 0
     self.mock(task_runner, 'run_command', run_command)
@@ -203,6 +333,7 @@ class TestTaskRunner(TestTaskRunnerBase):
     with open(manifest, 'wb') as f:
       data = {
         'bot_id': 'localhost',
+        'caches': [],
         'command': ['a'],
         'data': [('https://localhost:1/f', 'foo.zip')],
         'env': {'d': 'e'},
@@ -214,30 +345,26 @@ class TestTaskRunner(TestTaskRunnerBase):
       json.dump(data, f)
 
     self.assertEqual(
-        True, task_runner.load_and_run(manifest, server, 3600., time.time()))
+        True,
+        task_runner.load_and_run(
+            manifest, server, 3600., time.time(), self.work_dir))
     self.assertEqual([0], runs)
 
   def test_load_and_run_fail(self):
-    requests = [
-      (
-        'https://localhost:1/f',
-        {},
-        compress_to_zip({'file3': 'content3'}),
-        None,
-      ),
-    ]
-    self.expected_requests(requests)
+    self.mock_url_retrieve({'https://localhost:1/f': {'file3': 'content3'}})
     server = xsrf_client.XsrfRemote('https://localhost:1/')
 
     runs = []
     def run_command(
-        swarming_server, task_details, work_dir, cost_usd_hour, start):
+        swarming_server, task_details, work_dir, cost_usd_hour, start,
+        timings):
       self.assertEqual(server, swarming_server)
       # Necessary for OSX.
       self.assertEqual(os.path.realpath(self.work_dir), work_dir)
       self.assertTrue(isinstance(task_details, task_runner.TaskDetails))
       self.assertEqual(3600., cost_usd_hour)
       self.assertEqual(time.time(), start)
+      self.assertEqual({'download': 0., 'setup': 0.}, timings)
       runs.append(0)
       # Fails the first, pass the second.
       return 1 if len(runs) == 1 else 0
@@ -247,6 +374,7 @@ class TestTaskRunner(TestTaskRunnerBase):
     with open(manifest, 'wb') as f:
       data = {
         'bot_id': 'localhost',
+        'caches': [],
         'command': ['a'],
         'data': [('https://localhost:1/f', 'foo.zip')],
         'env': {'d': 'e'},
@@ -258,7 +386,9 @@ class TestTaskRunner(TestTaskRunnerBase):
       json.dump(data, f)
 
     self.assertEqual(
-        False, task_runner.load_and_run(manifest, server, 3600., time.time()))
+        False,
+        task_runner.load_and_run(
+            manifest, server, 3600., time.time(), self.work_dir))
     self.assertEqual([0], runs)
 
   def test_run_command(self):
@@ -285,10 +415,13 @@ class TestTaskRunner(TestTaskRunnerBase):
       'Command "executable_that_shouldnt_be_on_your_system '
       'thus_raising_OSError" failed to start.\n'
       'Error: [Errno 2] No such file or directory')
-    self.requests(cost_usd=10., exit_code=1, output=output)
+    self.requests(
+        cost_usd=10., exit_code=1, output=output,
+        bot_timings={'process_start': 0.})
     task_details = task_runner.TaskDetails(
         {
           'bot_id': 'localhost',
+          'caches': [],
           'command': [
             'executable_that_shouldnt_be_on_your_system',
             'thus_raising_OSError',
@@ -337,30 +470,40 @@ class TestTaskRunner(TestTaskRunnerBase):
 
     self.mock(subprocess42, 'Popen', Popen)
 
-    def check_final(kwargs):
-      self.assertEqual(
-          {
-            'data': {
-              # That's because the cost includes the duration starting at start,
-              # not when the process was started.
-              'cost_usd': 10.,
-              'duration': 0.,
-              'exit_code': 0,
-              'hard_timeout': False,
-              'id': 'localhost',
-              'io_timeout': False,
-              'output': base64.b64encode('hi!\n'),
-              'output_chunk_start': 100002*4,
-              'task_id': 23,
+    # The output is sent in chunks by the uploader thread. The remainder is too
+    # large to be sent along the last packet so it is sent by the uploader too.
+    output = 'hi!\n' * 100003
+    chunks = [
+      output[i:i+task_runner.MAX_CHUNK_SIZE]
+      for i in xrange(0, len(output), task_runner.MAX_CHUNK_SIZE)
+    ]
+    self.assertEqual(4, len(chunks))
+
+    # The packets with output are large enough to be sent compressed.
+    def get_check_gzip(expected):
+      def check_gzip(kwargs):
+        with gzip.GzipFile(
+            fileobj=StringIO.StringIO(kwargs.pop('data'))) as f:
+          data = json.load(f)
+        self.assertEqual(
+            {
+              'content_type': 'application/json; charset=utf-8',
+              'headers': {
+                'Content-Encoding': 'gzip',
+                'X-XSRF-Token': 'token',
+              },
             },
-            'headers': {'X-XSRF-Token': 'token'},
-          },
-          kwargs)
+            kwargs)
+        self.assertEqual(expected, data)
+      return check_gzip
 
     requests = [
       (
         'https://localhost:1/auth/api/v1/accounts/self/xsrf_token',
-        {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+        {
+          'data': {},
+          'headers': {'X-XSRF-Token-Request': '1'},
+        },
         {'xsrf_token': 'token'},
       ),
       (
@@ -375,31 +518,52 @@ class TestTaskRunner(TestTaskRunnerBase):
         },
         {},
       ),
+    ]
+    for i, chunk in enumerate(chunks):
+      requests.append(
+        (
+          'https://localhost:1/swarming/api/v1/bot/task_update/23',
+          get_check_gzip(
+            {
+              'cost_usd': 10.,
+              'id': 'localhost',
+              'output': base64.b64encode(chunk),
+              'output_chunk_start': i * task_runner.MAX_CHUNK_SIZE,
+              'task_id': 23,
+            }),
+          '{}',
+          None,
+        ))
+    requests.append(
       (
         'https://localhost:1/swarming/api/v1/bot/task_update/23',
         {
           'data': {
+            'bot_timings': {
+              'execution': 0.,
+              'process_start': 0.,
+              'upload': 0.,
+            },
+            # That's because the cost includes the duration starting at
+            # start, not when the process was started.
             'cost_usd': 10.,
+            'duration': 0.,
+            'exit_code': 0,
+            'hard_timeout': False,
             'id': 'localhost',
-            'output': base64.b64encode('hi!\n' * 100002),
-            'output_chunk_start': 0,
+            'io_timeout': False,
             'task_id': 23,
           },
           'headers': {'X-XSRF-Token': 'token'},
         },
         {},
-      ),
-      (
-        'https://localhost:1/swarming/api/v1/bot/task_update/23',
-        check_final,
-        {},
-      ),
-    ]
+      ))
     self.expected_requests(requests)
     server = xsrf_client.XsrfRemote('https://localhost:1/')
     task_details = task_runner.TaskDetails(
         {
           'bot_id': 'localhost',
+          'caches': [],
           'command': ['large', 'executable'],
           'data': [],
           'env': {},
@@ -414,12 +578,83 @@ class TestTaskRunner(TestTaskRunnerBase):
         server, task_details, './', 3600., start)
     self.assertEqual(0, r)
 
+  def test_output_uploader_error(self):
+    # An error while sending an update is surfaced to the reader, even when it
+    # waited on a full buffer.
+    def post_update(*_):
+      raise ValueError('Oops')
+    self.mock(task_runner, 'post_update', post_update)
+    self.mock(task_runner, 'MAX_BUFFERED_OUTPUT', task_runner.MAX_CHUNK_SIZE)
+    # pylint: disable=W0212
+    uploader = task_runner._OutputUploader(None, {}, 3600., time.time())
+    uploader.start()
+    uploader.add('a' * task_runner.MAX_CHUNK_SIZE, 60)
+    with self.assertRaises(ValueError):
+      uploader.add('b', 60)
+    with self.assertRaises(ValueError):
+      uploader.stop()
+
+  def test_output_uploader_add_timeout(self):
+    # A slow server doesn't block the reader past the timeout and the output
+    # is still buffered.
+    posting = threading.Event()
+    release = threading.Event()
+    def post_update(*_):
+      posting.set()
+      release.wait()
+      return {}
+    self.mock(task_runner, 'post_update', post_update)
+    self.mock(task_runner, 'MAX_BUFFERED_OUTPUT', task_runner.MAX_CHUNK_SIZE)
+    # pylint: disable=W0212
+    uploader = task_runner._OutputUploader(None, {}, 3600., time.time())
+    uploader.start()
+    uploader.add('a' * task_runner.MAX_CHUNK_SIZE, 0.01)
+    posting.wait()
+    uploader.add('b', 0.01)
+    release.set()
+    self.assertEqual(('b', task_runner.MAX_CHUNK_SIZE), uploader.stop())
+
+  def test_update_policy(self):
+    policy = task_runner.UpdatePolicy()
+    self.assertEqual(task_runner.MAX_CHUNK_SIZE, policy.packet_size)
+    self.assertEqual(
+        task_runner.MIN_PACKET_INTERNAL, policy.packet_interval(True))
+    self.assertEqual(
+        task_runner.MAX_PACKET_INTERVAL, policy.packet_interval(False))
+    self.assertEqual(False, policy.should_post('a', 100., 95.))
+    self.assertEqual(True, policy.should_post('a', 100., 80.))
+    self.assertEqual(False, policy.should_post('', 100., 80.))
+    self.assertEqual(
+        True, policy.should_post('a' * task_runner.MAX_CHUNK_SIZE, 100., 99.))
+
+    # A quiet task backs off.
+    policy.on_packet_sent(0, 30., 0.1, {})
+    self.assertEqual(
+        task_runner.MAX_IDLE_PACKET_INTERVAL, policy.packet_interval(False))
+
+    # A noisy task sends larger packets, but not larger than MAX_PACKET_SIZE.
+    for _ in xrange(10):
+      policy.on_packet_sent(task_runner.MAX_CHUNK_SIZE, 1., 0.1, {})
+    self.assertEqual(task_runner.MAX_PACKET_SIZE, policy.packet_size)
+    self.assertEqual(
+        task_runner.MAX_PACKET_INTERVAL, policy.packet_interval(False))
+
+    # A slow server and the server hint stretch the interval.
+    policy.on_packet_sent(task_runner.MAX_CHUNK_SIZE, 1., 10., {})
+    self.assertLess(30., policy.packet_interval(True))
+    policy.on_packet_sent(
+        task_runner.MAX_CHUNK_SIZE, 1., 0., {'update_interval_secs': 45})
+    self.assertEqual(45., policy.packet_interval(True))
+    self.assertEqual(45., policy.packet_interval(False))
+
   def test_main(self):
-    def load_and_run(manifest, swarming_server, cost_usd_hour, start):
+    def load_and_run(
+        manifest, swarming_server, cost_usd_hour, start, work_dir):
       self.assertEqual('foo', manifest)
       self.assertEqual('http://localhost', swarming_server.url)
       self.assertEqual(3600., cost_usd_hour)
       self.assertEqual(time.time(), start)
+      self.assertEqual('work', work_dir)
       return True
 
     self.mock(task_runner, 'load_and_run', load_and_run)
@@ -430,11 +665,13 @@ class TestTaskRunner(TestTaskRunnerBase):
     self.assertEqual(0, task_runner.main(cmd))
 
   def test_main_reboot(self):
-    def load_and_run(manifest, swarming_server, cost_usd_hour, start):
+    def load_and_run(
+        manifest, swarming_server, cost_usd_hour, start, work_dir):
       self.assertEqual('foo', manifest)
       self.assertEqual('http://localhost', swarming_server.url)
       self.assertEqual(3600., cost_usd_hour)
       self.assertEqual(time.time(), start)
+      self.assertEqual('work', work_dir)
       return False
 
     self.mock(task_runner, 'load_and_run', load_and_run)
@@ -444,6 +681,49 @@ class TestTaskRunner(TestTaskRunnerBase):
     ]
     self.assertEqual(task_runner.TASK_FAILED, task_runner.main(cmd))
 
+  def test_serve(self):
+    calls = []
+    def load_and_run(
+        manifest, swarming_server, cost_usd_hour, start, work_dir):
+      calls.append(
+          (manifest, swarming_server.url, cost_usd_hour, start, work_dir,
+            os.environ.get('SWARMING_TASK_ID')))
+      if manifest == 'raise':
+        raise IOError('Dang')
+      return manifest == 'pass'
+    self.mock(task_runner, 'load_and_run', load_and_run)
+    os.environ.pop('SWARMING_TASK_ID', None)
+
+    requests = [
+      {
+        'cost_usd_hour': 3600.,
+        'env': {'SWARMING_TASK_ID': str(i)},
+        'file': name,
+        'start': time.time(),
+        'swarming_server': 'http://localhost',
+        'work_dir': 'work%d' % i,
+      }
+      for i, name in enumerate(('pass', 'fail', 'raise'))
+    ]
+    stdin = StringIO.StringIO(''.join(json.dumps(r) + '\n' for r in requests))
+    stdout = StringIO.StringIO()
+    task_runner.serve(stdin, stdout)
+    expected = [
+      {'exit_code': 0},
+      {'exit_code': task_runner.TASK_FAILED},
+      {'exit_code': 1},
+    ]
+    self.assertEqual(
+        expected, [json.loads(l) for l in stdout.getvalue().splitlines()])
+    expected = [
+      ('pass', 'http://localhost', 3600., time.time(), 'work0', '0'),
+      ('fail', 'http://localhost', 3600., time.time(), 'work1', '1'),
+      ('raise', 'http://localhost', 3600., time.time(), 'work2', '2'),
+    ]
+    self.assertEqual(expected, calls)
+    # The environment is restored after each task.
+    self.assertNotIn('SWARMING_TASK_ID', os.environ)
+
 
 class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
   # Do not mock time.time() for these tests otherwise it becomes a tricky
@@ -500,6 +780,9 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
     def check_final(kwargs):
       self.assertLess(self.SHORT_TIME_OUT, kwargs['data'].pop('cost_usd'))
       self.assertLess(self.SHORT_TIME_OUT, kwargs['data'].pop('duration'))
+      self.assertEqual(
+          ['execution', 'process_start', 'upload'],
+          sorted(kwargs['data'].pop('bot_timings')))
       # It makes the diffing easier.
       kwargs['data']['output'] = base64.b64decode(kwargs['data']['output'])
       self.assertEqual(
@@ -539,6 +822,40 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
         self.SCRIPT_HANG, io_timeout=self.SHORT_TIME_OUT)
     self.assertEqual(sig, self._run(details))
 
+  def test_canceled(self):
+    # The server asks to kill the task on the first update as it was canceled.
+    # Actually 0xc000013a
+    sig = -1073741510 if sys.platform == 'win32' else -signal.SIGTERM
+    def check_final(kwargs):
+      data = kwargs['data']
+      self.assertEqual(sig, data['exit_code'])
+      self.assertEqual(False, data['hard_timeout'])
+      self.assertEqual(False, data['io_timeout'])
+      self.assertEqual(True, data['killed'])
+      self.assertEqual('hi\n', base64.b64decode(data['output']))
+    requests = [
+      (
+        'https://localhost:1/auth/api/v1/accounts/self/xsrf_token',
+        {
+          'data': {},
+          'headers': {'X-XSRF-Token-Request': '1'},
+        },
+        {'xsrf_token': 'token'},
+      ),
+      (
+        'https://localhost:1/swarming/api/v1/bot/task_update/23',
+        self.get_check_first(0.),
+        {'must_stop': True, 'ok': True},
+      ),
+      (
+        'https://localhost:1/swarming/api/v1/bot/task_update/23',
+        check_final,
+        {'must_stop': False, 'ok': True},
+      ),
+    ]
+    self.expected_requests(requests)
+    self.assertEqual(sig, self._run(self.get_task_details(self.SCRIPT_HANG)))
+
   def test_hard_signal(self):
     sig = signal.SIGBREAK if sys.platform == 'win32' else signal.SIGTERM
     self.requests(
@@ -2,11 +2,22 @@
 # Use of this source code is governed by the Apache v2.0 license that can be
 # found in the LICENSE file.
 
-"""A helper script for wrapping url calls."""
+"""A helper script for wrapping url calls.
 
+The connections are kept alive and pooled per host by utils/net.py, so all the
+calls done by a process to the server reuse the same connections.
+"""
+
+import StringIO
+import gzip
+import json
 import logging
 import os
+import random
+import re
 import sys
+import threading
+import time
 
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -15,10 +26,51 @@ sys.path.insert(0, os.path.join(THIS_DIR, 'third_party'))
 from utils import net
 
 
+# POST bodies at least this large are sent gzip compressed.
+GZIP_MIN_SIZE = 8192
+
+
 class Error(Exception):
   pass
 
 
+class RetryBudget(object):
+  """Limits the retries to a ratio of the successful requests.
+
+  Each successful request adds |ratio| token, each retry spends one. Once the
+  budget is spent, the requests are not retried anymore so a fleet of bots
+  doesn't amplify the load on a server that is already failing.
+
+  Only the retry done by XsrfRemote after refreshing the token is charged; net
+  keeps its own retries and backoff.
+  """
+  def __init__(self, ratio=0.1, max_tokens=10.):
+    self.ratio = ratio
+    self.max_tokens = max_tokens
+    self._tokens = max_tokens
+    self._lock = threading.Lock()
+
+  def on_success(self):
+    with self._lock:
+      self._tokens = min(self._tokens + self.ratio, self.max_tokens)
+
+  def spend(self):
+    """Returns True if a retry can be done."""
+    with self._lock:
+      if self._tokens < 1:
+        return False
+      self._tokens -= 1
+      return True
+
+
+def _gzip(content):
+  """Returns content gzip compressed, reproducibly."""
+  out = StringIO.StringIO()
+  with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as f:
+    f.write(content)
+  return out.getvalue()
+
+
 class XsrfRemote(object):
   """Transparently adds XSRF token to requests."""
   TOKEN_RESOURCE = '/auth/api/v1/accounts/self/xsrf_token'
@@ -28,21 +80,27 @@ class XsrfRemote(object):
     self.token = None
     self.token_resource = token_resource or self.TOKEN_RESOURCE
     self.xsrf_request_params = {}
+    self.retry_budget = RetryBudget()
+    # The remote is shared by the threads running the task slots, see
+    # bot_main._TaskSlots. Only one of them refreshes the token at a time.
+    self._token_lock = threading.Lock()
+    self._stats_lock = threading.Lock()
+    # Per resource counters, see get_stats().
+    self._stats = {}
 
   def url_read(self, resource, **kwargs):
     url = self.url + resource
     if kwargs.get('data') == None:
       # No XSRF token for GET.
-      return net.url_read(url, **kwargs)
+      return self._call(net.url_read, resource, url, **kwargs)
 
-    if not self.token:
-      self.token = self.refresh_token()
-    resp = self._url_read_post(url, **kwargs)
-    if resp is None:
+    token = self._get_token()
+    resp = self._url_read_post(resource, url, token, **kwargs)
+    if resp is None and self._backoff():
       # This includes 403 because the XSRF token expired. Renew the token.
       # TODO(maruel): It'd be great if it were transparent.
-      self.refresh_token()
-      resp = self._url_read_post(url, **kwargs)
+      token = self._renew_token(token)
+      resp = self._url_read_post(resource, url, token, **kwargs)
     if resp is None:
       raise Error('Failed to connect to %s' % url)
     return resp
@@ -51,27 +109,52 @@ class XsrfRemote(object):
     url = self.url + resource
     if kwargs.get('data') == None:
       # No XSRF token required for GET.
-      return net.url_read_json(url, **kwargs)
+      return self._call(net.url_read_json, resource, url, **kwargs)
 
-    if not self.token:
-      self.token = self.refresh_token()
-    resp = self._url_read_json_post(url, **kwargs)
-    if resp is None:
+    token = self._get_token()
+    resp = self._url_read_json_post(resource, url, token, **kwargs)
+    if resp is None and self._backoff():
       logging.error('Forcibly refreshing; %s, %s', url, kwargs)
       # This includes 403 because the XSRF token expired. Renew the token.
       # TODO(maruel): It'd be great if it were transparent.
-      self.refresh_token()
-      resp = self._url_read_json_post(url, **kwargs)
+      token = self._renew_token(token)
+      resp = self._url_read_json_post(resource, url, token, **kwargs)
     if resp is None:
       raise Error('Failed to connect to %s' % url)
     return resp
 
+  def get_stats(self):
+    """Returns the counters of the requests done, per resource.
+
+    The durations are in seconds.
+    """
+    with self._stats_lock:
+      return dict((k, v.copy()) for k, v in self._stats.iteritems())
+
   def refresh_token(self):
     """Returns a fresh token. Necessary as the token may expire after an hour.
     """
+    with self._token_lock:
+      return self._refresh_token_locked()
+
+  def _get_token(self):
+    """Returns the current token, fetching one if necessary."""
+    with self._token_lock:
+      return self.token or self._refresh_token_locked()
+
+  def _renew_token(self, stale):
+    """Returns a fresh token, unless another thread already replaced the stale
+    one.
+    """
+    with self._token_lock:
+      if self.token != stale:
+        return self.token
+      return self._refresh_token_locked()
+
+  def _refresh_token_locked(self):
     url = self.url + self.token_resource
-    resp = net.url_read_json(
-        url,
+    resp = self._call(
+        net.url_read_json, self.token_resource, url,
         headers={'X-XSRF-Token-Request': '1'},
         data=self.xsrf_request_params)
     if resp is None:
@@ -79,12 +162,55 @@ class XsrfRemote(object):
     self.token = resp['xsrf_token']
     return self.token
 
-  def _url_read_post(self, url, **kwargs):
+  def _url_read_post(self, resource, url, token, **kwargs):
     headers = (kwargs.pop('headers', None) or {}).copy()
-    headers['X-XSRF-Token'] = self.token
-    return net.url_read(url, headers=headers, **kwargs)
+    headers['X-XSRF-Token'] = token
+    return self._call(net.url_read, resource, url, headers=headers, **kwargs)
 
-  def _url_read_json_post(self, url, **kwargs):
+  def _url_read_json_post(self, resource, url, token, **kwargs):
     headers = (kwargs.pop('headers', None) or {}).copy()
-    headers['X-XSRF-Token'] = self.token
-    return net.url_read_json(url, headers=headers, **kwargs)
+    headers['X-XSRF-Token'] = token
+    body = json.dumps(kwargs['data'], sort_keys=True, separators=(',', ':'))
+    if len(body) < GZIP_MIN_SIZE:
+      return self._call(
+          net.url_read_json, resource, url, headers=headers, **kwargs)
+
+    # Large bodies, like task_update with output, are worth compressing. The
+    # server handles the Content-Encoding header, see ApiHandler.parse_body().
+    headers['Content-Encoding'] = 'gzip'
+    kwargs['data'] = _gzip(body)
+    kwargs['content_type'] = 'application/json; charset=utf-8'
+    resp = self._call(net.url_read, resource, url, headers=headers, **kwargs)
+    if resp is None:
+      return None
+    try:
+      return json.loads(resp)
+    except ValueError:
+      logging.error('Invalid json response from %s: %r', url, resp[:200])
+      return None
+
+  def _backoff(self):
+    """Returns True if the request can be retried, after a jittered sleep."""
+    if not self.retry_budget.spend():
+      logging.error('Retry budget exhausted, not retrying')
+      return False
+    time.sleep(random.uniform(0., 1.))
+    return True
+
+  def _call(self, func, resource, url, **kwargs):
+    """Calls a function of net and updates the counters."""
+    start = time.time()
+    resp = func(url, **kwargs)
+    duration = time.time() - start
+    if resp is not None:
+      self.retry_budget.on_success()
+    # Strip the ids from the resource to keep the number of keys bounded.
+    key = re.sub(r'/[0-9a-fA-F]+$', '', resource)
+    with self._stats_lock:
+      stats = self._stats.setdefault(
+          key, {'count': 0, 'failures': 0, 'duration': 0., 'max': 0.})
+      stats['count'] += 1
+      stats['failures'] += int(resp is None)
+      stats['duration'] += duration
+      stats['max'] = max(stats['max'], duration)
+    return resp
@@ -3,6 +3,9 @@
 # Use of this source code is governed by the Apache v2.0 license that can be
 # found in the LICENSE file.
 
+import StringIO
+import gzip
+import json
 import logging
 import os
 import sys
@@ -35,7 +38,8 @@ class UrlHelperTest(net_utils.TestCase):
     self.mock(time, 'sleep', lambda _: None)
 
   def testXsrfRemoteGET(self):
-    self.expected_requests([('http://localhost/a', {}, 'foo', None)])
+    self.expected_requests(
+        [('http://localhost/a', {}, 'foo', None)])
 
     remote = xsrf_client.XsrfRemote('http://localhost/')
     self.assertEqual('foo', remote.url_read('/a'))
@@ -45,12 +49,18 @@ class UrlHelperTest(net_utils.TestCase):
         [
           (
             'http://localhost/auth/api/v1/accounts/self/xsrf_token',
-            {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+            {
+              'data': {},
+              'headers': {'X-XSRF-Token-Request': '1'},
+            },
             {'xsrf_token': 'token'},
           ),
           (
             'http://localhost/a',
-            {'data': {'foo': 'bar'}, 'headers': {'X-XSRF-Token': 'token'}},
+            {
+              'data': {'foo': 'bar'},
+              'headers': {'X-XSRF-Token': 'token'},
+            },
             'foo',
             None,
           ),
@@ -64,12 +74,18 @@ class UrlHelperTest(net_utils.TestCase):
         [
           (
             'http://localhost/auth/api/v1/accounts/self/xsrf_token',
-            {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+            {
+              'data': {},
+              'headers': {'X-XSRF-Token-Request': '1'},
+            },
             {'xsrf_token': 'token'},
           ),
           (
             'http://localhost/a',
-            {'data': {'foo': 'bar'}, 'headers': {'X-XSRF-Token': 'token'}},
+            {
+              'data': {'foo': 'bar'},
+              'headers': {'X-XSRF-Token': 'token'},
+            },
             # Fake that the token went bad by returning None. XsrfRemote will
             # automatically try to refresh the token before retrying.
             None,
@@ -77,12 +93,18 @@ class UrlHelperTest(net_utils.TestCase):
           ),
           (
             'http://localhost/auth/api/v1/accounts/self/xsrf_token',
-            {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+            {
+              'data': {},
+              'headers': {'X-XSRF-Token-Request': '1'},
+            },
             {'xsrf_token': 'token2'},
           ),
           (
             'http://localhost/a',
-            {'data': {'foo': 'bar'}, 'headers': {'X-XSRF-Token': 'token2'}},
+            {
+              'data': {'foo': 'bar'},
+              'headers': {'X-XSRF-Token': 'token2'},
+            },
             'foo',
             None,
           ),
@@ -107,12 +129,18 @@ class UrlHelperTest(net_utils.TestCase):
           ),
           (
             'http://localhost/auth/api/v1/accounts/self/xsrf_token',
-            {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+            {
+              'data': {},
+              'headers': {'X-XSRF-Token-Request': '1'},
+            },
             {'xsrf_token': 'token2'},
           ),
           (
             'http://localhost/a',
-            {'data': {'foo': 'bar'}, 'headers': {'X-XSRF-Token': 'token2'}},
+            {
+              'data': {'foo': 'bar'},
+              'headers': {'X-XSRF-Token': 'token2'},
+            },
             'foo',
             None,
           ),
@@ -122,6 +150,33 @@ class UrlHelperTest(net_utils.TestCase):
     remote.token = 'invalid_token'
     remote.url_read('/a', data={'foo': 'bar'})
 
+  def testXsrfRemoteRefreshConcurrent(self):
+    remote = xsrf_client.XsrfRemote('http://localhost/')
+    remote.token = 'token'
+    def check(kwargs):
+      self.assertEqual(
+          {
+            'data': {'foo': 'bar'},
+            'headers': {'X-XSRF-Token': 'token'},
+          },
+          kwargs)
+      # Another thread refreshed the token meanwhile, it is not fetched again.
+      remote.token = 'token2'
+    self.expected_requests(
+        [
+          ('http://localhost/a', check, None, None),
+          (
+            'http://localhost/a',
+            {
+              'data': {'foo': 'bar'},
+              'headers': {'X-XSRF-Token': 'token2'},
+            },
+            'foo',
+            None,
+          ),
+        ])
+    self.assertEqual('foo', remote.url_read('/a', data={'foo': 'bar'}))
+
   def testXsrfRemoteCustom(self):
     # Use the new swarming bot API as an example of custom XSRF request handler.
     self.expected_requests(
@@ -136,7 +191,10 @@ class UrlHelperTest(net_utils.TestCase):
           ),
           (
             'http://localhost/a',
-            {'data': {'foo': 'bar'}, 'headers': {'X-XSRF-Token': 'token'}},
+            {
+              'data': {'foo': 'bar'},
+              'headers': {'X-XSRF-Token': 'token'},
+            },
             'foo',
             None,
           ),
@@ -148,6 +206,83 @@ class UrlHelperTest(net_utils.TestCase):
     remote.xsrf_request_params = {'attributes': 'b'}
     self.assertEqual('foo', remote.url_read('/a', data={'foo': 'bar'}))
 
+  def testXsrfRemoteRetryBudget(self):
+    self.expected_requests(
+        [
+          (
+            'http://localhost/a',
+            {
+              'data': {'foo': 'bar'},
+              'headers': {'X-XSRF-Token': 'token'},
+            },
+            None,
+            None,
+          ),
+        ])
+
+    remote = xsrf_client.XsrfRemote('http://localhost/')
+    remote.token = 'token'
+    self.mock(time, 'time', lambda: 10.)
+    # Exhaust the budget; the request is not retried by XsrfRemote.
+    while remote.retry_budget.spend():
+      pass
+    with self.assertRaises(xsrf_client.Error):
+      remote.url_read('/a', data={'foo': 'bar'})
+    self.assertEqual(
+        {'': {'count': 1, 'duration': 0., 'failures': 1, 'max': 0.}},
+        remote.get_stats())
+
+  def testRetryBudget(self):
+    budget = xsrf_client.RetryBudget(ratio=0.5, max_tokens=2.)
+    self.assertTrue(budget.spend())
+    self.assertTrue(budget.spend())
+    self.assertFalse(budget.spend())
+    budget.on_success()
+    self.assertFalse(budget.spend())
+    budget.on_success()
+    self.assertTrue(budget.spend())
+    self.assertFalse(budget.spend())
+    for _ in xrange(10):
+      budget.on_success()
+    # Capped at max_tokens.
+    self.assertTrue(budget.spend())
+    self.assertTrue(budget.spend())
+    self.assertFalse(budget.spend())
+
+  def testXsrfRemoteJsonGzip(self):
+    data = {'output': 'a' * xsrf_client.GZIP_MIN_SIZE}
+    def check(kwargs):
+      with gzip.GzipFile(fileobj=StringIO.StringIO(kwargs.pop('data'))) as f:
+        self.assertEqual(data, json.load(f))
+      expected = {
+        'content_type': 'application/json; charset=utf-8',
+        'headers': {'Content-Encoding': 'gzip', 'X-XSRF-Token': 'token'},
+      }
+      self.assertEqual(expected, kwargs)
+    self.expected_requests(
+        [
+          (
+            'http://localhost/swarming/api/v1/bot/task_update/23',
+            check,
+            '{"ok":true}',
+            None,
+          ),
+        ])
+
+    remote = xsrf_client.XsrfRemote('http://localhost/')
+    remote.token = 'token'
+    self.mock(time, 'time', lambda: 10.)
+    self.assertEqual(
+        {'ok': True},
+        remote.url_read_json(
+            '/swarming/api/v1/bot/task_update/23', data=data))
+    expected = {
+      '/swarming/api/v1/bot/task_update': {
+        'count': 1, 'duration': 0., 'failures': 0, 'max': 0.,
+      },
+    }
+    self.assertEqual(expected, remote.get_stats())
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -23,6 +23,7 @@ from components import auth
 from components import auth_testing
 from components import stats_framework
 from server import acl
+from server import bot_code
 from server import stats
 
 
@@ -33,6 +34,8 @@ class AppTestBase(test_case.TestCase):
     super(AppTestBase, self).setUp()
     self.bot_version = None
     self.source_ip = '192.168.2.2'
+    # The bot versions are otherwise kept in-process across tests.
+    self.mock(bot_code, '_BOT_VERSIONS', {})
     self.testbed.init_user_stub()
     self.testbed.init_search_stub()
 
@@ -66,7 +69,7 @@ class AppTestBase(test_case.TestCase):
 
   def _parse_line(self, line):
     # pylint: disable=W0212
-    actual = stats._parse_line(line, stats._Snapshot(), {}, {}, {})
+    actual = stats._parse_line(line, stats._Snapshot(), {}, {}, {}, {})
     self.assertEqual(True, actual, line)
 
   def set_as_anonymous(self):
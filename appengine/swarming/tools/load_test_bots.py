@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+# Copyright 2014 The Swarming Authors. All rights reserved.
+# Use of this source code is governed by the Apache v2.0 license that can be
+# found in the LICENSE file.
+
+"""Simulates a fleet of Swarming bots against a server to load test it.
+
+Each simulated bot is a thread that runs the real bot protocol: handshake,
+poll, then task_update with synthetic output when it is handed a task. The bots
+advertise the 'load_test' dimension like bot_main.py does in load test mode so
+they never steal tasks meant to real bots, and the triggered tasks request it.
+
+Thousands of bots are spread across a few processes. At the end, the QPS,
+p50/p99 latency and error rate are printed per endpoint. They are measured
+client-side, so the latency includes the network round trip and the scheduling
+delays of the simulated bots themselves. For the server's side of the story,
+the wall time and the RPCs per route are then fetched from the profiling
+snapshots of the minutes of the run, see components/profiling.py. Only a sample
+of the requests is profiled.
+
+If --swarming is not specified, a local dev server is started. The tool doesn't
+authenticate, so a remote server must whitelist the IP of this host as a bot;
+the profiling snapshots are only available on the local dev server, where the
+tool logs in as an admin and runs the profiling cron job itself.
+"""
+
+import base64
+import datetime
+import json
+import logging
+import multiprocessing
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+import urllib
+import urllib2
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(APP_DIR, '..', 'components'))
+sys.path.insert(0, os.path.join(APP_DIR, '..', 'components', 'third_party'))
+
+from support import local_app
+
+
+# Stack size of each simulated bot thread. The default is 8mb, which limits the
+# number of threads that can be run in a single process.
+THREAD_STACK_SIZE = 256*1024
+
+# Dimension always advertised by the simulated bots and requested by the
+# triggered tasks. Matches what bot_main.py uses when SWARMING_LOAD_TEST=1.
+LOAD_TEST_DIMENSION = ('load_test', '1')
+
+
+### Private stuff.
+
+
+class _Stats(object):
+  """Latency and error count per endpoint, safe to use across threads."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.latencies = {}
+    self.errors = {}
+
+  def add(self, endpoint, duration, failed):
+    with self._lock:
+      self.latencies.setdefault(endpoint, []).append(duration)
+      if failed:
+        self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+  def merge(self, other):
+    """Merges a to_dict() output from another process."""
+    with self._lock:
+      for endpoint, values in other['latencies'].iteritems():
+        self.latencies.setdefault(endpoint, []).extend(values)
+      for endpoint, value in other['errors'].iteritems():
+        self.errors[endpoint] = self.errors.get(endpoint, 0) + value
+
+  def to_dict(self):
+    with self._lock:
+      return {
+        'errors': self.errors.copy(),
+        'latencies': dict((k, v[:]) for k, v in self.latencies.iteritems()),
+      }
+
+
+def _percentile(sorted_values, percent):
+  """Returns the nearest-rank percentile of an already sorted list."""
+  if not sorted_values:
+    return 0.
+  index = int(round(percent / 100. * (len(sorted_values) - 1)))
+  return sorted_values[index]
+
+
+def _pick_dimensions(dimensions_mix):
+  """Returns one set of dimensions out of a list of (weight, dimensions)."""
+  total = sum(weight for weight, _ in dimensions_mix)
+  value = random.uniform(0, total)
+  for weight, dimensions in dimensions_mix:
+    value -= weight
+    if value <= 0:
+      return dimensions
+  return dimensions_mix[-1][1]
+
+
+def _parse_dimensions_mix(values):
+  """Parses the --dimensions arguments.
+
+  Each value is formatted as 'key=value,key=value[:weight]'.
+  """
+  out = []
+  for value in values or ['os=Linux']:
+    weight = 1.
+    if ':' in value:
+      value, weight = value.rsplit(':', 1)
+      weight = float(weight)
+    dimensions = {}
+    for item in value.split(','):
+      k, v = item.split('=', 1)
+      dimensions[k] = v
+    dimensions[LOAD_TEST_DIMENSION[0]] = LOAD_TEST_DIMENSION[1]
+    out.append((weight, dimensions))
+  return out
+
+
+class _Client(object):
+  """Wraps a HttpClient to record the latency of each request.
+
+  The latency is measured client-side.
+  """
+
+  def __init__(self, url, stats):
+    self._client = local_app.HttpClient(url)
+    self._stats = stats
+    # HTTP status of the last request, None if it didn't reach the server.
+    self.http_code = None
+
+  def json_request(self, endpoint, resource, body, headers=None):
+    """Returns the decoded reply or None on failure."""
+    start = time.time()
+    failed = True
+    self.http_code = None
+    headers = (headers or {}).copy()
+    headers['Content-Type'] = 'application/json; charset=UTF-8'
+    try:
+      resp = self._client.request(resource, json.dumps(body), headers=headers)
+      self.http_code = resp.http_code
+      failed = resp.http_code != 200
+      if failed:
+        logging.warning('%s: HTTP %d', resource, resp.http_code)
+        return None
+      return json.loads(resp.body)
+    except (urllib2.URLError, ValueError) as e:
+      logging.warning('%s: %s', resource, e)
+      return None
+    finally:
+      self._stats.add(endpoint, time.time() - start, failed)
+
+
+class _SimulatedBot(threading.Thread):
+  """Runs the bot protocol until the deadline is reached."""
+
+  def __init__(self, url, bot_id, dimensions, options, stats, deadline):
+    super(_SimulatedBot, self).__init__(name=bot_id)
+    self.daemon = True
+    self._bot_id = bot_id
+    self._client = _Client(url, stats)
+    self._deadline = deadline
+    self._options = options
+    self._dimensions = dict((k, [v]) for k, v in dimensions.iteritems())
+    self._dimensions['id'] = [bot_id]
+    self._started = time.time()
+    self._sleep_streak = 0
+    self._version = None
+    self._xsrf_token = None
+
+  def _body(self):
+    return {
+      'dimensions': self._dimensions,
+      'state': {
+        'running_time': time.time() - self._started,
+        'sleep_streak': self._sleep_streak,
+      },
+      'version': self._version or '1',
+    }
+
+  def _handshake(self):
+    resp = self._client.json_request(
+        'handshake', '/swarming/api/v1/bot/handshake', self._body(),
+        headers={'X-XSRF-Token-Request': '1'})
+    if not resp:
+      return False
+    self._version = resp['bot_version']
+    self._xsrf_token = resp['xsrf_token'].encode('ascii')
+    return True
+
+  def _post(self, endpoint, resource, body):
+    return self._client.json_request(
+        endpoint, resource, body, headers={'X-XSRF-Token': self._xsrf_token})
+
+  def _run_task(self, manifest):
+    """Streams synthetic output for the task then reports its completion."""
+    task_id = manifest['task_id']
+    resource = '/swarming/api/v1/bot/task_update/%s' % task_id
+    chunk = 'x' * (self._options.output_chunk_size - 1) + '\n'
+    offset = 0
+    start = time.time()
+    for _ in xrange(self._options.output_chunks):
+      time.sleep(self._options.task_duration / (self._options.output_chunks+1))
+      resp = self._post('task_update', resource, {
+        'cost_usd': 0.,
+        'id': self._bot_id,
+        'output': base64.b64encode(chunk),
+        'output_chunk_start': offset,
+        'task_id': task_id,
+      })
+      offset += len(chunk)
+      if resp and not resp.get('ok'):
+        break
+    time.sleep(self._options.task_duration / (self._options.output_chunks+1))
+    duration = time.time() - start
+    self._post('task_update', resource, {
+      'bot_timings': {'execution': duration},
+      'cost_usd': 0.,
+      'duration': duration,
+      'exit_code': 0,
+      'hard_timeout': False,
+      'id': self._bot_id,
+      'io_timeout': False,
+      'output': base64.b64encode(chunk),
+      'output_chunk_start': offset,
+      'task_id': task_id,
+    })
+
+  def run(self):
+    while time.time() < self._deadline and not self._handshake():
+      time.sleep(1)
+    while time.time() < self._deadline:
+      resp = self._post('poll', '/swarming/api/v1/bot/poll', self._body())
+      if not resp:
+        time.sleep(1)
+        continue
+      cmd = resp['cmd']
+      if cmd == 'run':
+        self._sleep_streak = 0
+        self._run_task(resp['manifest'])
+      elif cmd == 'sleep':
+        self._sleep_streak += 1
+        time.sleep(min(resp['duration'], self._options.max_sleep))
+      else:
+        # 'update' or 'restart'; a real bot would restart, the simulated one
+        # simply does a new handshake to pick up the server's bot version.
+        self._handshake()
+
+
+def _run_bots(url, first_bot, count, dimensions_mix, options, deadline):
+  """Runs |count| simulated bots in the current process.
+
+  Returns the collected stats as a dict.
+  """
+  threading.stack_size(THREAD_STACK_SIZE)
+  stats = _Stats()
+  bots = []
+  for i in xrange(first_bot, first_bot + count):
+    bot = _SimulatedBot(
+        url, 'load-test-bot-%d' % i, _pick_dimensions(dimensions_mix),
+        options, stats, deadline)
+    bot.start()
+    bots.append(bot)
+    # Stagger the initial handshakes so they do not all hit at once.
+    time.sleep(options.ramp_up / float(max(options.bots, 1)))
+  for bot in bots:
+    bot.join(max(deadline - time.time(), 0) + options.task_duration + 10)
+  return stats.to_dict()
+
+
+def _run_bots_process(args):
+  """multiprocessing entry point."""
+  return _run_bots(*args)
+
+
+def _client_handshake(url, stats):
+  """Does a client handshake to fail fast when the server denies the requests.
+
+  Returns:
+    tuple(_Client, xsrf_token, error message or None).
+  """
+  resource = '/swarming/api/v1/client/handshake'
+  client = _Client(url, stats)
+  resp = client.json_request(
+      'client_handshake', resource, {}, headers={'X-XSRF-Token-Request': '1'})
+  if resp:
+    return client, resp['xsrf_token'].encode('ascii'), None
+  if client.http_code in (401, 403):
+    return client, None, (
+        '%s%s denied the request with HTTP %d. This tool doesn\'t '
+        'authenticate so the IP of this host must be whitelisted as a bot on '
+        'the server.' % (url, resource, client.http_code))
+  return client, None, 'Failed to handshake with %s%s' % (url, resource)
+
+
+def _trigger_tasks(client, xsrf_token, dimensions_mix, options, deadline):
+  """Triggers tasks at a fixed rate until the deadline is reached."""
+  interval = 1. / options.tasks_per_sec
+  next_trigger = time.time()
+  i = 0
+  while time.time() < deadline:
+    request = {
+      'name': 'load-test-%d' % i,
+      'priority': 100,
+      'properties': {
+        'commands': [['python', '-c', 'print(\'hi\')']],
+        'data': [],
+        'dimensions': _pick_dimensions(dimensions_mix),
+        'env': {},
+        'execution_timeout_secs': 3600,
+        'io_timeout_secs': 1200,
+      },
+      'scheduling_expiration_secs': 600,
+      'tags': ['load_test:1'],
+      'user': 'load_test',
+    }
+    client.json_request(
+        'client_request', '/swarming/api/v1/client/request', request,
+        headers={'X-XSRF-Token': xsrf_token})
+    i += 1
+    next_trigger += interval
+    time.sleep(max(next_trigger - time.time(), 0))
+
+
+def _print_report(stats, duration):
+  """Prints the QPS and latency per endpoint, as measured by the clients."""
+  print('%-16s %8s %8s %9s %9s %7s' % (
+      'endpoint', 'requests', 'qps', 'p50 (ms)', 'p99 (ms)', 'errors'))
+  for endpoint in sorted(stats.latencies):
+    values = sorted(stats.latencies[endpoint])
+    errors = stats.errors.get(endpoint, 0)
+    print('%-16s %8d %8.1f %9.1f %9.1f %6.2f%%' % (
+        endpoint,
+        len(values),
+        len(values) / duration,
+        _percentile(values, 50) * 1000.,
+        _percentile(values, 99) * 1000.,
+        100. * errors / len(values)))
+
+
+def _fetch_server_profiling(client, start, end, timeout):
+  """Returns the profiling snapshots of the minutes from start to end, None if
+  they are not available within timeout seconds.
+
+  The snapshot of a minute is generated by the profiling cron job once the
+  minute is over. The dev server doesn't run the cron jobs, so it is called
+  directly, as many times as needed to catch up. On a fresh datastore, it
+  starts a few days back.
+  """
+  first = datetime.datetime.utcfromtimestamp(int(start) / 60 * 60)
+  last = datetime.datetime.utcfromtimestamp(int(end) / 60 * 60)
+  last_key = last.strftime('%Y-%m-%d %H:%M:%S')
+  resource = '/swarming/api/v1/stats/profiling/minutes?%s' % urllib.urlencode({
+    'duration': int((last - first).total_seconds() / 60) + 1,
+    'now': last.strftime('%Y-%m-%d %H:%M'),
+  })
+  deadline = time.time() + timeout
+  while True:
+    client.request(
+        '/internal/cron/profiling/update', headers={'X-AppEngine-Cron': 'true'})
+    resp = client.json_request(resource)
+    if resp.http_code != 200:
+      logging.warning('%s: HTTP %d', resource, resp.http_code)
+      return None
+    if any(i['key'] == last_key for i in resp.body):
+      return resp.body
+    if time.time() >= deadline:
+      return None
+
+
+def _print_server_report(snapshots):
+  """Prints the wall time and the RPCs per route, as profiled by the server.
+
+  The p50 is averaged across the minutes, weighted by their requests, and the
+  p99 is the worst minute.
+  """
+  routes = {}
+  for snapshot in snapshots:
+    for item in snapshot['routes']:
+      route = routes.setdefault(
+          item['route'],
+          {'calls': 0, 'p50': 0., 'p99': 0., 'requests': 0, 'rpc_ms': 0})
+      route['requests'] += item['requests']
+      route['p50'] += item['wall_secs_p50'] * item['requests']
+      route['p99'] = max(route['p99'], item['wall_secs_p99'])
+      for rpc in item['rpcs'].itervalues():
+        route['calls'] += rpc['calls']
+        route['rpc_ms'] += rpc['total_ms']
+  print('')
+  print('%-48s %8s %9s %9s %9s %11s' % (
+      'route (server-side)', 'profiled', 'p50 (ms)', 'p99 (ms)', 'rpcs/req',
+      'rpc ms/req'))
+  for name in sorted(routes):
+    route = routes[name]
+    requests = route['requests']
+    if not requests:
+      continue
+    print('%-48s %8d %9.1f %9.1f %9.1f %11.1f' % (
+        name,
+        requests,
+        route['p50'] / requests * 1000.,
+        route['p99'] * 1000.,
+        float(route['calls']) / requests,
+        float(route['rpc_ms']) / requests))
+
+
+### Public API.
+
+
+def run_load_test(url, dimensions_mix, options, dev_server=False):
+  """Runs the simulated fleet against |url| and prints the report.
+
+  The server-side report is only fetched from a dev server, as it requires an
+  admin.
+  """
+  start = time.time()
+  deadline = start + options.duration
+  stats = _Stats()
+  trigger = None
+  if options.tasks_per_sec:
+    # The triggering client is not authenticated, check that the server accepts
+    # it before starting the fleet.
+    client, xsrf_token, error = _client_handshake(url, stats)
+    if error:
+      print >> sys.stderr, error
+      return 1
+    trigger = threading.Thread(
+        target=_trigger_tasks,
+        args=(client, xsrf_token, dimensions_mix, options, deadline))
+    trigger.daemon = True
+    trigger.start()
+
+  per_process = (options.bots + options.processes - 1) / options.processes
+  args = [
+    (url, i, min(per_process, options.bots - i), dimensions_mix, options,
+      deadline)
+    for i in xrange(0, options.bots, per_process)
+  ]
+  if len(args) == 1:
+    results = [_run_bots_process(args[0])]
+  else:
+    pool = multiprocessing.Pool(len(args))
+    try:
+      results = pool.map(_run_bots_process, args)
+    finally:
+      pool.close()
+      pool.join()
+  for result in results:
+    stats.merge(result)
+  if trigger:
+    trigger.join()
+  end = time.time()
+  _print_report(stats, end - start)
+
+  if dev_server and options.server_stats_timeout:
+    client = local_app.HttpClient(url)
+    client.login_as_admin()
+    snapshots = _fetch_server_profiling(
+        client, start, end, options.server_stats_timeout)
+    if snapshots is None:
+      print >> sys.stderr, 'The server-side profiling snapshots are missing'
+    else:
+      _print_server_report(snapshots)
+  return 0
+
+
+def main():
+  parser = optparse.OptionParser(description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '-S', '--swarming',
+      help='Server to load test; defaults to starting a local dev server')
+  parser.add_option(
+      '--bots', type='int', default=100, help='Number of simulated bots')
+  parser.add_option(
+      '--processes', type='int', default=1,
+      help='Number of processes to spread the bots across')
+  parser.add_option(
+      '-d', '--dimensions', action='append', default=[],
+      help='Dimensions of a group of bots, formatted as '
+           '\'key=value,key=value[:weight]\'. Can be specified multiple times '
+           'to create a mix of bots')
+  parser.add_option(
+      '--duration', type='float', default=60.,
+      help='Duration of the load test in seconds')
+  parser.add_option(
+      '--ramp-up', type='float', default=10.,
+      help='Time spent starting all the bots, in seconds')
+  parser.add_option(
+      '--tasks-per-sec', type='float', default=1.,
+      help='Rate at which tasks are triggered; 0 to not trigger any')
+  parser.add_option(
+      '--task-duration', type='float', default=5.,
+      help='Time each simulated task takes')
+  parser.add_option(
+      '--output-chunks', type='int', default=3,
+      help='Number of intermediary output updates sent per task')
+  parser.add_option(
+      '--output-chunk-size', type='int', default=1024,
+      help='Size in bytes of each output update')
+  parser.add_option(
+      '--max-sleep', type='float', default=60.,
+      help='Caps the sleep duration requested by the server')
+  parser.add_option(
+      '--server-stats-timeout', type='float', default=300.,
+      help='Time to wait for the server-side profiling snapshots of the run '
+           'on the local dev server, in seconds; 0 to skip them')
+  parser.add_option('-v', '--verbose', action='store_true')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unknown arguments: %s' % args)
+  if options.bots < 1 or options.processes < 1:
+    parser.error('--bots and --processes must be at least 1')
+  if options.output_chunk_size < 1:
+    parser.error('--output-chunk-size must be at least 1')
+  logging.basicConfig(
+      level=logging.INFO if options.verbose else logging.ERROR)
+  try:
+    dimensions_mix = _parse_dimensions_mix(options.dimensions)
+  except ValueError as e:
+    parser.error('Invalid --dimensions: %s' % e)
+
+  if options.swarming:
+    return run_load_test(options.swarming.rstrip('/'), dimensions_mix, options)
+
+  app = local_app.LocalApplication(APP_DIR, 9050)
+  app.start()
+  try:
+    app.ensure_serving()
+    return run_load_test(app.url, dimensions_mix, options, dev_server=True)
+  finally:
+    app.stop()
+    if options.verbose:
+      app.dump_log()
+
+
+if __name__ == '__main__':
+  sys.exit(main())